@@ -0,0 +1,623 @@
+"""ASGI entry point for the visitor-facing portal routes
+
+Serves /, /validate, /booking/<email>, /process_payment, /api/process_payment
+and /health (plus the QR images and static assets those pages link to) from
+one event loop, so a single process keeps serving visitors while Firestore
+calls and SMTP sessions are in flight. Templates, caches, booking logic and
+the storage layout are shared with index.py.
+
+Firestore is reached through the async Firestore client; the SQLite and
+in-memory backends run on the default thread pool. Confirmation emails go out
+through aiosmtplib when it is installed, otherwise through the threaded
+outbox workers of index.py.
+
+Built on Starlette. Run with any ASGI server, e.g.:
+    pip install starlette uvicorn aiosmtplib
+    uvicorn asgi:app --app-dir api
+"""
+import asyncio
+import os
+import secrets
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from starlette.applications import Starlette
+from starlette.datastructures import MutableHeaders
+from starlette.middleware import Middleware
+from starlette.responses import HTMLResponse, JSONResponse, RedirectResponse, Response
+from starlette.routing import Route
+
+import index
+from index import (
+    metrics, booking_cache, idempotency_cache, qr_cache, email_outbox, smtp_pool, render_page, timed,
+    booking_steps, read_booking_by_booking_id_steps, payment_steps, payment_error_title, PaymentResult,
+    BaseSMTPConnectionPool, qr_code_etag, qr_signature_valid, generate_qr_png, ticket_payload, build_confirmation_email, StorageConflict, BookingStorage, FirestoreStorage, outbox_claimable,
+    STORAGE_BACKEND, STATIC_DIR, ASSET_FILES, ASSET_MAX_AGE, QR_MAX_AGE,
+    SMTP_SERVER, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, SMTP_STARTTLS, SMTP_TIMEOUT, SMTP_POOL_SIZE,
+    SMTP_POOL_IDLE_TIMEOUT, SMTP_POOL_CHECK_AFTER
+)
+
+class AsyncFirestoreStorage(BookingStorage):
+    """FirestoreStorage on the async Firestore client; same documents, awaitable methods
+
+    Implements the methods the request paths use; the rest of the interface
+    raises NotImplementedError.
+    """
+
+    name = 'firestore'
+
+    def __init__(self, client):
+        self.client = client
+        # Builds references and write batches only; every read and commit here is awaited
+        self.documents = FirestoreStorage(client)
+
+    async def get_booking(self, email_doc_id):
+        booking_doc = await self.documents._booking_ref(email_doc_id).get()
+        return (booking_doc.to_dict(), booking_doc.update_time) if booking_doc.exists else None
+
+    async def get_booking_by_booking_id(self, booking_id):
+        docs = await self.client.collection('bookings').where('booking_id', '==', booking_id).limit(1).get()
+        for doc in docs:
+            return doc.to_dict()
+        return None
+
+    async def update_booking(self, email_doc_id, fields):
+        await self.documents._booking_ref(email_doc_id).update(fields)
+
+    async def commit_payments(self, payments):
+        refs = self.documents.capacity_refs(payments)
+        capacity_shards = [shard_doc async for shard_doc in self.client.get_all(refs)] if refs else ()
+        batch = self.documents.payment_batch(payments, capacity_shards)
+        writes = len(batch)
+        try:
+            await batch.commit()
+            return writes
+        except Exception as e:
+            if type(e).__name__ in ('FailedPrecondition', 'NotFound', 'AlreadyExists'):
+                raise StorageConflict(str(e)) from e
+            raise
+
+    async def get_outbox(self, outbox_id):
+        outbox_doc = await self.client.collection('email_outbox').document(outbox_id).get()
+        return outbox_doc.to_dict() if outbox_doc.exists else None
+
+    async def update_outbox(self, outbox_id, fields):
+        await self.client.collection('email_outbox').document(outbox_id).update(fields)
+
+    async def claim_outbox(self, outbox_id, now, lease_until, owner):
+        outbox_ref = self.client.collection('email_outbox').document(outbox_id)
+        outbox_doc = await outbox_ref.get()
+        record = outbox_doc.to_dict() if outbox_doc.exists else None
+        if not outbox_claimable(record, now):
+            return None
+        try:
+            await outbox_ref.update({'lease_until': lease_until, 'lease_owner': owner},
+                                    option=self.client.write_option(last_update_time=outbox_doc.update_time))
+        except Exception as e:
+            if type(e).__name__ in ('FailedPrecondition', 'NotFound'):
+                return None
+            raise
+        return record
+
+    async def get_idempotency(self, key_id):
+        key_doc = await self.client.collection('idempotency_keys').document(key_id).get()
+        return key_doc.to_dict() if key_doc.exists else None
+
+class ThreadedStorage:
+    """Awaitable wrapper running a synchronous storage backend on the default thread pool"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.name = storage.name
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def call(*args):
+            return await asyncio.to_thread(method, *args)
+        return call
+
+def init_async_firestore():
+    if not index.init_firebase_app():
+        return None
+
+    from firebase_admin import firestore_async
+    return firestore_async.client()
+
+storage = None
+_storage_lock = threading.Lock()
+
+def create_storage(backend=STORAGE_BACKEND):
+    """Build the async counterpart of the configured storage backend, or None"""
+    if backend == 'firestore':
+        client = init_async_firestore()
+        return AsyncFirestoreStorage(client) if client is not None else None
+    sync_storage = index.get_storage()
+    return ThreadedStorage(sync_storage) if sync_storage is not None else None
+
+def get_storage():
+    """Async storage backend, created on first use"""
+    global storage
+    if storage is None:
+        with _storage_lock:
+            if storage is None:
+                try:
+                    storage = create_storage()
+                except Exception as e:
+                    print(f"Storage initialization error: {e}")
+    return storage
+
+class AsyncSingleFlight:
+    """Coalesce concurrent coroutines for the same key into one execution"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, fn, *args):
+        task = self._calls.get(key)
+        if task is not None:
+            metrics.inc('portal_singleflight_shared_total', flight=self.name)
+        else:
+            task = self._calls[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        # A disconnecting caller must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+booking_reads = AsyncSingleFlight('booking_read')
+booking_id_reads = AsyncSingleFlight('booking_id_read')
+payment_flights = AsyncSingleFlight('payment')
+
+flights = {flight.name: flight for flight in (booking_reads, booking_id_reads, payment_flights)}
+
+# Booking and payment logic comes from the steps generators of index.py, run here with
+# every storage call, sleep and send awaited on the event loop
+async def run_steps(steps, storage):
+    """Run an index.py steps generator to completion against an awaitable storage backend"""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await perform(step, storage), None
+        except Exception as e:
+            result, error = None, e
+
+async def perform(step, storage):
+    operation, args = step
+    if operation == 'shared':
+        flight, key, steps = args
+        return await flights[flight].do(key, run_steps, steps, storage)
+    if operation == 'sleep':
+        return await asyncio.sleep(*args)
+    if operation == 'send_email':
+        return await email_sender.send(*args)
+    if operation == 'dispatch_email':
+        return email_sender.dispatch(*args)
+    with timed('storage'):
+        return await getattr(storage, operation)(*args)
+
+async def get_booking_by_email(email):
+    storage = get_storage()
+    if not storage:
+        return None
+
+    try:
+        return await run_steps(booking_steps(email), storage)
+    except Exception as e:
+        print(f"Error fetching booking: {e}")
+        return None
+
+async def get_booking_by_booking_id(booking_id):
+    storage = get_storage()
+    if not storage:
+        return None
+
+    try:
+        return await booking_id_reads.do(booking_id, run_steps, read_booking_by_booking_id_steps(booking_id), storage)
+    except Exception as e:
+        print(f"Error fetching booking by ID: {e}")
+        return None
+
+async def process_payment(email, idempotency_key=None):
+    """Process payment and update booking; see index.process_payment"""
+    storage = get_storage()
+    if not storage:
+        return PaymentResult(False, "Database connection failed")
+    return await run_steps(payment_steps(email, idempotency_key), storage)
+
+class AsyncSMTPConnectionPool(BaseSMTPConnectionPool):
+    """index.SMTPConnectionPool on aiosmtplib sessions; same reuse policy and stats, awaitable methods"""
+
+    def __init__(self, smtp, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.smtp = smtp
+        # Created on first use, inside the event loop
+        self._slots = None
+
+    async def _connect(self):
+        server = self.smtp.SMTP(hostname=self.host, port=self.port, start_tls=self.starttls, timeout=self.timeout)
+        try:
+            await server.connect()
+            if server.supports_extension('auth'):
+                await server.login(self.username, self.password)
+        except Exception:
+            await self._close(server)
+            raise
+        with self._lock:
+            self.connects += 1
+        return server
+
+    async def _close(self, server):
+        try:
+            await server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    async def _is_alive(self, server):
+        try:
+            return (await server.noop()).code == 250
+        except Exception:
+            return False
+
+    async def acquire(self):
+        """Check out a healthy session, connecting if none is idle"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_size)
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                server, last_used = self._idle.pop()
+                idle_for = time.monotonic() - last_used
+                if idle_for > self.idle_timeout:
+                    await self._close(server)
+                    continue
+                if idle_for > self.check_after and not await self._is_alive(server):
+                    await self._close(server)
+                    continue
+                with self._lock:
+                    self.hits += 1
+                return server
+            return await self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    async def release(self, server, broken=False):
+        """Return a session to the pool, closing it if it is no longer usable"""
+        try:
+            if broken:
+                await self._close(server)
+            else:
+                self._idle.append((server, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    async def send(self, msg):
+        """Send a message over a pooled session"""
+        started = time.perf_counter()
+        server = await self.acquire()
+        broken = False
+        try:
+            try:
+                await server.send_message(msg)
+            except self.smtp.SMTPServerDisconnected:
+                await self._close(server)
+                server = None
+                with self._lock:
+                    self.reconnects += 1
+                server = await self._connect()
+                await server.send_message(msg)
+        except self.smtp.SMTPResponseException:
+            # The server rejected the message but the session is still usable
+            with self._lock:
+                self.failures += 1
+            raise
+        except Exception:
+            broken = True
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            if server is None:
+                self._slots.release()
+            else:
+                await self.release(server, broken=broken)
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.sends += 1
+                self.send_time_total += elapsed
+                self.send_time_max = max(self.send_time_max, elapsed)
+
+    async def close(self):
+        """Close every idle session"""
+        idle, self._idle = self._idle, []
+        for server, _ in idle:
+            await self._close(server)
+
+class AsyncEmailSender:
+    """Deliver outbox records with aiosmtplib as tasks on the event loop
+
+    Runs the delivery steps of index.EmailOutbox (claiming, attempt counting,
+    backoff, email_status on the booking) against the same outbox records;
+    retries are left to its drain. Without aiosmtplib, records are
+    handed to the threaded outbox instead.
+    """
+
+    def __init__(self, max_connections=2):
+        self._tasks = set()
+        self._inflight = set()
+        self.pool = None
+        try:
+            import aiosmtplib
+            self.smtp = aiosmtplib
+        except ImportError:
+            self.smtp = None
+            return
+        self.pool = AsyncSMTPConnectionPool(
+            aiosmtplib, SMTP_SERVER, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD,
+            starttls=SMTP_STARTTLS,
+            max_size=max_connections,
+            idle_timeout=SMTP_POOL_IDLE_TIMEOUT,
+            check_after=SMTP_POOL_CHECK_AFTER,
+            timeout=SMTP_TIMEOUT
+        )
+
+    def dispatch(self, outbox_id):
+        if self.smtp is None:
+            email_outbox.dispatch(outbox_id)
+            return
+        task = asyncio.ensure_future(self._deliver_now(outbox_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def pending(self):
+        return len(self._tasks) if self.smtp is not None else email_outbox.pending()
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _deliver_now(self, outbox_id):
+        if outbox_id in self._inflight:
+            return
+        self._inflight.add(outbox_id)
+        try:
+            await self.deliver(outbox_id)
+        except Exception as e:
+            print(f"Email outbox worker error: {e}")
+        finally:
+            self._inflight.discard(outbox_id)
+
+    async def send(self, payload):
+        if not SMTP_USERNAME or not SMTP_PASSWORD:
+            print("SMTP credentials not configured")
+            return False
+        try:
+            # Building the message may encode a QR image, which is CPU-bound
+            msg = await asyncio.to_thread(build_confirmation_email, payload)
+            with timed('smtp'):
+                await self.pool.send(msg)
+            metrics.inc('portal_emails_total', result='sent')
+            return True
+        except Exception as e:
+            print(f"Failed to send email: {e}")
+            metrics.inc('portal_emails_total', result='failed')
+            return False
+
+    async def deliver(self, outbox_id):
+        """Attempt delivery of one outbox record; None if it wasn't available to claim"""
+        return await run_steps(email_outbox.delivery_steps(outbox_id), get_storage())
+
+email_sender = AsyncEmailSender(max_connections=SMTP_POOL_SIZE)
+
+# HTTP helpers
+async def read_form(request):
+    """Fields of a URL-encoded form post, the only kind the pages send"""
+    if not request.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+        return {}
+    body = await request.body()
+    return {key: values[0] for key, values in parse_qs(body.decode('utf-8', 'replace')).items()}
+
+def request_idempotency_key(request, data):
+    """Idempotency key from the Idempotency-Key header or an idempotency_key field"""
+    key = request.headers.get('idempotency-key') or data.get('idempotency_key')
+    key = str(key or '').strip()
+    return key or None
+
+def html(page, **context):
+    return HTMLResponse(render_page(page, **context))
+
+def redirect(location):
+    return RedirectResponse(location, status_code=302)
+
+# Routes
+async def home(request):
+    email = request.query_params.get('email', '')
+    if email:
+        return redirect(f"/booking/{email}")
+    return html('home')
+
+async def validate_email(request):
+    email = (await read_form(request)).get('email', '').strip()
+
+    if not email:
+        return html('error', error_message="Please enter a valid email address.")
+
+    booking = await get_booking_by_email(email)
+
+    if not booking:
+        return html('error', error_message="No booking found for this email address. Please check and try again.")
+
+    return redirect(f"/booking/{email}")
+
+async def booking_details(request):
+    booking = await get_booking_by_email(request.path_params['email'])
+
+    if not booking:
+        return html('error', error_message="Booking not found or has expired.")
+
+    return html('booking', booking=booking, idempotency_key=secrets.token_hex(16))
+
+async def process_payment_route(request):
+    form = await read_form(request)
+    email = form.get('email', '').strip()
+
+    if not email:
+        return html('error', error_message="Invalid request.")
+
+    result = await process_payment(email, request_idempotency_key(request, form))
+    success, message = result
+
+    if success:
+        return html('success', email=email)
+    else:
+        return html('error', error_title=payment_error_title(result), error_message=message)
+
+async def api_process_payment(request):
+    try:
+        data = await request.json()
+        email = data.get('email')
+
+        if not email:
+            return JSONResponse({'success': False, 'error': 'Email is required'})
+
+        result = await process_payment(email, request_idempotency_key(request, data))
+        success, message = result
+
+        if result.sold_out:
+            return JSONResponse({'success': False, 'sold_out': True, 'message': message}, 409)
+
+        return JSONResponse({
+            'success': success,
+            'message': message
+        })
+    except Exception as e:
+        return JSONResponse({'success': False, 'error': str(e)})
+
+async def qr_image(request):
+    booking_id = request.path_params['booking_id']
+    signature = request.query_params.get('sig')
+    # Without a signing key the token is the booking's hash, checked once the booking is read
+    if index.TICKET_SIGNING_KEY and not qr_signature_valid(booking_id, signature):
+        return JSONResponse({'error': 'QR code not found'}, 404)
+
+    etag = f'"{qr_code_etag(booking_id)}"'
+    headers = {'etag': etag, 'cache-control': f"public, max-age={QR_MAX_AGE}, immutable"}
+
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+
+    booking = await get_booking_by_booking_id(booking_id)
+    if not booking or booking.get('status') != 'completed' or not qr_signature_valid(booking_id, signature, booking):
+        return JSONResponse({'error': 'QR code not found'}, 404)
+
+    try:
+        png = await asyncio.to_thread(generate_qr_png, ticket_payload(booking))
+    except Exception as e:
+        print(f"QR code generation failed: {e}")
+        return JSONResponse({'error': 'QR code generation failed'}, 500)
+
+    return Response(png, media_type='image/png', headers=headers)
+
+async def static_asset(request):
+    name = ASSET_FILES.get(request.path_params['filename'])
+    if not name:
+        return JSONResponse({'error': 'Asset not found'}, 404)
+
+    with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+        body = f.read()
+    media_type = 'text/css' if name.endswith('.css') else 'text/javascript'
+    return Response(body, media_type=media_type,
+                    headers={'cache-control': f"public, max-age={ASSET_MAX_AGE}, immutable"})
+
+async def health_check(request):
+    # As index.health_check: null until storage is first used, never connected from here
+    connected = True if storage is not None else None
+    return JSONResponse({
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "server": "asgi",
+        "storage": STORAGE_BACKEND,
+        "storage_connected": connected,
+        "ticket_signing_configured": bool(index.TICKET_SIGNING_KEY),
+        "async_smtp": email_sender.smtp is not None,
+        "qr_cache": qr_cache.stats(),
+        "booking_cache": booking_cache.stats(),
+        "idempotency_cache": idempotency_cache.stats(),
+        "email_queue": email_sender.pending(),
+        "smtp_pool": (email_sender.pool or smtp_pool).stats()
+    })
+
+async def catch_all(request):
+    return redirect('/')
+
+async def server_error(request, exc):
+    print(f"Unhandled error on {request.url.path}: {exc}")
+    return JSONResponse({'error': 'Internal server error'}, 500)
+
+class RequestTiming:
+    """Request latency histogram and Server-Timing header, as index.record_request_timing"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+
+        def observe(status):
+            elapsed = time.perf_counter() - started
+            # The router leaves the matched route in the scope
+            route = scope['route'].path if scope.get('route') else 'unmatched'
+            metrics.observe('portal_request_duration_seconds', elapsed, route=route, method=scope['method'],
+                            status=str(status))
+            return elapsed
+
+        async def send_timed(message):
+            if message['type'] == 'http.response.start':
+                elapsed = observe(message['status'])
+                MutableHeaders(scope=message).append('server-timing', f"total;dur={elapsed * 1000:.2f}")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        except Exception:
+            observe(500)
+            raise
+
+@asynccontextmanager
+async def lifespan(app):
+    # Due and retried emails are drained by index.py's drainer thread or the cron
+    email_outbox.start_drainer()
+    index.expiry_sweeper.start()
+    yield
+    if email_sender.pool is not None:
+        await email_sender.pool.close()
+
+app = Starlette(
+    routes=[
+        Route('/', home, methods=['GET']),
+        Route('/validate', validate_email, methods=['POST']),
+        Route('/booking/{email}', booking_details, methods=['GET']),
+        Route('/process_payment', process_payment_route, methods=['POST']),
+        Route('/api/process_payment', api_process_payment, methods=['POST']),
+        Route('/qr/{booking_id}.png', qr_image, methods=['GET']),
+        Route('/static/{filename}', static_asset, methods=['GET']),
+        Route('/health', health_check, methods=['GET']),
+        Route('/{path:path}', catch_all, methods=['GET', 'POST']),
+    ],
+    middleware=[Middleware(RequestTiming)],
+    exception_handlers={Exception: server_error},
+    lifespan=lifespan
+)
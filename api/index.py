@@ -1,22 +1,42 @@
-from flask import Flask, render_template_string, request, redirect, jsonify
-import firebase_admin
-from firebase_admin import credentials, firestore
-import qrcode
+from flask import Flask, request, redirect, jsonify, send_from_directory, g, has_request_context
+import click
+from jinja2 import DictLoader
 import io
 import base64
 import hashlib
+import hmac
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.mime.image import MIMEImage
+from email.charset import Charset, QP
+from email.header import Header
 from datetime import datetime, timedelta
+from collections import OrderedDict
 import os
 import json
-
-app = Flask(__name__)
+import threading
+import time
+import queue
+import copy
+import sqlite3
+import tempfile
+import sys
+import random
+import secrets
+import importlib
+from contextlib import contextmanager
+
+app = Flask(__name__, static_folder=None)
 app.secret_key = os.environ.get('SECRET_KEY', 'athena-museum-secret-key')
 
 # Firebase Configuration using environment variables
-def init_firebase():
+def init_firebase_app():
+    """Initialize the default Firebase app; False if the credentials are unusable"""
+    # firebase_admin pulls in the gRPC Firestore stack, so it is imported on first use
+    import firebase_admin
+    from firebase_admin import credentials
+    
     if not firebase_admin._apps:
         try:
             # Use environment variables for Firebase credentials
@@ -38,533 +58,1284 @@ def init_firebase():
             firebase_admin.initialize_app(cred)
         except Exception as e:
             print(f"Firebase initialization error: {e}")
-            return None
+            return False
     
-    return firestore.client()
-
-# Initialize Firebase
-db = init_firebase()
-
-# SMTP Configuration from environment variables
-SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
-SMTP_PORT = int(os.environ.get('SMTP_PORT', '587'))
-SMTP_USERNAME = os.environ.get('SMTP_USERNAME', 'chsantosh2004@gmail.com')
-SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', 'kzka uohw hbxg gwgi')
-
-# Streamlit app URL
-STREAMLIT_APP_URL = "https://update-athena-chatbot.streamlit.app"
-
-# Enhanced HTML Template with 3D Effects and Back Button
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Athena Museum - Payment Portal</title>
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;500;600;700&display=swap');
-        
-        :root {
-            --primary-color: #6c63ff;
-            --secondary-color: #764ba2;
-            --accent-color: #ff6b6b;
-            --text-color: #ffffff;
-            --bg-dark: #0f172a;
-            --bg-card: rgba(255, 255, 255, 0.05);
-            --border-color: rgba(255, 255, 255, 0.1);
-        }
-        
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-
-        body {
-            font-family: 'Poppins', sans-serif;
-            background: linear-gradient(135deg, #0f172a 0%, #1e293b 100%);
-            min-height: 100vh;
-            color: var(--text-color);
-            overflow-x: hidden;
-            position: relative;
-        }
-
-        /* Animated Background */
-        .bg-animation {
-            position: fixed;
-            top: 0;
-            left: 0;
-            width: 100%;
-            height: 100%;
-            z-index: -1;
-            overflow: hidden;
-        }
-
-        .bg-animation span {
-            position: absolute;
-            display: block;
-            width: 20px;
-            height: 20px;
-            background: rgba(255, 255, 255, 0.05);
-            animation: animate 25s linear infinite;
-            bottom: -150px;
-            border-radius: 50%;
-        }
-
-        .bg-animation span:nth-child(1) { left: 25%; width: 80px; height: 80px; animation-delay: 0s; }
-        .bg-animation span:nth-child(2) { left: 10%; width: 20px; height: 20px; animation-delay: 2s; animation-duration: 12s; }
-        .bg-animation span:nth-child(3) { left: 70%; width: 20px; height: 20px; animation-delay: 4s; }
-        .bg-animation span:nth-child(4) { left: 40%; width: 60px; height: 60px; animation-delay: 0s; animation-duration: 18s; }
-        .bg-animation span:nth-child(5) { left: 65%; width: 20px; height: 20px; animation-delay: 0s; }
-        .bg-animation span:nth-child(6) { left: 75%; width: 110px; height: 110px; animation-delay: 3s; }
-        .bg-animation span:nth-child(7) { left: 35%; width: 150px; height: 150px; animation-delay: 7s; }
-        .bg-animation span:nth-child(8) { left: 50%; width: 25px; height: 25px; animation-delay: 15s; animation-duration: 45s; }
-        .bg-animation span:nth-child(9) { left: 20%; width: 15px; height: 15px; animation-delay: 2s; animation-duration: 35s; }
-        .bg-animation span:nth-child(10) { left: 85%; width: 150px; height: 150px; animation-delay: 0s; animation-duration: 11s; }
-
-        @keyframes animate {
-            0% { transform: translateY(0) rotate(0deg); opacity: 1; border-radius: 50%; }
-            100% { transform: translateY(-1000px) rotate(720deg); opacity: 0; border-radius: 50%; }
-        }
-
-        /* Stylish Back Button */
-        .back-button {
-            position: fixed;
-            top: 20px;
-            left: 20px;
-            z-index: 1000;
-            background: linear-gradient(135deg, #6c63ff 0%, #764ba2 100%);
-            border: none;
-            border-radius: 50px;
-            padding: 12px 24px;
-            color: white;
-            font-weight: 600;
-            font-size: 16px;
-            cursor: pointer;
-            text-decoration: none;
-            display: flex;
-            align-items: center;
-            gap: 10px;
-            box-shadow: 0 8px 25px rgba(108, 99, 255, 0.4);
-            transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1);
-            backdrop-filter: blur(10px);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-        }
-        
-        .back-button:hover {
-            transform: translateY(-3px) scale(1.05);
-            box-shadow: 0 12px 35px rgba(108, 99, 255, 0.6);
-            background: linear-gradient(135deg, #764ba2 0%, #6c63ff 100%);
-        }
-        
-        .back-button:active {
-            transform: translateY(-1px) scale(1.02);
-        }
-        
-        .back-arrow {
-            font-size: 18px;
-            transition: transform 0.3s ease;
-        }
-        
-        .back-button:hover .back-arrow {
-            transform: translateX(-5px);
-        }
-        
-        /* Floating particles animation */
-        .back-button::before {
-            content: '';
-            position: absolute;
-            top: 0;
-            left: 0;
-            right: 0;
-            bottom: 0;
-            border-radius: 50px;
-            background: linear-gradient(135deg, rgba(255,255,255,0.1), rgba(255,255,255,0.05));
-            opacity: 0;
-            transition: opacity 0.3s ease;
-        }
-        
-        .back-button:hover::before {
-            opacity: 1;
-        }
-
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 2rem;
-            position: relative;
-            z-index: 1;
-        }
-
-        .header {
-            text-align: center;
-            margin-bottom: 3rem;
-            position: relative;
-            margin-top: 2rem;
-        }
-
-        .header h1 {
-            font-size: clamp(2.5rem, 5vw, 4rem);
-            font-weight: 700;
-            margin-bottom: 0.5rem;
-            background: linear-gradient(to right, #6c63ff, #764ba2, #ff6b6b);
-            -webkit-background-clip: text;
-            background-clip: text;
-            -webkit-text-fill-color: transparent;
-            position: relative;
-            display: inline-block;
-        }
-
-        .header h1::after {
-            content: '';
-            position: absolute;
-            bottom: -10px;
-            left: 50%;
-            transform: translateX(-50%);
-            width: 100px;
-            height: 4px;
-            background: linear-gradient(to right, #6c63ff, #764ba2);
-            border-radius: 2px;
-        }
-
-        .header p {
-            font-size: 1.2rem;
-            color: rgba(255, 255, 255, 0.7);
-            margin-top: 1rem;
-        }
+    return True
 
-        .card {
-            background: rgba(255, 255, 255, 0.03);
-            backdrop-filter: blur(10px);
-            border-radius: 20px;
-            padding: 2.5rem;
-            margin-bottom: 2rem;
-            border: 1px solid rgba(255, 255, 255, 0.1);
-            box-shadow: 0 10px 30px rgba(0, 0, 0, 0.1);
-            transform-style: preserve-3d;
-            perspective: 1000px;
-            transition: all 0.5s cubic-bezier(0.175, 0.885, 0.32, 1.275);
-            position: relative;
-            overflow: hidden;
-        }
-
-        .card::before {
-            content: '';
-            position: absolute;
-            top: 0;
-            left: -100%;
-            width: 100%;
-            height: 100%;
-            background: linear-gradient(90deg, transparent, rgba(255, 255, 255, 0.05), transparent);
-            transition: 0.5s;
-        }
-
-        .card:hover::before { left: 100%; }
-        .card:hover {
-            transform: translateY(-10px) rotateX(5deg);
-            box-shadow: 0 20px 40px rgba(0, 0, 0, 0.2);
-            border-color: rgba(255, 255, 255, 0.2);
-        }
-
-        .card h2 {
-            font-size: 1.8rem;
-            margin-bottom: 1.5rem;
-            color: #fff;
-            text-align: center;
-            position: relative;
-            padding-bottom: 0.5rem;
-        }
-
-        .card h2::after {
-            content: '';
-            position: absolute;
-            bottom: 0;
-            left: 50%;
-            transform: translateX(-50%);
-            width: 50px;
-            height: 3px;
-            background: linear-gradient(to right, var(--primary-color), var(--secondary-color));
-            border-radius: 2px;
-        }
-
-        .form-group {
-            margin-bottom: 1.5rem;
-            position: relative;
-        }
-
-        .form-group label {
-            display: block;
-            margin-bottom: 0.5rem;
-            font-size: 1rem;
-            font-weight: 500;
-            color: rgba(255, 255, 255, 0.8);
-        }
-
-        .form-control {
-            width: 100%;
-            padding: 1rem 1.5rem;
-            background: rgba(255, 255, 255, 0.05);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-            border-radius: 10px;
-            color: #fff;
-            font-size: 1rem;
-            transition: all 0.3s ease;
-        }
-
-        .form-control:focus {
-            outline: none;
-            border-color: var(--primary-color);
-            box-shadow: 0 0 0 3px rgba(108, 99, 255, 0.2);
-            background: rgba(255, 255, 255, 0.1);
-        }
-
-        .form-control::placeholder { color: rgba(255, 255, 255, 0.4); }
-
-        .btn {
-            display: inline-block;
-            padding: 1rem 2rem;
-            background: linear-gradient(45deg, var(--primary-color), var(--secondary-color));
-            color: white;
-            border: none;
-            border-radius: 10px;
-            font-size: 1rem;
-            font-weight: 600;
-            cursor: pointer;
-            transition: all 0.3s ease;
-            text-align: center;
-            text-decoration: none;
-            position: relative;
-            overflow: hidden;
-            z-index: 1;
-            width: 100%;
-        }
-
-        .btn::before {
-            content: '';
-            position: absolute;
-            top: 0;
-            left: 0;
-            width: 100%;
-            height: 100%;
-            background: linear-gradient(45deg, var(--secondary-color), var(--primary-color));
-            z-index: -1;
-            transition: opacity 0.3s ease;
-            opacity: 0;
-        }
-
-        .btn:hover::before { opacity: 1; }
-        .btn:hover {
-            transform: translateY(-3px);
-            box-shadow: 0 10px 20px rgba(108, 99, 255, 0.3);
-        }
-        .btn:active { transform: translateY(-1px); }
-
-        .btn-accent {
-            background: linear-gradient(45deg, var(--accent-color), #ff8e8e);
-        }
-
-        .btn-accent::before {
-            background: linear-gradient(45deg, #ff8e8e, var(--accent-color));
-        }
-
-        .booking-details { margin-top: 2rem; }
-
-        .detail-row {
-            display: flex;
-            justify-content: space-between;
-            padding: 1rem 0;
-            border-bottom: 1px solid rgba(255, 255, 255, 0.1);
-        }
+def init_firebase():
+    if not init_firebase_app():
+        return None
+    
+    from firebase_admin import firestore
+    return firestore.client()
 
-        .detail-row:last-child { border-bottom: none; }
+# Firebase is initialized on first use rather than at import to keep cold starts cheap
+db = None
+_db_initialized = False
+_db_lock = threading.Lock()
+
+def get_db():
+    """Firestore client, initialized on first use"""
+    global db, _db_initialized
+    if db is None and not _db_initialized:
+        with _db_lock:
+            if not _db_initialized:
+                db = init_firebase()
+                _db_initialized = True
+    return db
+
+# Storage backend selection: firestore (default), sqlite or memory
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'firestore').lower()
+SQLITE_PATH = os.environ.get('SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'athena_portal.db'))
+
+class StorageConflict(Exception):
+    """A conditional write found the booking missing or changed since it was read"""
+
+class SoldOut(Exception):
+    """Not enough capacity left on a day for a reservation"""
+
+    def __init__(self, day):
+        super().__init__(f"No capacity left for {day}")
+        self.day = day
+
+class BookingStorage:
+    """Persistence interface for bookings, payments and the email outbox
+
+    Bookings are keyed by email doc id and read together with an opaque version.
+    commit_payments applies a group of payments atomically: each booking update
+    is conditional on the version it was read at, and raises StorageConflict if
+    any booking is missing or has changed.
+
+    A payment is a dict with email_doc_id, version, updates (booking fields),
+    booking_id, payment (payments record) and outbox (email outbox record,
+    stored under the booking ID).
+    """
+
+    name = None
+
+    def get_booking(self, email_doc_id):
+        """(data, version) of a booking, or None"""
+        raise NotImplementedError
+
+    def get_bookings(self, email_doc_ids):
+        """{email_doc_id: (data, version)} for the bookings that exist"""
+        raise NotImplementedError
+
+    def get_booking_by_booking_id(self, booking_id):
+        """Booking data for a booking ID, or None"""
+        raise NotImplementedError
+
+    def put_bookings(self, bookings):
+        """Create or replace bookings from {email_doc_id: data}"""
+        raise NotImplementedError
+
+    def update_booking(self, email_doc_id, fields):
+        """Merge fields into an existing booking"""
+        raise NotImplementedError
+
+    def commit_payments(self, payments):
+        """Atomically apply booking updates, payment records, outbox records,
+        idempotency records, capacity reservations and the daily stats rollup
+
+        Returns the number of records written. Raises StorageConflict if a
+        booking changed since it was read, and SoldOut if a day lacks capacity
+        for its reservations.
+        """
+        raise NotImplementedError
 
-        .detail-label {
-            font-weight: 500;
-            color: rgba(255, 255, 255, 0.7);
-        }
+    def get_daily_stats(self, days):
+        """{day: {'tickets', 'amount', 'payments'}} for 'YYYY-MM-DD' days with payments"""
+        raise NotImplementedError
 
-        .detail-value {
-            font-weight: 600;
-            color: #fff;
-        }
+    def remaining_capacity(self, day):
+        """Tickets still available on a day"""
+        raise NotImplementedError
 
-        .status-badge {
-            display: inline-block;
-            padding: 0.5rem 1rem;
-            border-radius: 50px;
-            font-size: 0.8rem;
-            font-weight: 600;
-            text-transform: uppercase;
-        }
+    def put_outbox(self, outbox_id, record):
+        raise NotImplementedError
 
-        .status-pending { background: linear-gradient(45deg, #f39c12, #e67e22); color: white; }
-        .status-completed { background: linear-gradient(45deg, #2ecc71, #27ae60); color: white; }
-        .status-expired { background: linear-gradient(45deg, #e74c3c, #c0392b); color: white; }
-
-        .qr-container {
-            margin-top: 2rem;
-            text-align: center;
-            background: white;
-            padding: 2rem;
-            border-radius: 15px;
-            box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
-            transform: perspective(1000px);
-            transition: all 0.3s ease;
-        }
+    def get_outbox(self, outbox_id):
+        raise NotImplementedError
 
-        .qr-container:hover { transform: perspective(1000px) rotateX(5deg); }
-        .qr-container h3 { color: #333; margin-bottom: 1rem; }
-        .qr-container img {
-            max-width: 200px;
-            border-radius: 10px;
-            box-shadow: 0 5px 15px rgba(0, 0, 0, 0.1);
-        }
+    def update_outbox(self, outbox_id, fields):
+        raise NotImplementedError
 
-        .alert {
-            padding: 1.5rem;
-            border-radius: 10px;
-            margin-bottom: 1.5rem;
-            position: relative;
-            overflow: hidden;
-        }
+    def due_outbox_ids(self, now, limit):
+        """IDs of pending outbox records whose next attempt is due by now"""
+        raise NotImplementedError
 
-        .alert::before {
-            content: '';
-            position: absolute;
-            top: 0;
-            left: 0;
-            width: 5px;
-            height: 100%;
-        }
-
-        .alert-success {
-            background: rgba(46, 204, 113, 0.1);
-            border: 1px solid rgba(46, 204, 113, 0.3);
-            color: #2ecc71;
-        }
+    def claim_outbox(self, outbox_id, now, lease_until, owner):
+        """Lease a due, unleased pending outbox record for one delivery attempt
 
-        .alert-success::before { background: #2ecc71; }
+        Returns the record, or None if it is not due or another worker holds
+        it. Only one of several concurrent claims on a record succeeds.
+        """
+        raise NotImplementedError
 
-        .alert-error {
-            background: rgba(231, 76, 60, 0.1);
-            border: 1px solid rgba(231, 76, 60, 0.3);
-            color: #e74c3c;
-        }
+    def get_idempotency(self, key_id):
+        """Stored result for an idempotency key, or None"""
+        raise NotImplementedError
 
-        .alert-error::before { background: #e74c3c; }
+    def purge_idempotency(self, before):
+        """Delete idempotency records that expired by a time; returns how many were deleted"""
+        raise NotImplementedError
 
-        .museum-info {
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(300px, 1fr));
-            gap: 1.5rem;
-            margin-top: 3rem;
-        }
+    def expired_bookings(self, before, limit, cursor=None):
+        """[(email_doc_id, validity, version)] of pending bookings with validity before a time
 
-        .info-card {
-            background: rgba(255, 255, 255, 0.03);
-            backdrop-filter: blur(10px);
-            border-radius: 15px;
-            padding: 1.5rem;
-            border: 1px solid rgba(255, 255, 255, 0.1);
-            transition: all 0.3s ease;
+        Ordered by (validity, email_doc_id) and starting after cursor, a
+        (validity, email_doc_id) pair from a previous page.
+        """
+        raise NotImplementedError
+
+    def expire_bookings(self, bookings):
+        """Atomically mark [(email_doc_id, version)] expired, if none changed since read"""
+        raise NotImplementedError
+
+    def completed_bookings(self, limit, cursor=None):
+        """[(email_doc_id, data)] of completed bookings in email_doc_id order, starting after cursor"""
+        raise NotImplementedError
+
+# Daily payment rollups. Firestore sustains about one write per second per document,
+# so each day's counters are spread over STATS_SHARDS documents and summed on read.
+STATS_SHARDS = int(os.environ.get('STATS_SHARDS', '10'))
+STATS_FIELDS = ('tickets', 'amount', 'payments')
+
+# Daily visitor capacity; 0 leaves it unlimited. A day's remaining tickets are spread over
+# CAPACITY_SHARDS counters so concurrent payments mostly update different documents.
+DAILY_CAPACITY = int(os.environ.get('DAILY_CAPACITY', '0'))
+CAPACITY_SHARDS = int(os.environ.get('CAPACITY_SHARDS', '20'))
+
+def payment_reservations(payments):
+    """{day: tickets} to reserve for a set of payments"""
+    reservations = {}
+    for payment in payments:
+        if payment.get('reservation'):
+            day, tickets = payment['reservation']
+            reservations[day] = reservations.get(day, 0) + tickets
+    return reservations
+
+def payment_writes(payments):
+    """Records written by commit_payments on backends keeping one capacity and stats row per day"""
+    return (sum(4 if payment.get('idempotency') else 3 for payment in payments)
+            + len(payment_reservations(payments)) + len(payment_rollup(payments)))
+
+# A Firestore commit holds at most 500 writes
+BATCH_WRITE_LIMIT = 500
+
+def payment_groups(payments, limit=BATCH_WRITE_LIMIT):
+    """Split (email, payment) pairs into groups that commit_payments can write in one commit
+
+    Sized by the most a commit can write: the records of each payment, up to
+    CAPACITY_SHARDS capacity writes per visit day reserved, and a stats rollup
+    write for each of the (at most two, across midnight) days paid on.
+    """
+    groups, group, days, writes = [], [], set(), 2
+    for entry in payments:
+        payment = entry[1]
+        day = payment['reservation'][0] if payment.get('reservation') else None
+        records = 4 if payment.get('idempotency') else 3
+        cost = records + (CAPACITY_SHARDS if day and day not in days else 0)
+        if group and writes + cost > limit:
+            groups.append(group)
+            group, days, writes = [], set(), 2
+            cost = records + (CAPACITY_SHARDS if day else 0)
+        group.append(entry)
+        writes += cost
+        if day:
+            days.add(day)
+    if group:
+        groups.append(group)
+    return groups
+
+def split_capacity(capacity, shards):
+    """Initial remaining count of each counter shard for a day"""
+    return [capacity // shards + (1 if shard < capacity % shards else 0) for shard in range(shards)]
+
+def _stat_value(value):
+    """Numeric value of a booking field for the rollup; anything unparseable counts as 0"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+def payment_rollup(payments):
+    """{day: {'tickets', 'amount', 'payments'}} increments for a set of payments"""
+    rollup = {}
+    for payment in payments:
+        record = payment['payment']
+        totals = rollup.setdefault(record['created_at'].strftime('%Y-%m-%d'), dict.fromkeys(STATS_FIELDS, 0))
+        totals['tickets'] += _stat_value(record.get('tickets'))
+        totals['amount'] += _stat_value(record.get('amount'))
+        totals['payments'] += 1
+    return rollup
+
+class FirestoreStorage(BookingStorage):
+    """Storage on Cloud Firestore; versions are document update times"""
+
+    name = 'firestore'
+
+    def __init__(self, client):
+        self.client = client
+
+    def _booking_ref(self, email_doc_id):
+        return self.client.collection('bookings').document(email_doc_id)
+
+    def get_booking(self, email_doc_id):
+        booking_doc = self._booking_ref(email_doc_id).get()
+        return (booking_doc.to_dict(), booking_doc.update_time) if booking_doc.exists else None
+
+    def get_bookings(self, email_doc_ids):
+        refs = [self._booking_ref(email_doc_id) for email_doc_id in email_doc_ids]
+        return {
+            booking_doc.id: (booking_doc.to_dict(), booking_doc.update_time)
+            for booking_doc in self.client.get_all(refs) if booking_doc.exists
         }
 
-        .info-card:hover {
-            transform: translateY(-5px);
-            box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
-            border-color: rgba(255, 255, 255, 0.2);
-        }
+    def get_booking_by_booking_id(self, booking_id):
+        docs = self.client.collection('bookings').where('booking_id', '==', booking_id).limit(1).get()
+        for doc in docs:
+            return doc.to_dict()
+        return None
 
-        .info-card h3 {
-            font-size: 1.2rem;
-            margin-bottom: 1rem;
-            color: #fff;
-            display: flex;
-            align-items: center;
-        }
+    def put_bookings(self, bookings):
+        items = list(bookings.items())
+        for start in range(0, len(items), 500):
+            batch = self.client.batch()
+            for email_doc_id, data in items[start:start + 500]:
+                batch.set(self._booking_ref(email_doc_id), data)
+            batch.commit()
+
+    def update_booking(self, email_doc_id, fields):
+        self._booking_ref(email_doc_id).update(fields)
+
+    def _capacity_ref(self, day, shard):
+        return self.client.collection('capacity').document(f"{day}-{shard}")
+
+    def capacity_refs(self, payments):
+        """Counter shards to read before reserving capacity for payments"""
+        return [
+            self._capacity_ref(day, shard)
+            for day in payment_reservations(payments) for shard in range(CAPACITY_SHARDS)
+        ]
+
+    def _reserve(self, batch, payments, capacity_shards):
+        """Add capacity reservations to a batch, as conditional writes on the shards read"""
+        shards = {shard_doc.id: shard_doc for shard_doc in capacity_shards}
+        for day, tickets in payment_reservations(payments).items():
+            day_shards = [shards.get(f"{day}-{shard}") for shard in range(CAPACITY_SHARDS)]
+            
+            if not any(shard_doc is not None and shard_doc.exists for shard_doc in day_shards):
+                # The day's first reservation creates its shards; a concurrent creator makes the commit fail
+                remaining = split_capacity(DAILY_CAPACITY, CAPACITY_SHARDS)
+                if sum(remaining) < tickets:
+                    raise SoldOut(day)
+                needed = tickets
+                for shard in random.sample(range(CAPACITY_SHARDS), CAPACITY_SHARDS):
+                    take = min(needed, remaining[shard])
+                    remaining[shard] -= take
+                    needed -= take
+                for shard, value in enumerate(remaining):
+                    batch.create(self._capacity_ref(day, shard), {'day': day, 'shard': shard, 'remaining': value})
+                continue
+            
+            # Prefer a single random shard that covers the whole reservation
+            candidates = [shard_doc for shard_doc in day_shards if shard_doc is not None and (shard_doc.get('remaining') or 0) > 0]
+            random.shuffle(candidates)
+            candidates.sort(key=lambda shard_doc: shard_doc.get('remaining') < tickets)
+            if sum(shard_doc.get('remaining') for shard_doc in candidates) < tickets:
+                raise SoldOut(day)
+            needed = tickets
+            for shard_doc in candidates:
+                take = min(needed, shard_doc.get('remaining'))
+                option = self.client.write_option(last_update_time=shard_doc.update_time)
+                batch.update(shard_doc.reference, {'remaining': shard_doc.get('remaining') - take}, option=option)
+                needed -= take
+                if not needed:
+                    break
+
+    def payment_batch(self, payments, capacity_shards=()):
+        """Write batch applying payments, with each booking update conditional on its version
+
+        capacity_shards are the snapshots of capacity_refs(payments), read
+        just before; reservations are conditional on them being unchanged.
+        """
+        batch = self.client.batch()
+        for payment in payments:
+            option = self.client.write_option(last_update_time=payment['version'])
+            batch.update(self._booking_ref(payment['email_doc_id']), payment['updates'], option=option)
+            batch.set(self.client.collection('payments').document(payment['booking_id']), payment['payment'])
+            batch.set(self.client.collection('email_outbox').document(payment['booking_id']), payment['outbox'])
+            if payment.get('idempotency'):
+                key_id, record = payment['idempotency']
+                batch.set(self.client.collection('idempotency_keys').document(key_id), record)
+        self._reserve(batch, payments, capacity_shards)
+        
+        # One shard per commit keeps the rollup to one extra write per day in the batch
+        from google.cloud.firestore_v1 import Increment
+        shard = random.randrange(STATS_SHARDS)
+        for day, totals in payment_rollup(payments).items():
+            batch.set(self.client.collection('daily_stats').document(f"{day}-{shard}"), {
+                'day': day,
+                'shard': shard,
+                **{field: Increment(value) for field, value in totals.items()}
+            }, merge=True)
+        return batch
+
+    def commit_payments(self, payments):
+        refs = self.capacity_refs(payments)
+        batch = self.payment_batch(payments, self.client.get_all(refs) if refs else ())
+        writes = len(batch)
+        try:
+            batch.commit()
+            return writes
+        except Exception as e:
+            if type(e).__name__ in ('FailedPrecondition', 'NotFound', 'AlreadyExists'):
+                raise StorageConflict(str(e)) from e
+            raise
+
+    def remaining_capacity(self, day):
+        shard_docs = [
+            shard_doc for shard_doc in self.client.get_all([self._capacity_ref(day, shard) for shard in range(CAPACITY_SHARDS)])
+            if shard_doc.exists
+        ]
+        if not shard_docs:
+            return DAILY_CAPACITY
+        return sum(shard_doc.get('remaining') or 0 for shard_doc in shard_docs)
+
+    def get_daily_stats(self, days):
+        refs = [
+            self.client.collection('daily_stats').document(f"{day}-{shard}")
+            for day in days for shard in range(STATS_SHARDS)
+        ]
+        stats = {}
+        for shard_doc in self.client.get_all(refs):
+            if shard_doc.exists:
+                shard = shard_doc.to_dict()
+                totals = stats.setdefault(shard['day'], dict.fromkeys(STATS_FIELDS, 0))
+                for field in STATS_FIELDS:
+                    totals[field] += shard.get(field, 0)
+        return stats
+
+    def put_outbox(self, outbox_id, record):
+        self.client.collection('email_outbox').document(outbox_id).set(record)
+
+    def get_outbox(self, outbox_id):
+        outbox_doc = self.client.collection('email_outbox').document(outbox_id).get()
+        return outbox_doc.to_dict() if outbox_doc.exists else None
+
+    def update_outbox(self, outbox_id, fields):
+        self.client.collection('email_outbox').document(outbox_id).update(fields)
+
+    def due_outbox_ids(self, now, limit):
+        # Served by a composite index on email_outbox (status ASC, next_attempt_at ASC)
+        docs = (self.client.collection('email_outbox')
+                .where('status', '==', 'pending')
+                .where('next_attempt_at', '<=', now)
+                .order_by('next_attempt_at')
+                .limit(limit)
+                .get())
+        return [doc.id for doc in docs]
+
+    def claim_outbox(self, outbox_id, now, lease_until, owner):
+        outbox_ref = self.client.collection('email_outbox').document(outbox_id)
+        outbox_doc = outbox_ref.get()
+        record = outbox_doc.to_dict() if outbox_doc.exists else None
+        if not outbox_claimable(record, now):
+            return None
+        try:
+            # Conditional on the read, so of two concurrent claims only the first commits
+            outbox_ref.update({'lease_until': lease_until, 'lease_owner': owner},
+                              option=self.client.write_option(last_update_time=outbox_doc.update_time))
+        except Exception as e:
+            if type(e).__name__ in ('FailedPrecondition', 'NotFound'):
+                return None
+            raise
+        return record
+
+    def get_idempotency(self, key_id):
+        # A TTL policy on expires_at lets Firestore delete old keys on its own
+        key_doc = self.client.collection('idempotency_keys').document(key_id).get()
+        return key_doc.to_dict() if key_doc.exists else None
+
+    def purge_idempotency(self, before):
+        # Left to the TTL policy on expires_at
+        return 0
+
+    def expired_bookings(self, before, limit, cursor=None):
+        # Served by a composite index on bookings (status ASC, validity ASC)
+        query = (self.client.collection('bookings')
+                 .where('status', '==', 'pending')
+                 .where('validity', '<', before)
+                 .order_by('validity')
+                 .order_by('__name__')
+                 .limit(limit))
+        if cursor:
+            query = query.start_after(list(cursor))
+        return [(doc.id, doc.get('validity'), doc.update_time) for doc in query.get()]
+
+    def expire_bookings(self, bookings):
+        batch = self.client.batch()
+        now = datetime.now()
+        for email_doc_id, version in bookings:
+            option = self.client.write_option(last_update_time=version)
+            batch.update(self._booking_ref(email_doc_id), {'status': 'expired', 'updated_at': now}, option=option)
+        try:
+            batch.commit()
+        except Exception as e:
+            if type(e).__name__ in ('FailedPrecondition', 'NotFound'):
+                raise StorageConflict(str(e)) from e
+            raise
+
+    def completed_bookings(self, limit, cursor=None):
+        # Equality on status ordered by document ID is served by the automatic single-field index
+        query = (self.client.collection('bookings')
+                 .where('status', '==', 'completed')
+                 .order_by('__name__')
+                 .limit(limit))
+        if cursor:
+            query = query.start_after([cursor])
+        return [(doc.id, doc.to_dict()) for doc in query.get()]
+
+class MemoryStorage(BookingStorage):
+    """Process-local storage for tests, benchmarks and load tests; versions are counters"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._bookings = {}
+        self._booking_ids = {}
+        self._payments = {}
+        self._outbox = {}
+        self._idempotency = {}
+        self._stats = {}
+        self._capacity = {}
+        self._versions = {}
+        self._clock = 0
+        self._lock = threading.RLock()
+
+    def _put(self, email_doc_id, data):
+        self._clock += 1
+        self._bookings[email_doc_id] = data
+        self._versions[email_doc_id] = self._clock
+        if data.get('booking_id'):
+            self._booking_ids[data['booking_id']] = email_doc_id
+
+    def get_booking(self, email_doc_id):
+        with self._lock:
+            if email_doc_id not in self._bookings:
+                return None
+            return copy.deepcopy(self._bookings[email_doc_id]), self._versions[email_doc_id]
+
+    def get_bookings(self, email_doc_ids):
+        with self._lock:
+            return {
+                email_doc_id: (copy.deepcopy(self._bookings[email_doc_id]), self._versions[email_doc_id])
+                for email_doc_id in email_doc_ids if email_doc_id in self._bookings
+            }
 
-        .info-card h3 span {
-            margin-right: 0.5rem;
-            font-size: 1.5rem;
-        }
+    def get_booking_by_booking_id(self, booking_id):
+        with self._lock:
+            email_doc_id = self._booking_ids.get(booking_id)
+            return copy.deepcopy(self._bookings[email_doc_id]) if email_doc_id in self._bookings else None
+
+    def put_bookings(self, bookings):
+        with self._lock:
+            for email_doc_id, data in bookings.items():
+                self._put(email_doc_id, copy.deepcopy(data))
+
+    def update_booking(self, email_doc_id, fields):
+        with self._lock:
+            if email_doc_id not in self._bookings:
+                raise StorageConflict(f"No booking to update: {email_doc_id}")
+            self._put(email_doc_id, {**self._bookings[email_doc_id], **copy.deepcopy(fields)})
+
+    def commit_payments(self, payments):
+        with self._lock:
+            for payment in payments:
+                if self._versions.get(payment['email_doc_id']) != payment['version']:
+                    raise StorageConflict(f"Booking changed since it was read: {payment['email_doc_id']}")
+            reservations = payment_reservations(payments)
+            for day, tickets in reservations.items():
+                if self._capacity.get(day, DAILY_CAPACITY) < tickets:
+                    raise SoldOut(day)
+            for day, tickets in reservations.items():
+                self._capacity[day] = self._capacity.get(day, DAILY_CAPACITY) - tickets
+            for payment in payments:
+                self._put(payment['email_doc_id'], {**self._bookings[payment['email_doc_id']], **copy.deepcopy(payment['updates'])})
+                self._payments[payment['booking_id']] = copy.deepcopy(payment['payment'])
+                self._outbox[payment['booking_id']] = copy.deepcopy(payment['outbox'])
+                if payment.get('idempotency'):
+                    key_id, record = payment['idempotency']
+                    self._idempotency[key_id] = copy.deepcopy(record)
+            for day, totals in payment_rollup(payments).items():
+                current = self._stats.setdefault(day, dict.fromkeys(STATS_FIELDS, 0))
+                for field, value in totals.items():
+                    current[field] += value
+            return payment_writes(payments)
+
+    def get_daily_stats(self, days):
+        with self._lock:
+            return {day: dict(self._stats[day]) for day in days if day in self._stats}
+
+    def remaining_capacity(self, day):
+        with self._lock:
+            return self._capacity.get(day, DAILY_CAPACITY)
+
+    def put_outbox(self, outbox_id, record):
+        with self._lock:
+            self._outbox[outbox_id] = copy.deepcopy(record)
+
+    def get_outbox(self, outbox_id):
+        with self._lock:
+            return copy.deepcopy(self._outbox.get(outbox_id))
+
+    def update_outbox(self, outbox_id, fields):
+        with self._lock:
+            self._outbox[outbox_id].update(copy.deepcopy(fields))
+
+    def due_outbox_ids(self, now, limit):
+        with self._lock:
+            return [outbox_id for outbox_id, record in self._outbox.items() if outbox_due(record, now)][:limit]
+
+    def claim_outbox(self, outbox_id, now, lease_until, owner):
+        with self._lock:
+            record = self._outbox.get(outbox_id)
+            if not outbox_claimable(record, now):
+                return None
+            record.update(lease_until=lease_until, lease_owner=owner)
+            return copy.deepcopy(record)
+
+    def get_idempotency(self, key_id):
+        with self._lock:
+            return copy.deepcopy(self._idempotency.get(key_id))
+
+    def purge_idempotency(self, before):
+        with self._lock:
+            expired = [key_id for key_id, record in self._idempotency.items() if record['expires_at'] <= before]
+            for key_id in expired:
+                del self._idempotency[key_id]
+        return len(expired)
+
+    def expired_bookings(self, before, limit, cursor=None):
+        # No index here: every page scans the whole collection
+        with self._lock:
+            rows = sorted(
+                (validity_key(data['validity']), email_doc_id, data['validity'], self._versions[email_doc_id])
+                for email_doc_id, data in self._bookings.items()
+                if data.get('status') == 'pending' and data.get('validity')
+                and validity_key(data['validity']) < validity_key(before)
+            )
+        if cursor:
+            start = (validity_key(cursor[0]), cursor[1])
+            rows = [row for row in rows if row[:2] > start]
+        return [(email_doc_id, validity, version) for _, email_doc_id, validity, version in rows[:limit]]
+
+    def expire_bookings(self, bookings):
+        with self._lock:
+            for email_doc_id, version in bookings:
+                if self._versions.get(email_doc_id) != version:
+                    raise StorageConflict(f"Booking changed since it was read: {email_doc_id}")
+            now = datetime.now()
+            for email_doc_id, version in bookings:
+                self._put(email_doc_id, {**self._bookings[email_doc_id], 'status': 'expired', 'updated_at': now})
+
+    def completed_bookings(self, limit, cursor=None):
+        with self._lock:
+            rows = sorted(
+                (email_doc_id, data) for email_doc_id, data in self._bookings.items()
+                if data.get('status') == 'completed' and (cursor is None or email_doc_id > cursor)
+            )[:limit]
+            return copy.deepcopy(rows)
+
+def validity_key(validity):
+    """Sortable text form of a validity time, in wall-clock time as on the booking page"""
+    return validity.replace(tzinfo=None).isoformat(timespec='microseconds')
+
+def _wall_clock(value):
+    """Naive wall-clock form of a stored time; Firestore returns them timezone-aware"""
+    return value.replace(tzinfo=None) if isinstance(value, datetime) else value
+
+def outbox_due(record, now):
+    """Whether a pending outbox record's next attempt is due; records from before scheduling always are"""
+    if not record or record.get('status') != 'pending':
+        return False
+    next_attempt_at = record.get('next_attempt_at')
+    return next_attempt_at is None or _wall_clock(next_attempt_at) <= now
+
+def outbox_claimable(record, now):
+    """Whether an outbox record is due and not leased to a worker that may still be sending it"""
+    lease_until = (record or {}).get('lease_until')
+    return outbox_due(record, now) and (lease_until is None or _wall_clock(lease_until) <= now)
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+def _json_object_hook(value):
+    if '__datetime__' in value and len(value) == 1:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+def _dumps(data):
+    return json.dumps(data, default=_json_default)
+
+def _loads(text):
+    return json.loads(text, object_hook=_json_object_hook)
+
+class SQLiteStorage(BookingStorage):
+    """Single-node storage on SQLite in WAL mode; versions are row counters
+
+    Documents are stored as JSON, with the columns that are looked up or
+    filtered on (email doc id, booking ID, status, validity, next outbox
+    attempt, idempotency key expiry) kept alongside and indexed.
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS bookings (
+            email_doc_id TEXT PRIMARY KEY,
+            booking_id TEXT,
+            status TEXT,
+            validity TEXT,
+            version INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_bookings_booking_id ON bookings (booking_id);
+        CREATE INDEX IF NOT EXISTS idx_bookings_status_id ON bookings (status, email_doc_id);
+        CREATE TABLE IF NOT EXISTS payments (
+            booking_id TEXT PRIMARY KEY,
+            email TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            outbox_id TEXT PRIMARY KEY,
+            status TEXT,
+            next_attempt_at TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_status ON email_outbox (status);
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key_id TEXT PRIMARY KEY,
+            expires_at TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS capacity (
+            day TEXT PRIMARY KEY,
+            remaining INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            tickets NUMERIC NOT NULL DEFAULT 0,
+            amount NUMERIC NOT NULL DEFAULT 0,
+            payments INTEGER NOT NULL DEFAULT 0
+        );
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        self._migrate(conn)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_bookings_status_validity ON bookings (status, validity, email_doc_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_email_outbox_status_next ON email_outbox (status, next_attempt_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)')
+
+    def _migrate(self, conn):
+        """Add the validity, next_attempt_at and expires_at columns to databases created before they existed"""
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(bookings)')}
+        if 'validity' not in columns:
+            with self._transaction() as conn:
+                conn.execute('ALTER TABLE bookings ADD COLUMN validity TEXT')
+                rows = conn.execute('SELECT email_doc_id, data FROM bookings').fetchall()
+                for email_doc_id, data in rows:
+                    validity = _loads(data).get('validity')
+                    if isinstance(validity, datetime):
+                        conn.execute('UPDATE bookings SET validity = ? WHERE email_doc_id = ?',
+                                     (validity_key(validity), email_doc_id))
+        
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(email_outbox)')}
+        if 'next_attempt_at' not in columns:
+            with self._transaction() as conn:
+                conn.execute('ALTER TABLE email_outbox ADD COLUMN next_attempt_at TEXT')
+                rows = conn.execute('SELECT outbox_id, data FROM email_outbox').fetchall()
+                for outbox_id, data in rows:
+                    conn.execute('UPDATE email_outbox SET next_attempt_at = ? WHERE outbox_id = ?',
+                                 (self._next_attempt_key(_loads(data)), outbox_id))
+        
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(idempotency_keys)')}
+        if 'expires_at' not in columns:
+            with self._transaction() as conn:
+                conn.execute('ALTER TABLE idempotency_keys ADD COLUMN expires_at TEXT')
+                rows = conn.execute('SELECT key_id, data FROM idempotency_keys').fetchall()
+                for key_id, data in rows:
+                    conn.execute('UPDATE idempotency_keys SET expires_at = ? WHERE key_id = ?',
+                                 (validity_key(_loads(data)['expires_at']), key_id))
+
+    @staticmethod
+    def _next_attempt_key(record):
+        """Sortable next_attempt_at of an outbox record; records from before scheduling sort first, as always due"""
+        next_attempt_at = record.get('next_attempt_at')
+        return validity_key(next_attempt_at) if isinstance(next_attempt_at, datetime) else ''
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _write_booking(self, conn, email_doc_id, data, version):
+        validity = data.get('validity')
+        conn.execute(
+            'INSERT OR REPLACE INTO bookings (email_doc_id, booking_id, status, validity, version, data) VALUES (?, ?, ?, ?, ?, ?)',
+            (email_doc_id, data.get('booking_id'), data.get('status'),
+             validity_key(validity) if isinstance(validity, datetime) else None, version, _dumps(data))
+        )
 
-        .info-card p {
-            color: rgba(255, 255, 255, 0.7);
-            line-height: 1.6;
+    def _merge_booking(self, conn, email_doc_id, fields, version=None):
+        row = conn.execute('SELECT data, version FROM bookings WHERE email_doc_id = ?', (email_doc_id,)).fetchone()
+        if row is None:
+            raise StorageConflict(f"No booking to update: {email_doc_id}")
+        if version is not None and row[1] != version:
+            raise StorageConflict(f"Booking changed since it was read: {email_doc_id}")
+        self._write_booking(conn, email_doc_id, {**_loads(row[0]), **fields}, row[1] + 1)
+
+    def get_booking(self, email_doc_id):
+        row = self._conn().execute('SELECT data, version FROM bookings WHERE email_doc_id = ?', (email_doc_id,)).fetchone()
+        return (_loads(row[0]), row[1]) if row else None
+
+    def get_bookings(self, email_doc_ids):
+        bookings = {}
+        email_doc_ids = list(email_doc_ids)
+        # Stay under SQLite's bound parameter limit
+        for start in range(0, len(email_doc_ids), 500):
+            chunk = email_doc_ids[start:start + 500]
+            rows = self._conn().execute(
+                f"SELECT email_doc_id, data, version FROM bookings WHERE email_doc_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for email_doc_id, data, version in rows:
+                bookings[email_doc_id] = (_loads(data), version)
+        return bookings
+
+    def get_booking_by_booking_id(self, booking_id):
+        row = self._conn().execute('SELECT data FROM bookings WHERE booking_id = ? LIMIT 1', (booking_id,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def put_bookings(self, bookings):
+        with self._transaction() as conn:
+            for email_doc_id, data in bookings.items():
+                self._write_booking(conn, email_doc_id, data, 1)
+
+    def update_booking(self, email_doc_id, fields):
+        with self._transaction() as conn:
+            self._merge_booking(conn, email_doc_id, fields)
+
+    def commit_payments(self, payments):
+        with self._transaction() as conn:
+            for payment in payments:
+                self._merge_booking(conn, payment['email_doc_id'], payment['updates'], version=payment['version'])
+                conn.execute(
+                    'INSERT OR REPLACE INTO payments (booking_id, email, data) VALUES (?, ?, ?)',
+                    (payment['booking_id'], payment['payment'].get('email'), _dumps(payment['payment']))
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO email_outbox (outbox_id, status, next_attempt_at, data) VALUES (?, ?, ?, ?)',
+                    (payment['booking_id'], payment['outbox'].get('status'),
+                     self._next_attempt_key(payment['outbox']), _dumps(payment['outbox']))
+                )
+                if payment.get('idempotency'):
+                    key_id, record = payment['idempotency']
+                    conn.execute(
+                        'INSERT OR REPLACE INTO idempotency_keys (key_id, expires_at, data) VALUES (?, ?, ?)',
+                        (key_id, validity_key(record['expires_at']), _dumps(record))
+                    )
+            # Writers are serialized by the database lock, so one row per day needs no sharding
+            for day, tickets in payment_reservations(payments).items():
+                conn.execute('INSERT OR IGNORE INTO capacity (day, remaining) VALUES (?, ?)', (day, DAILY_CAPACITY))
+                cursor = conn.execute(
+                    'UPDATE capacity SET remaining = remaining - ? WHERE day = ? AND remaining >= ?',
+                    (tickets, day, tickets)
+                )
+                if cursor.rowcount != 1:
+                    raise SoldOut(day)
+            for day, totals in payment_rollup(payments).items():
+                conn.execute(
+                    """INSERT INTO daily_stats (day, tickets, amount, payments) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (day) DO UPDATE SET tickets = tickets + excluded.tickets,
+                       amount = amount + excluded.amount, payments = payments + excluded.payments""",
+                    (day, totals['tickets'], totals['amount'], totals['payments'])
+                )
+        return payment_writes(payments)
+
+    def remaining_capacity(self, day):
+        row = self._conn().execute('SELECT remaining FROM capacity WHERE day = ?', (day,)).fetchone()
+        return row[0] if row else DAILY_CAPACITY
+
+    def get_daily_stats(self, days):
+        days = list(days)
+        rows = self._conn().execute(
+            f"SELECT day, tickets, amount, payments FROM daily_stats WHERE day IN ({','.join('?' * len(days))})",
+            days
+        )
+        return {
+            day: {'tickets': tickets, 'amount': amount, 'payments': payments}
+            for day, tickets, amount, payments in rows
         }
 
-        .success-animation { text-align: center; margin-bottom: 2rem; }
-
-        .checkmark {
-            width: 80px;
-            height: 80px;
-            border-radius: 50%;
-            display: block;
-            stroke-width: 2;
-            stroke: #2ecc71;
-            stroke-miterlimit: 10;
-            margin: 0 auto 1rem;
-            box-shadow: inset 0px 0px 0px #2ecc71;
-            animation: fill .4s ease-in-out .4s forwards, scale .3s ease-in-out .9s both;
-        }
+    def put_outbox(self, outbox_id, record):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO email_outbox (outbox_id, status, next_attempt_at, data) VALUES (?, ?, ?, ?)',
+                (outbox_id, record.get('status'), self._next_attempt_key(record), _dumps(record))
+            )
+
+    def get_outbox(self, outbox_id):
+        row = self._conn().execute('SELECT data FROM email_outbox WHERE outbox_id = ?', (outbox_id,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def update_outbox(self, outbox_id, fields):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT data FROM email_outbox WHERE outbox_id = ?', (outbox_id,)).fetchone()
+            if row is None:
+                raise StorageConflict(f"No outbox record to update: {outbox_id}")
+            record = {**_loads(row[0]), **fields}
+            conn.execute(
+                'UPDATE email_outbox SET status = ?, next_attempt_at = ?, data = ? WHERE outbox_id = ?',
+                (record.get('status'), self._next_attempt_key(record), _dumps(record), outbox_id)
+            )
+
+    def due_outbox_ids(self, now, limit):
+        # A range scan of idx_email_outbox_status_next
+        rows = self._conn().execute(
+            """SELECT outbox_id FROM email_outbox WHERE status = 'pending' AND next_attempt_at <= ?
+               ORDER BY next_attempt_at LIMIT ?""",
+            (validity_key(now), limit)
+        )
+        return [outbox_id for outbox_id, in rows]
+
+    def claim_outbox(self, outbox_id, now, lease_until, owner):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT data FROM email_outbox WHERE outbox_id = ?', (outbox_id,)).fetchone()
+            record = _loads(row[0]) if row else None
+            if not outbox_claimable(record, now):
+                return None
+            record.update(lease_until=lease_until, lease_owner=owner)
+            conn.execute('UPDATE email_outbox SET data = ? WHERE outbox_id = ?', (_dumps(record), outbox_id))
+        return record
+
+    def get_idempotency(self, key_id):
+        row = self._conn().execute('SELECT data FROM idempotency_keys WHERE key_id = ?', (key_id,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def purge_idempotency(self, before):
+        with self._transaction() as conn:
+            return conn.execute('DELETE FROM idempotency_keys WHERE expires_at <= ?', (validity_key(before),)).rowcount
+
+    def expired_bookings(self, before, limit, cursor=None):
+        # Only the indexed columns are read; the JSON document is left alone
+        sql = "SELECT email_doc_id, validity, version FROM bookings WHERE status = 'pending' AND validity < ?"
+        params = [validity_key(before)]
+        if cursor:
+            sql += ' AND (validity, email_doc_id) > (?, ?)'
+            params += [validity_key(cursor[0]), cursor[1]]
+        sql += ' ORDER BY validity, email_doc_id LIMIT ?'
+        rows = self._conn().execute(sql, params + [limit])
+        return [(email_doc_id, datetime.fromisoformat(validity), version) for email_doc_id, validity, version in rows]
+
+    def expire_bookings(self, bookings):
+        updated_at = _dumps(datetime.now())
+        with self._transaction() as conn:
+            for email_doc_id, version in bookings:
+                # Patch the document in place rather than decoding and re-encoding it
+                cursor = conn.execute(
+                    """UPDATE bookings SET status = 'expired', version = version + 1,
+                       data = json_set(data, '$.status', 'expired', '$.updated_at', json(?))
+                       WHERE email_doc_id = ? AND version = ?""",
+                    (updated_at, email_doc_id, version)
+                )
+                if cursor.rowcount != 1:
+                    raise StorageConflict(f"Booking changed since it was read: {email_doc_id}")
+
+    def completed_bookings(self, limit, cursor=None):
+        rows = self._conn().execute(
+            "SELECT email_doc_id, data FROM bookings WHERE status = 'completed' AND email_doc_id > ? "
+            "ORDER BY email_doc_id LIMIT ?",
+            (cursor or '', limit)
+        )
+        return [(email_doc_id, _loads(data)) for email_doc_id, data in rows]
+
+storage = None
+_storage_lock = threading.Lock()
+
+def create_storage(backend=STORAGE_BACKEND):
+    """Build the configured storage backend, or None if it is unavailable"""
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'sqlite':
+        return SQLiteStorage(SQLITE_PATH)
+    if backend == 'firestore':
+        client = get_db()
+        return FirestoreStorage(client) if client else None
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def get_storage():
+    """Configured storage backend, created on first use"""
+    global storage
+    if storage is None:
+        with _storage_lock:
+            if storage is None:
+                try:
+                    storage = create_storage()
+                except Exception as e:
+                    print(f"Storage initialization error: {e}")
+    return storage
 
-        .checkmark__circle {
-            stroke-dasharray: 166;
-            stroke-dashoffset: 166;
-            stroke-width: 2;
-            stroke-miterlimit: 10;
-            stroke: #2ecc71;
-            fill: none;
-            animation: stroke 0.6s cubic-bezier(0.65, 0, 0.45, 1) forwards;
-        }
+# SMTP Configuration from environment variables
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '587'))
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME', 'chsantosh2004@gmail.com')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', 'kzka uohw hbxg gwgi')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'true').lower() != 'false'
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', '30'))
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '2'))
+SMTP_POOL_IDLE_TIMEOUT = float(os.environ.get('SMTP_POOL_IDLE_TIMEOUT', '60'))
+SMTP_POOL_CHECK_AFTER = float(os.environ.get('SMTP_POOL_CHECK_AFTER', '5'))
+
+# Confirmation email outbox configuration
+EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS', '2'))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '5'))
+EMAIL_RETRY_BASE = float(os.environ.get('EMAIL_RETRY_BASE', '2'))
+EMAIL_RETRY_MAX = float(os.environ.get('EMAIL_RETRY_MAX', '300'))
+# A claimed record is leased to its worker for EMAIL_LEASE seconds; after that another may retry it
+EMAIL_LEASE = float(os.environ.get('EMAIL_LEASE', '120'))
+# /api/drain_outbox delivers at most EMAIL_DRAIN_BATCH due records within EMAIL_DRAIN_BUDGET seconds.
+# Long-running processes can also drain every EMAIL_DRAIN_INTERVAL seconds; 0 leaves it to the cron.
+EMAIL_DRAIN_BATCH = int(os.environ.get('EMAIL_DRAIN_BATCH', '100'))
+EMAIL_DRAIN_BUDGET = float(os.environ.get('EMAIL_DRAIN_BUDGET', '50'))
+EMAIL_DRAIN_INTERVAL = float(os.environ.get('EMAIL_DRAIN_INTERVAL', '0'))
+
+# Bulk payment configuration. Bookings are read PAYMENT_BATCH_SIZE at a time, and their payments
+# committed in groups that fit a Firestore batch (see payment_groups).
+PAYMENT_BATCH_SIZE = int(os.environ.get('PAYMENT_BATCH_SIZE', '150'))
+PAYMENT_BULK_MAX = int(os.environ.get('PAYMENT_BULK_MAX', '1000'))
+BOOKING_LOOKUP_MAX = int(os.environ.get('BOOKING_LOOKUP_MAX', '1000'))
+
+# Payments retry when a concurrent write (usually another payment reserving the same
+# capacity shard) invalidates what they read
+PAYMENT_RETRIES = int(os.environ.get('PAYMENT_RETRIES', '8'))
+PAYMENT_RETRY_BASE = float(os.environ.get('PAYMENT_RETRY_BASE', '0.005'))
+SOLD_OUT_MESSAGE = "Sorry, tickets for this day are sold out."
+
+# Expiry sweeper: marks pending bookings past their validity as expired, one Firestore batch per page
+EXPIRY_BATCH_SIZE = min(int(os.environ.get('EXPIRY_BATCH_SIZE', '500')), 500)
+EXPIRY_SWEEP_BUDGET = float(os.environ.get('EXPIRY_SWEEP_BUDGET', '50'))
+# Seconds between sweeps in a long-running process; 0 leaves sweeping to the /api/expire_bookings cron
+EXPIRY_SWEEP_INTERVAL = float(os.environ.get('EXPIRY_SWEEP_INTERVAL', '0'))
+# Bearer token the cron endpoints require; they are refused until it is set
+CRON_SECRET = os.environ.get('CRON_SECRET', '')
+
+# Bulk confirmation re-send (flask resend-tickets): completed bookings read per page, messages
+# per second (0 for no limit), processes encoding QR codes (0 encodes in-process) and the
+# checkpoint file an interrupted run resumes from
+RESEND_PAGE_SIZE = int(os.environ.get('RESEND_PAGE_SIZE', '200'))
+RESEND_RATE = float(os.environ.get('RESEND_RATE', '5'))
+RESEND_QR_WORKERS = int(os.environ.get('RESEND_QR_WORKERS', str(os.cpu_count() or 1)))
+RESEND_CHECKPOINT = os.environ.get('RESEND_CHECKPOINT', 'resend_checkpoint.json')
+
+# Reporting: /api/stats reads at most STATS_MAX_DAYS days of rollups, behind a bearer token; it is
+# disabled until STATS_TOKEN is set
+STATS_MAX_DAYS = int(os.environ.get('STATS_MAX_DAYS', '90'))
+STATS_TOKEN = os.environ.get('STATS_TOKEN', '')
+
+# Request profiling: off unless a sample rate or a token for the X-Profile-Token header is set
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sample')
+PROFILE_ENDPOINTS = set(os.environ.get('PROFILE_ENDPOINTS', 'process_payment_route,api_process_payment,booking_details').split(','))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'athena_profiles'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '50'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.001'))
 
-        .checkmark__check {
-            transform-origin: 50% 50%;
-            stroke-dasharray: 48;
-            stroke-dashoffset: 48;
-            animation: stroke 0.3s cubic-bezier(0.65, 0, 0.45, 1) 0.8s forwards;
-        }
+# Streamlit app URL
+STREAMLIT_APP_URL = "https://update-athena-chatbot.streamlit.app"
 
-        @keyframes stroke { 100% { stroke-dashoffset: 0; } }
-        @keyframes scale { 0%, 100% { transform: none; } 50% { transform: scale3d(1.1, 1.1, 1); } }
-        @keyframes fill { 100% { box-shadow: inset 0px 0px 0px 30px #2ecc71; } }
-
-        .loading {
-            display: inline-block;
-            width: 20px;
-            height: 20px;
-            border: 3px solid rgba(255, 255, 255, 0.3);
-            border-radius: 50%;
-            border-top-color: #fff;
-            animation: spin 1s ease-in-out infinite;
-            margin-right: 10px;
-        }
+# Public base URL of this portal, used for links and images in emails
+PORTAL_URL = os.environ.get('PORTAL_URL', '').rstrip('/')
+
+# QR code cache configuration
+QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE', '1024'))
+QR_CACHE_TTL = int(os.environ.get('QR_CACHE_TTL', '86400'))
+QR_MAX_AGE = int(os.environ.get('QR_MAX_AGE', '31536000'))
+QR_ETAG_VERSION = 'v2'
+
+# Signed ticket payloads, verified at the gates without a storage lookup
+# There is no default key: without one, tickets are issued unsigned and nothing is verified
+TICKET_SIGNING_KEY = os.environ.get('TICKET_SIGNING_KEY', '')
+if not TICKET_SIGNING_KEY:
+    print("WARNING: TICKET_SIGNING_KEY is not set - tickets are issued unsigned, "
+          "/api/verify is disabled and QR image links carry the booking hash")
+TICKET_PREFIX = 'ATHENA2'
+VERIFY_BATCH_MAX = int(os.environ.get('VERIFY_BATCH_MAX', '1000'))
+
+# Booking read-through cache configuration
+BOOKING_CACHE_SIZE = int(os.environ.get('BOOKING_CACHE_SIZE', '4096'))
+BOOKING_CACHE_TTL = int(os.environ.get('BOOKING_CACHE_TTL', '30'))
+
+# Idempotency keys for payment requests
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '4096'))
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache with per-entry TTL"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
 
-        @keyframes spin { to { transform: rotate(360deg); } }
-
-        @media (max-width: 768px) {
-            .container { padding: 1rem; }
-            .card { padding: 1.5rem; }
-            .header h1 { font-size: 2rem; }
-            .header p { font-size: 1rem; }
-            .museum-info { grid-template-columns: 1fr; }
-            .back-button {
-                padding: 10px 20px;
-                font-size: 14px;
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses
             }
-        }
-
-        .tilt-card {
-            transform-style: preserve-3d;
-            transform: perspective(1000px);
-        }
 
-        .tilt-content {
-            transform: translateZ(30px);
-            transition: all 0.3s ease;
-        }
-    </style>
+qr_cache = LRUCache(maxsize=QR_CACHE_SIZE, ttl=QR_CACHE_TTL)
+booking_cache = LRUCache(maxsize=BOOKING_CACHE_SIZE, ttl=BOOKING_CACHE_TTL)
+idempotency_cache = LRUCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+
+class Metrics:
+    """Process-local counters and histograms rendered in Prometheus text format"""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self, snapshot=None):
+        """Exposition text for every metric, plus point-in-time values {name: (type, value)}"""
+        def fmt(labels):
+            if not labels:
+                return ''
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in self._histograms.items()}
+
+        lines = []
+        seen = set()
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                text = self._help.get(name, (kind, name))[1]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            header(name, 'histogram')
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{fmt(labels + (('le', repr(bound)),))} {bucket_count}")
+            lines.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{fmt(labels)} {total}")
+            lines.append(f"{name}_count{fmt(labels)} {count}")
+        for name, (kind, value) in sorted((snapshot or {}).items()):
+            header(name, kind)
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into one execution
+
+    The first caller for a key runs the function; callers arriving while it is
+    in flight wait for it and receive the same result or exception.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        
+        if not leader:
+            metrics.inc('portal_singleflight_shared_total', flight=self.name)
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        
+        try:
+            call['result'] = fn(*args, **kwargs)
+            return call['result']
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+metrics = Metrics()
+metrics.describe('portal_request_duration_seconds', 'histogram', 'Request latency by route')
+metrics.describe('portal_stage_duration_seconds', 'histogram', 'Time spent in storage, QR encoding, SMTP and rendering')
+metrics.describe('portal_storage_reads_total', 'counter', 'Documents read from storage')
+metrics.describe('portal_storage_writes_total', 'counter', 'Documents written to storage')
+metrics.describe('portal_qr_encodes_total', 'counter', 'QR images encoded (cache misses)')
+metrics.describe('portal_emails_total', 'counter', 'Confirmation email delivery attempts by result')
+metrics.describe('portal_singleflight_shared_total', 'counter', 'Calls answered by an identical call already in flight')
+metrics.describe('portal_tickets_verified_total', 'counter', 'Ticket payloads verified at the gates by result')
+metrics.describe('portal_bookings_expired_total', 'counter', 'Pending bookings marked expired by the sweeper')
+
+# Concurrent lookups and payments for the same booking share one in-flight call
+booking_reads = SingleFlight('booking_read')
+booking_id_reads = SingleFlight('booking_id_read')
+payment_flights = SingleFlight('payment')
+flights = {flight.name: flight for flight in (booking_reads, booking_id_reads, payment_flights)}
+
+# Booking, payment and delivery logic is written once as generators of steps, shared with
+# the async app in asgi.py. A step is (operation, args): a storage method, 'sleep',
+# 'send_email', 'dispatch_email', or 'shared' to run nested steps coalesced in a flight.
+# The step's result, or the exception it raised, is sent back into the generator.
+def run_steps(steps, storage):
+    """Run a steps generator to completion against a blocking storage backend"""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = perform(step, storage), None
+        except Exception as e:
+            result, error = None, e
+
+def perform(step, storage):
+    operation, args = step
+    if operation == 'shared':
+        flight, key, steps = args
+        return flights[flight].do(key, run_steps, steps, storage)
+    if operation == 'sleep':
+        return time.sleep(*args)
+    if operation == 'send_email':
+        return send_confirmation_email(*args)
+    if operation == 'dispatch_email':
+        return email_outbox.dispatch(*args)
+    with timed('storage'):
+        return getattr(storage, operation)(*args)
+
+@contextmanager
+def timed(stage):
+    """Time a hot-path stage into the stage histogram and the request's Server-Timing header"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('portal_stage_duration_seconds', elapsed, stage=stage)
+        if has_request_context() and hasattr(g, 'server_timing'):
+            g.server_timing[stage] = g.server_timing.get(stage, 0.0) + elapsed
+
+# Base layout with 3D Effects and Back Button, shared by every page
+BASE_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Athena Museum - Payment Portal</title>
+    <link rel="stylesheet" href="{{ asset_url('portal.css') }}">
 </head>
 <body>
     <div class="bg-animation">
@@ -584,7 +1355,67 @@ HTML_TEMPLATE = '''
             <p>Complete Your Booking Payment</p>
         </div>
 
-        {% if page == 'home' %}
+        {% block content %}{% endblock %}
+
+        <div class="museum-info">
+            <div class="info-card">
+                <h3><span>🏛️</span> Location</h3>
+                <p>123 Science Avenue<br>Mumbai, Maharashtra 400001<br>India</p>
+            </div>
+            <div class="info-card">
+                <h3><span>🕒</span> Opening Hours</h3>
+                <p>Monday - Saturday: 9:00 AM - 5:00 PM<br>Sunday: 10:00 AM - 4:00 PM</p>
+            </div>
+            <div class="info-card">
+                <h3><span>📞</span> Contact</h3>
+                <p>Phone: +91 22 1234 5678<br>Email: info@athenamuseum.com</p>
+            </div>
+        </div>
+    </div>
+
+    <script src="{{ asset_url('portal.js') }}" defer></script>
+</body>
+</html>
+'''
+
+# Static assets are served under content-hashed names so they can be cached forever
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ASSET_MAX_AGE = 31536000
+
+def build_asset_manifest(static_dir=STATIC_DIR):
+    """Map each static asset to its content-hashed file name"""
+    manifest = {}
+    try:
+        for name in sorted(os.listdir(static_dir)):
+            path = os.path.join(static_dir, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+            root, ext = os.path.splitext(name)
+            manifest[name] = f"{root}.{digest}{ext}"
+    except OSError as e:
+        print(f"Static asset manifest error: {e}")
+    return manifest
+
+ASSET_MANIFEST = build_asset_manifest()
+ASSET_FILES = {hashed: name for name, hashed in ASSET_MANIFEST.items()}
+
+def asset_url(name):
+    """Fingerprinted URL of a static asset"""
+    return f"/static/{ASSET_MANIFEST.get(name, name)}"
+
+# Human readable confirmation email delivery states
+EMAIL_STATUS_LABELS = {
+    'pending': 'Sending...',
+    'sent': 'Sent',
+    'failed': 'Delivery failed'
+}
+
+# Page templates
+HOME_TEMPLATE = '''
+{% extends "base.html" %}
+{% block content %}
         <div class="card tilt-card" id="tiltCard">
             <div class="tilt-content">
                 <h2>Find Your Booking</h2>
@@ -600,8 +1431,12 @@ HTML_TEMPLATE = '''
                 </form>
             </div>
         </div>
+{% endblock %}
+'''
 
-        {% elif page == 'booking' %}
+BOOKING_TEMPLATE = '''
+{% extends "base.html" %}
+{% block content %}
         <div class="card tilt-card" id="tiltCard">
             <div class="tilt-content">
                 <h2>Booking Details</h2>
@@ -633,29 +1468,42 @@ HTML_TEMPLATE = '''
                             <span class="status-badge status-{{ booking.status }}">{{ booking.status.title() }}</span>
                         </span>
                     </div>
+                    {% if booking.status == 'completed' and booking.email_status %}
+                    <div class="detail-row">
+                        <span class="detail-label">✉️ Ticket Email:</span>
+                        <span class="detail-value">{{ EMAIL_STATUS_LABELS.get(booking.email_status, booking.email_status.title()) }}</span>
+                    </div>
+                    {% endif %}
                 </div>
 
                 {% if booking.status == 'pending' %}
                 <form method="POST" action="/process_payment" id="paymentForm">
                     <input type="hidden" name="email" value="{{ booking.email }}">
+                    <input type="hidden" name="idempotency_key" value="{{ idempotency_key }}">
                     <button type="submit" class="btn btn-accent" id="payBtn">
                         💳 Complete Payment Now
                     </button>
                 </form>
                 {% endif %}
 
-                {% if booking.status == 'completed' and booking.qr_code %}
+                {% if booking.status == 'completed' %}
                 <div class="qr-container">
+                    {% if booking.qr_url %}
                     <h3>📱 Your Entry QR Code</h3>
-                    <img src="data:image/png;base64,{{ booking.qr_code }}" alt="QR Code">
+                    <img src="{{ booking.qr_url }}" alt="QR Code">
                     <p style="margin-top: 15px; color: #666;">Present this QR code at the museum entrance</p>
+                    {% endif %}
                     <p style="margin-top: 10px; color: #999; font-size: 0.9rem;">Booking ID: {{ booking.booking_id }}</p>
                 </div>
                 {% endif %}
             </div>
         </div>
+{% endblock %}
+'''
 
-        {% elif page == 'success' %}
+SUCCESS_TEMPLATE = '''
+{% extends "base.html" %}
+{% block content %}
         <div class="card tilt-card" id="tiltCard">
             <div class="tilt-content">
                 <div class="success-animation">
@@ -667,7 +1515,7 @@ HTML_TEMPLATE = '''
                 </div>
                 
                 <div class="alert alert-success">
-                    Your booking has been confirmed! We've sent your e-ticket with QR code to your email.
+                    Your booking has been confirmed! Your e-ticket with QR code is on its way to your email.
                 </div>
                 
                 <a href="/booking/{{ email }}" class="btn">
@@ -675,15 +1523,19 @@ HTML_TEMPLATE = '''
                 </a>
             </div>
         </div>
+{% endblock %}
+'''
 
-        {% elif page == 'error' %}
+ERROR_TEMPLATE = '''
+{% extends "base.html" %}
+{% block content %}
         <div class="card tilt-card" id="tiltCard">
             <div class="tilt-content">
                 <div class="error-animation">
                     <div class="error-circle">
                         <span style="font-size: 2.5rem;">❌</span>
                     </div>
-                    <h2>Booking Not Found</h2>
+                    <h2>{{ error_title or 'Booking Not Found' }}</h2>
                 </div>
                 
                 <div class="alert alert-error">
@@ -695,298 +1547,1620 @@ HTML_TEMPLATE = '''
                 </a>
             </div>
         </div>
-        {% endif %}
+{% endblock %}
+'''
 
-        <div class="museum-info">
-            <div class="info-card">
-                <h3><span>🏛️</span> Location</h3>
-                <p>123 Science Avenue<br>Mumbai, Maharashtra 400001<br>India</p>
+# Confirmation email, sent as HTML with a plain-text alternative
+EMAIL_HTML_TEMPLATE = '''
+<html>
+<head>
+    <style>
+        body { font-family: 'Poppins', sans-serif; line-height: 1.6; color: #333; margin: 0; padding: 0; }
+        .container { max-width: 600px; margin: 0 auto; padding: 20px; }
+        .header { background: linear-gradient(135deg, #6c63ff, #764ba2); color: white; padding: 30px; text-align: center; border-radius: 15px 15px 0 0; }
+        .content { padding: 30px; background: white; border-radius: 0 0 15px 15px; box-shadow: 0 4px 15px rgba(0,0,0,0.1); }
+        .ticket { background: #f8f9fa; border: 2px dashed #6c63ff; padding: 20px; margin: 20px 0; border-radius: 15px; text-align: center; }
+        .qr-code { margin: 20px 0; }
+        .qr-code img { max-width: 200px; border-radius: 10px; padding: 10px; background: white; border: 1px solid #eee; }
+        .details { background: #f0f4ff; padding: 15px; border-radius: 10px; margin: 15px 0; }
+        .detail-row { display: flex; justify-content: space-between; padding: 8px 0; border-bottom: 1px solid #e0e0ff; }
+        .detail-row:last-child { border-bottom: none; }
+        .footer { background: #f8f9fa; padding: 20px; text-align: center; font-size: 14px; color: #666; border-radius: 15px; margin-top: 20px; }
+        .button { display: inline-block; background: linear-gradient(135deg, #6c63ff, #764ba2); color: white; padding: 12px 25px; text-decoration: none; border-radius: 25px; font-weight: bold; margin: 15px 0; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>🏛️ Athena Museum</h1>
+            <h2>Booking Confirmed!</h2>
+        </div>
+        <div class="content">
+            <p>Dear Visitor,</p>
+            <p>Your payment has been processed successfully! Here are your booking details:</p>
+
+            <div class="ticket">
+                <h3>Your E-Ticket</h3>
+                {% if qr_cid %}
+                <div class="qr-code">
+                    <img src="cid:{{ qr_cid }}" alt="QR Code">
+                </div>
+                {% endif %}
+                <p><strong>Booking ID:</strong> {{ booking_id }}</p>
+                <p><strong>Security Hash:</strong> {{ hash }}</p>
             </div>
-            <div class="info-card">
-                <h3><span>🕒</span> Opening Hours</h3>
-                <p>Monday - Saturday: 9:00 AM - 5:00 PM<br>Sunday: 10:00 AM - 4:00 PM</p>
+
+            <div class="details">
+                <div class="detail-row">
+                    <span>Email:</span>
+                    <span>{{ email }}</span>
+                </div>
+                <div class="detail-row">
+                    <span>Phone:</span>
+                    <span>{{ phone }}</span>
+                </div>
+                <div class="detail-row">
+                    <span>Tickets:</span>
+                    <span>{{ tickets }}</span>
+                </div>
+                <div class="detail-row">
+                    <span>Amount Paid:</span>
+                    <span>₹{{ amount }}</span>
+                </div>
+                <div class="detail-row">
+                    <span>Valid Until:</span>
+                    <span>{{ validity_str }}</span>
+                </div>
             </div>
-            <div class="info-card">
-                <h3><span>📞</span> Contact</h3>
-                <p>Phone: +91 22 1234 5678<br>Email: info@athenamuseum.com</p>
+
+            <p>Present the QR code above at the museum entrance for entry.</p>
+            {% if ticket_url %}
+            <p>You can also open your ticket online: <a href="{{ ticket_url }}">{{ ticket_url }}</a></p>
+            {% endif %}
+            <p>We look forward to your visit!</p>
+
+            <div style="text-align: center; margin-top: 20px;">
+                <a href="{{ streamlit_url }}" class="button">Return to Chatbot</a>
             </div>
         </div>
+        <div class="footer">
+            <p><strong>Athena Museum of Science and Technology</strong></p>
+            <p>123 Science Avenue, Mumbai, Maharashtra 400001, India</p>
+            <p>📞 +91 22 1234 5678 | 📧 info@athenamuseum.com</p>
+        </div>
     </div>
-
-    <script>
-        document.addEventListener('DOMContentLoaded', function() {
-            const tiltCard = document.getElementById('tiltCard');
-            
-            if (tiltCard) {
-                tiltCard.addEventListener('mousemove', function(e) {
-                    const rect = this.getBoundingClientRect();
-                    const x = e.clientX - rect.left;
-                    const y = e.clientY - rect.top;
-                    
-                    const centerX = rect.width / 2;
-                    const centerY = rect.height / 2;
-                    
-                    const angleX = (y - centerY) / 20;
-                    const angleY = (centerX - x) / 20;
-                    
-                    this.style.transform = `perspective(1000px) rotateX(${angleX}deg) rotateY(${angleY}deg)`;
-                });
-                
-                tiltCard.addEventListener('mouseleave', function() {
-                    this.style.transform = 'perspective(1000px) rotateX(0) rotateY(0)';
-                });
-            }
-            
-            const emailForm = document.getElementById('emailForm');
-            const paymentForm = document.getElementById('paymentForm');
-            const submitBtn = document.getElementById('submitBtn');
-            const payBtn = document.getElementById('payBtn');
-            
-            if (emailForm && submitBtn) {
-                emailForm.addEventListener('submit', function() {
-                    submitBtn.innerHTML = '<span class="loading"></span> Searching...';
-                    submitBtn.disabled = true;
-                });
-            }
-            
-            if (paymentForm && payBtn) {
-                paymentForm.addEventListener('submit', function() {
-                    payBtn.innerHTML = '<span class="loading"></span> Processing Payment...';
-                    payBtn.disabled = true;
-                });
-            }
-        });
-    </script>
 </body>
 </html>
 '''
 
+EMAIL_TEXT_TEMPLATE = '''Athena Museum - Booking Confirmed
+
+Dear Visitor,
+
+Your payment has been processed successfully! Here are your booking details:
+
+Booking ID:     {{ booking_id }}
+Security Hash:  {{ hash }}
+Email:          {{ email }}
+Phone:          {{ phone }}
+Tickets:        {{ tickets }}
+Amount Paid:    ₹{{ amount }}
+Valid Until:    {{ validity_str }}
+
+Present the QR code attached to this email at the museum entrance for entry.
+{% if ticket_url %}
+You can also open your ticket online: {{ ticket_url }}
+{% endif %}
+We look forward to your visit!
+
+Return to Chatbot: {{ streamlit_url }}
+
+--
+Athena Museum of Science and Technology
+123 Science Avenue, Mumbai, Maharashtra 400001, India
++91 22 1234 5678 | info@athenamuseum.com
+'''
+
+TEMPLATES = {
+    'base.html': BASE_TEMPLATE,
+    'home.html': HOME_TEMPLATE,
+    'booking.html': BOOKING_TEMPLATE,
+    'success.html': SUCCESS_TEMPLATE,
+    'error.html': ERROR_TEMPLATE,
+    'email.html': EMAIL_HTML_TEMPLATE,
+    'email.txt': EMAIL_TEXT_TEMPLATE,
+}
+
+# Compile every page once at startup instead of on each request
+app.jinja_loader = DictLoader(TEMPLATES)
+app.jinja_env.globals['asset_url'] = asset_url
+app.jinja_env.globals['EMAIL_STATUS_LABELS'] = EMAIL_STATUS_LABELS
+PAGE_TEMPLATES = {
+    page: app.jinja_env.get_template(f"{page}.html")
+    for page in ('home', 'booking', 'success', 'error')
+}
+
+def render_page(page, **context):
+    """Render a precompiled page template"""
+    context.setdefault('streamlit_url', STREAMLIT_APP_URL)
+    with timed('render'):
+        return PAGE_TEMPLATES[page].render(**context)
+
 # Helper Functions
+def email_doc_id_for(email):
+    """Firestore document ID of the booking for an email address"""
+    return email.replace('.', '_').replace('@', '_at_')
+
 def get_booking_by_email(email):
-    """Get booking from Firebase by email"""
-    if not db:
+    """Get booking from storage by email"""
+    storage = get_storage()
+    if not storage:
         return None
     
     try:
-        email_doc_id = email.replace('.', '_').replace('@', '_at_')
-        booking_doc = db.collection('bookings').document(email_doc_id).get()
+        return run_steps(booking_steps(email), storage)
+    except Exception as e:
+        print(f"Error fetching booking: {e}")
+        return None
+
+def booking_steps(email):
+    """Steps of get_booking_by_email: the cached booking, or one read shared by concurrent callers"""
+    email_doc_id = email_doc_id_for(email)
+    booking_data = booking_cache.get(email_doc_id)
+    
+    if booking_data is None:
+        stored = yield ('shared', ('booking_read', email_doc_id, read_booking_steps(email_doc_id)))
         
-        if not booking_doc.exists:
+        if not stored:
             return None
         
-        booking_data = booking_doc.to_dict()
-        
-        # Calculate validity status
-        validity_date = booking_data.get('validity')
-        current_time = datetime.now()
-        
-        if validity_date:
-            if hasattr(validity_date, 'replace'):
-                validity_datetime = validity_date.replace(tzinfo=None)
-            else:
-                validity_datetime = validity_date
-            
-            is_valid = validity_datetime > current_time
-            validity_str = validity_datetime.strftime('%d %b %Y, %H:%M')
-            
-            if is_valid:
-                time_remaining = validity_datetime - current_time
-                hours_remaining = int(time_remaining.total_seconds() // 3600)
-                minutes_remaining = int((time_remaining.total_seconds() % 3600) // 60)
-                validity_str += f" ({hours_remaining}h {minutes_remaining}m remaining)"
-            else:
-                validity_str += " (EXPIRED)"
+        booking_data = stored[0]
+    
+    # Validity is derived from the current time, so it is computed on every read
+    return annotate_booking(dict(booking_data))
+
+def read_booking_steps(email_doc_id):
+    """Read one booking from storage and cache it"""
+    stored = yield ('get_booking', (email_doc_id,))
+    metrics.inc('portal_storage_reads_total')
+    if stored:
+        booking_cache.set(email_doc_id, stored[0])
+    return stored
+
+def get_bookings_by_email(emails):
+    """Get many bookings by email with a single multi-document read
+
+    Cached bookings are served from the booking cache; the rest are fetched
+    together in one storage call. Returns {email: booking or None}.
+    """
+    storage = get_storage()
+    bookings = {}
+    missing = {}
+    
+    for email in emails:
+        email_doc_id = email_doc_id_for(email)
+        booking_data = booking_cache.get(email_doc_id)
+        if booking_data is not None:
+            bookings[email] = annotate_booking(dict(booking_data))
         else:
-            is_valid = False
-            validity_str = "Not set"
-        
-        booking_data['validity_str'] = validity_str
-        booking_data['is_valid'] = is_valid
-        
-        # Generate QR code if completed
-        if booking_data.get('status') == 'completed' and booking_data.get('booking_id') and booking_data.get('hash'):
-            qr_code = generate_qr_code(booking_data['booking_id'], booking_data['hash'])
-            booking_data['qr_code'] = qr_code
+            missing.setdefault(email_doc_id, []).append(email)
+    
+    if missing and storage:
+        with timed('storage'):
+            stored = storage.get_bookings(list(missing))
+        metrics.inc('portal_storage_reads_total', len(missing))
+        for email_doc_id, (booking_data, version) in stored.items():
+            booking_cache.set(email_doc_id, booking_data)
+            for email in missing[email_doc_id]:
+                bookings[email] = annotate_booking(dict(booking_data))
+    
+    return {email: bookings.get(email) for email in emails}
+
+def booking_summary(email, booking_data):
+    """Compact JSON view of a booking for status sweeps"""
+    if not booking_data:
+        return {'email': email, 'found': False}
+    
+    validity = booking_data.get('validity')
+    return {
+        'email': email,
+        'found': True,
+        'status': booking_data.get('status'),
+        'booking_id': booking_data.get('booking_id'),
+        'validity': validity.isoformat() if hasattr(validity, 'isoformat') else validity,
+        'validity_str': booking_data['validity_str'],
+        'is_valid': booking_data['is_valid'],
+        'email_status': booking_data.get('email_status')
+    }
+
+def annotate_booking(booking_data):
+    """Add validity status and QR link to raw booking data"""
+    # Calculate validity status
+    validity_date = booking_data.get('validity')
+    current_time = datetime.now()
+    
+    if validity_date:
+        if hasattr(validity_date, 'replace'):
+            validity_datetime = validity_date.replace(tzinfo=None)
+        else:
+            validity_datetime = validity_date
         
-        return booking_data
+        is_valid = validity_datetime > current_time
+        validity_str = validity_datetime.strftime('%d %b %Y, %H:%M')
         
-    except Exception as e:
-        print(f"Error fetching booking: {e}")
-        return None
+        if is_valid:
+            time_remaining = validity_datetime - current_time
+            hours_remaining = int(time_remaining.total_seconds() // 3600)
+            minutes_remaining = int((time_remaining.total_seconds() % 3600) // 60)
+            validity_str += f" ({hours_remaining}h {minutes_remaining}m remaining)"
+        else:
+            validity_str += " (EXPIRED)"
+    else:
+        is_valid = False
+        validity_str = "Not set"
+    
+    booking_data['validity_str'] = validity_str
+    booking_data['is_valid'] = is_valid
+    
+    # Link the QR image endpoint if completed
+    if booking_data.get('status') == 'completed' and booking_data.get('booking_id') and booking_data.get('hash'):
+        booking_data['qr_url'] = qr_code_url(booking_data['booking_id'], booking_data['hash'])
+    
+    return booking_data
 
-def generate_qr_code(booking_id, hash_code):
-    """Generate QR code for booking"""
+def get_booking_by_booking_id(booking_id):
+    """Get completed booking from storage by booking ID"""
+    storage = get_storage()
+    if not storage:
+        return None
+    
     try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr_data = f"ATHENA-MUSEUM-{booking_id}-{hash_code}"
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffered = io.BytesIO()
-        img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        
-        return img_str
+        return booking_id_reads.do(booking_id, run_steps, read_booking_by_booking_id_steps(booking_id), storage)
     except Exception as e:
-        print(f"QR code generation failed: {e}")
+        print(f"Error fetching booking by ID: {e}")
         return None
 
+def read_booking_by_booking_id_steps(booking_id):
+    """Read one booking from storage by booking ID"""
+    booking_data = yield ('get_booking_by_booking_id', (booking_id,))
+    metrics.inc('portal_storage_reads_total')
+    return booking_data
+
+def qr_code_url(booking_id, booking_hash, absolute=False):
+    """URL of the cacheable QR image for a booking, carrying its access token"""
+    token = qr_signature(booking_id) if TICKET_SIGNING_KEY else booking_hash
+    path = f"/qr/{booking_id}.png?sig={token}"
+    return f"{PORTAL_URL}{path}" if absolute else path
+
+def qr_signature(booking_id):
+    """Unguessable token for a booking's QR image, so tickets can't be fetched by enumerating IDs"""
+    return ticket_signature(f"qr:{booking_id}")
+
+def qr_signature_valid(booking_id, signature, booking=None):
+    """Whether a QR URL's token is valid
+
+    With a signing key it is checked without a lookup; without one it must
+    match the hash of the booking, once read.
+    """
+    if not signature:
+        return False
+    expected = qr_signature(booking_id) if TICKET_SIGNING_KEY else (booking or {}).get('hash')
+    return bool(expected) and hmac.compare_digest(str(signature).encode(), expected.encode())
+
+def qr_code_etag(booking_id):
+    """Strong ETag for a booking's QR image; the payload never changes for a booking ID"""
+    return f"qr-{QR_ETAG_VERSION}-{booking_id}"
+
+def ticket_signature(body):
+    """Truncated HMAC-SHA256 of a ticket payload body, URL-safe base64"""
+    if not TICKET_SIGNING_KEY:
+        raise RuntimeError("TICKET_SIGNING_KEY is not configured")
+    digest = hmac.new(TICKET_SIGNING_KEY.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).decode().rstrip('=')
+
+def sign_ticket(booking_id, validity, tickets):
+    """Signed QR payload ATHENA2.<booking_id>.<valid until, epoch seconds>.<tickets>.<signature>"""
+    # Validity is wall-clock time, as on the booking page
+    valid_until = int(validity.replace(tzinfo=None).timestamp())
+    body = f"{TICKET_PREFIX}.{booking_id}.{valid_until}.{int(tickets)}"
+    return f"{body}.{ticket_signature(body)}"
+
+def ticket_payload(booking_data):
+    """QR payload for a completed booking"""
+    if TICKET_SIGNING_KEY and booking_data.get('validity') and booking_data.get('tickets'):
+        return sign_ticket(booking_data['booking_id'], booking_data['validity'], booking_data['tickets'])
+    # Bookings without validity or ticket count, or with no signing key, keep the unsigned payload
+    return f"ATHENA-MUSEUM-{booking_data['booking_id']}-{booking_data['hash']}"
+
+def verify_ticket(payload, now=None):
+    """Verify a scanned ticket payload in memory, without touching storage
+
+    Returns a dict with valid, reason (None, 'malformed', 'unsigned',
+    'bad_signature', 'expired' or 'unconfigured'), and the booking_id, tickets and
+    valid_until carried by the payload when it could be parsed.
+    """
+    result = {'valid': False, 'reason': 'malformed', 'booking_id': None, 'tickets': None, 'valid_until': None}
+    if not TICKET_SIGNING_KEY:
+        result['reason'] = 'unconfigured'
+        return result
+    if not isinstance(payload, str):
+        return result
+    if payload.startswith('ATHENA-MUSEUM-'):
+        result['reason'] = 'unsigned'
+        return result
+    
+    parts = payload.strip().split('.')
+    if len(parts) != 5 or parts[0] != TICKET_PREFIX:
+        return result
+    try:
+        valid_until, tickets = int(parts[2]), int(parts[3])
+        # Out-of-range timestamps raise OverflowError/OSError rather than failing the whole batch
+        valid_until_iso = datetime.fromtimestamp(valid_until).isoformat()
+    except (ValueError, OverflowError, OSError):
+        return result
+    
+    result.update(booking_id=parts[1], tickets=tickets, valid_until=valid_until_iso)
+    if not hmac.compare_digest(parts[4], ticket_signature('.'.join(parts[:4]))):
+        result['reason'] = 'bad_signature'
+    elif valid_until <= (now if now is not None else time.time()):
+        result['reason'] = 'expired'
+    else:
+        result['valid'], result['reason'] = True, None
+    return result
+
+def verify_tickets(payloads):
+    """Verify a batch of scanned payloads against one clock reading"""
+    now = time.time()
+    return [verify_ticket(payload, now) for payload in payloads]
+
+def generate_qr_png(payload):
+    """Generate QR code PNG bytes for a ticket payload, served from cache when possible"""
+    png = qr_cache.get(payload)
+    if png is not None:
+        return png
+    
+    with timed('qr'):
+        png = encode_qr_png(payload)
+    metrics.inc('portal_qr_encodes_total')
+    
+    qr_cache.set(payload, png)
+    return png
+
+def encode_qr_png(payload):
+    """Encode a ticket QR payload as PNG bytes"""
+    # qrcode loads Pillow, so both are imported only once a QR is actually rendered
+    import qrcode
+    
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffered = io.BytesIO()
+    img.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+class BaseSMTPConnectionPool:
+    """Settings, idle sessions and counters of an SMTP session pool; subclasses do the I/O"""
+
+    def __init__(self, host, port, username, password, starttls=True,
+                 max_size=2, idle_timeout=60.0, check_after=5.0, timeout=30.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.sends = 0
+        self.failures = 0
+        self.send_time_total = 0.0
+        self.send_time_max = 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "idle": len(self._idle),
+                "hits": self.hits,
+                "connects": self.connects,
+                "reconnects": self.reconnects,
+                "sends": self.sends,
+                "failures": self.failures,
+                "send_latency_avg_ms": round(self.send_time_total / self.sends * 1000, 2) if self.sends else 0.0,
+                "send_latency_max_ms": round(self.send_time_max * 1000, 2)
+            }
+
+class SMTPConnectionPool(BaseSMTPConnectionPool):
+    """Pool of authenticated SMTP sessions reused across messages
+
+    Idle sessions are closed after idle_timeout seconds and probed with NOOP
+    before reuse once they have been idle for check_after seconds. A session
+    dropped by the server is transparently replaced and the send retried once.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = threading.BoundedSemaphore(self.max_size)
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                server.starttls()
+            server.ehlo_or_helo_if_needed()
+            if server.has_extn('auth'):
+                server.login(self.username, self.password)
+        except Exception:
+            self._close(server)
+            raise
+        with self._lock:
+            self.connects += 1
+        return server
+
+    def _close(self, server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _is_alive(self, server):
+        try:
+            return server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self):
+        """Check out a healthy session, connecting if none is idle"""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    server, last_used = self._idle.pop()
+                idle_for = time.monotonic() - last_used
+                if idle_for > self.idle_timeout:
+                    self._close(server)
+                    continue
+                if idle_for > self.check_after and not self._is_alive(server):
+                    self._close(server)
+                    continue
+                with self._lock:
+                    self.hits += 1
+                return server
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, server, broken=False):
+        """Return a session to the pool, closing it if it is no longer usable"""
+        try:
+            if broken:
+                self._close(server)
+            else:
+                with self._lock:
+                    self._idle.append((server, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def send(self, msg):
+        """Send a message over a pooled session"""
+        started = time.perf_counter()
+        server = self.acquire()
+        broken = False
+        try:
+            try:
+                server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self._close(server)
+                server = None
+                with self._lock:
+                    self.reconnects += 1
+                server = self._connect()
+                server.send_message(msg)
+        except smtplib.SMTPResponseException:
+            # The server rejected the message but the session is still usable
+            with self._lock:
+                self.failures += 1
+            raise
+        except Exception:
+            broken = True
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            if server is None:
+                self._slots.release()
+            else:
+                self.release(server, broken=broken)
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.sends += 1
+                self.send_time_total += elapsed
+                self.send_time_max = max(self.send_time_max, elapsed)
+
+    def close(self):
+        """Close every idle session"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._close(server)
+
+smtp_pool = SMTPConnectionPool(
+    SMTP_SERVER, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD,
+    starttls=SMTP_STARTTLS,
+    max_size=SMTP_POOL_SIZE,
+    idle_timeout=SMTP_POOL_IDLE_TIMEOUT,
+    check_after=SMTP_POOL_CHECK_AFTER,
+    timeout=SMTP_TIMEOUT
+)
+
+# Compiled once; the .html template is autoescaped, the .txt one is not
+EMAIL_TEMPLATES = {
+    subtype: app.jinja_env.get_template(f"email.{extension}")
+    for subtype, extension in (('plain', 'txt'), ('html', 'html'))
+}
+
+# Quoted-printable keeps the mostly-ASCII bodies near their raw size, where base64 adds a third
+EMAIL_CHARSET = Charset('utf-8')
+EMAIL_CHARSET.body_encoding = QP
+
+# RFC 2047 encoding of the non-ASCII subject is a large share of building a message, and it never changes
+EMAIL_SUBJECT = Header("🎫 Athena Museum - Booking Confirmed", 'utf-8').encode()
+
+def build_confirmation_email(booking_data, qr_png=None):
+    """Confirmation email message with the QR code attached inline
+
+    multipart/related holding the plain-text and HTML alternatives, plus the
+    QR PNG once as an image the HTML references by Content-ID. The PNG is
+    generated unless one is passed in.
+    """
+    booking_id = booking_data['booking_id']
+    if qr_png is None:
+        try:
+            qr_png = generate_qr_png(ticket_payload(booking_data))
+        except Exception as e:
+            print(f"Failed to generate QR code for email: {e}")
+    
+    # Older bookings may lack the optional fields; the templates show them blank
+    context = {field: booking_data.get(field) for field in ('phone', 'tickets', 'amount', 'validity_str')}
+    context.update(
+        email=booking_data['email'],
+        hash=booking_data['hash'],
+        booking_id=booking_id,
+        qr_cid=f"qr-{booking_id}@athenamuseum.com" if qr_png else None,
+        ticket_url=qr_code_url(booking_id, booking_data['hash'], absolute=True) if PORTAL_URL else None,
+        streamlit_url=STREAMLIT_APP_URL
+    )
+    
+    # "=_" never occurs in quoted-printable or base64 output, so these boundaries are safe
+    # as given and the generator skips drawing and checking a random one for every part
+    body = MIMEMultipart('alternative', boundary=f"=_alt_{booking_id}")
+    with timed('render'):
+        for subtype, template in EMAIL_TEMPLATES.items():
+            body.attach(MIMEText(template.render(**context), subtype, EMAIL_CHARSET))
+    
+    msg = MIMEMultipart('related', boundary=f"=_rel_{booking_id}")
+    msg['From'] = SMTP_USERNAME
+    msg['To'] = booking_data['email']
+    msg['Subject'] = EMAIL_SUBJECT
+    msg.attach(body)
+    
+    if qr_png:
+        image = MIMEImage(qr_png, 'png')
+        image['Content-ID'] = f"<{context['qr_cid']}>"
+        image.add_header('Content-Disposition', 'inline', filename=f"{booking_id}.png")
+        msg.attach(image)
+    
+    # MIME-Version belongs on the top-level message only
+    for part in msg.walk():
+        if part is not msg:
+            del part['MIME-Version']
+    return msg
+
 def send_confirmation_email(booking_data):
     """Send confirmation email with QR code"""
     try:
         if not SMTP_USERNAME or not SMTP_PASSWORD:
             print("SMTP credentials not configured")
             return False
-            
-        msg = MIMEMultipart()
-        msg['From'] = SMTP_USERNAME
-        msg['To'] = booking_data['email']
-        msg['Subject'] = "🎫 Athena Museum - Booking Confirmed"
-        
-        # Generate QR code for email
-        qr_code = generate_qr_code(booking_data['booking_id'], booking_data['hash'])
-        
-        if not qr_code:
-            print("Failed to generate QR code for email")
-            qr_code = ""
         
-        body = f"""
-        <html>
-        <head>
-            <style>
-                body {{ font-family: 'Poppins', sans-serif; line-height: 1.6; color: #333; margin: 0; padding: 0; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: linear-gradient(135deg, #6c63ff, #764ba2); color: white; padding: 30px; text-align: center; border-radius: 15px 15px 0 0; }}
-                .content {{ padding: 30px; background: white; border-radius: 0 0 15px 15px; box-shadow: 0 4px 15px rgba(0,0,0,0.1); }}
-                .ticket {{ background: #f8f9fa; border: 2px dashed #6c63ff; padding: 20px; margin: 20px 0; border-radius: 15px; text-align: center; }}
-                .qr-code {{ margin: 20px 0; }}
-                .qr-code img {{ max-width: 200px; border-radius: 10px; padding: 10px; background: white; border: 1px solid #eee; }}
-                .details {{ background: #f0f4ff; padding: 15px; border-radius: 10px; margin: 15px 0; }}
-                .detail-row {{ display: flex; justify-content: space-between; padding: 8px 0; border-bottom: 1px solid #e0e0ff; }}
-                .detail-row:last-child {{ border-bottom: none; }}
-                .footer {{ background: #f8f9fa; padding: 20px; text-align: center; font-size: 14px; color: #666; border-radius: 15px; margin-top: 20px; }}
-                .button {{ display: inline-block; background: linear-gradient(135deg, #6c63ff, #764ba2); color: white; padding: 12px 25px; text-decoration: none; border-radius: 25px; font-weight: bold; margin: 15px 0; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>🏛️ Athena Museum</h1>
-                    <h2>Booking Confirmed!</h2>
-                </div>
-                <div class="content">
-                    <p>Dear Visitor,</p>
-                    <p>Your payment has been processed successfully! Here are your booking details:</p>
-                    
-                    <div class="ticket">
-                        <h3>Your E-Ticket</h3>
-                        <div class="qr-code">
-                            <img src="data:image/png;base64,{qr_code}" alt="QR Code">
-                        </div>
-                        <p><strong>Booking ID:</strong> {booking_data['booking_id']}</p>
-                        <p><strong>Security Hash:</strong> {booking_data['hash']}</p>
-                    </div>
-                    
-                    <div class="details">
-                        <div class="detail-row">
-                            <span>Email:</span>
-                            <span>{booking_data['email']}</span>
-                        </div>
-                        <div class="detail-row">
-                            <span>Phone:</span>
-                            <span>{booking_data['phone']}</span>
-                        </div>
-                        <div class="detail-row">
-                            <span>Tickets:</span>
-                            <span>{booking_data['tickets']}</span>
-                        </div>
-                        <div class="detail-row">
-                            <span>Amount Paid:</span>
-                            <span>₹{booking_data['amount']}</span>
-                        </div>
-                        <div class="detail-row">
-                            <span>Valid Until:</span>
-                            <span>{booking_data['validity_str']}</span>
-                        </div>
-                    </div>
-                    
-                    <p>Present the QR code above at the museum entrance for entry.</p>
-                    <p>We look forward to your visit!</p>
-                    
-                    <div style="text-align: center; margin-top: 20px;">
-                        <a href="{STREAMLIT_APP_URL}" class="button">Return to Chatbot</a>
-                    </div>
-                </div>
-                <div class="footer">
-                    <p><strong>Athena Museum of Science and Technology</strong></p>
-                    <p>123 Science Avenue, Mumbai, Maharashtra 400001, India</p>
-                    <p>📞 +91 22 1234 5678 | 📧 info@athenamuseum.com</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        msg = build_confirmation_email(booking_data)
         
-        msg.attach(MIMEText(body, 'html'))
-        
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USERNAME, SMTP_PASSWORD)
-        server.send_message(msg)
-        server.quit()
+        with timed('smtp'):
+            smtp_pool.send(msg)
+        metrics.inc('portal_emails_total', result='sent')
         
         return True
     except Exception as e:
         print(f"Failed to send email: {e}")
+        metrics.inc('portal_emails_total', result='failed')
         return False
 
-def process_payment(email):
-    """Process payment and update booking"""
-    if not db:
-        return False, "Database connection failed"
-    
-    try:
-        # Generate booking ID and hash
-        booking_id = f"ATH{datetime.now().strftime('%Y%m%d')}{str(int(datetime.now().timestamp()))[-6:]}"
-        hash_code = hashlib.md5(f"{booking_id}{email}".encode()).hexdigest()[:8].upper()
+# Fields of a booking needed to render its confirmation email
+EMAIL_PAYLOAD_FIELDS = ('email', 'phone', 'tickets', 'amount', 'validity', 'validity_str', 'booking_id', 'hash')
+
+class EmailOutbox:
+    """Durable outbox for confirmation emails
+
+    Each pending email is stored in the email_outbox collection in the same
+    commit as its payment. Workers in the paying process try it straight
+    away, but a worker must first claim the record, a conditional write that
+    leases it for lease seconds, so two processes never send it at the same
+    time. A failed attempt is rescheduled with exponential backoff through
+    next_attempt_at. drain() delivers whatever is due, from the
+    /api/drain_outbox cron or a drainer thread, which also picks up sends
+    interrupted by a frozen or recycled serverless instance once their lease
+    runs out. The delivery state is mirrored onto the booking as email_status.
+    """
+
+    def __init__(self, workers=2, max_attempts=5, retry_base=2.0, retry_max=300.0, lease=120.0, drain_interval=0):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease = lease
+        self.drain_interval = drain_interval
+        self.owner = secrets.token_hex(8)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._drainer = None
+        self._inflight = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker pool"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"email-outbox-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def start_drainer(self):
+        """Drain due records every drain_interval seconds from a background thread, if set"""
+        with self._lock:
+            if self._drainer or not self.drain_interval:
+                return
+            self._drainer = threading.Thread(target=self._drain_forever, name='email-outbox-drainer', daemon=True)
+            self._drainer.start()
+
+    def record(self, booking_data):
+        """Outbox document for a pending confirmation email"""
+        now = datetime.now()
+        return {
+            'payload': {field: booking_data.get(field) for field in EMAIL_PAYLOAD_FIELDS},
+            'email_doc_id': email_doc_id_for(booking_data['email']),
+            'status': 'pending',
+            'attempts': 0,
+            'last_error': None,
+            'next_attempt_at': now,
+            'lease_until': None,
+            'created_at': now,
+            'updated_at': now
+        }
+
+    def dispatch(self, outbox_id):
+        """Hand a committed outbox record to the workers"""
+        self.start()
+        self._queue.put(outbox_id)
+
+    def drain(self, limit=EMAIL_DRAIN_BATCH, budget=None):
+        """Deliver due outbox records in this thread, stopping after budget seconds"""
+        storage = get_storage()
+        if not storage:
+            return {'success': False, 'error': 'Database connection failed'}
         
-        # Update booking in Firebase
-        email_doc_id = email.replace('.', '_').replace('@', '_at_')
-        booking_ref = db.collection('bookings').document(email_doc_id)
+        started = time.monotonic()
+        with timed('storage'):
+            outbox_ids = storage.due_outbox_ids(datetime.now(), limit)
+        metrics.inc('portal_storage_reads_total', len(outbox_ids))
         
-        booking_ref.update({
-            'status': 'completed',
-            'booking_id': booking_id,
-            'hash': hash_code,
-            'updated_at': datetime.now()
-        })
+        attempted = sent = 0
+        for outbox_id in outbox_ids:
+            if budget is not None and time.monotonic() - started >= budget:
+                break
+            result = self.deliver(outbox_id)
+            if result is not None:
+                attempted += 1
+                sent += result
+        return {
+            'success': True,
+            'due': len(outbox_ids),
+            'attempted': attempted,
+            'sent': sent,
+            'elapsed_ms': round((time.monotonic() - started) * 1000, 2)
+        }
+
+    def join(self, timeout=None):
+        """Wait until every queued email has been attempted (retries excluded)"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def pending(self):
+        """Number of emails waiting for a worker"""
+        return self._queue.qsize()
+
+    def backoff(self, attempts):
+        """Delay before the next attempt after the given number of failures"""
+        return min(self.retry_base * (2 ** (attempts - 1)), self.retry_max)
+
+    def attempt_result(self, record, sent):
+        """Outbox fields after a delivery attempt: sent, rescheduled with backoff, or failed for good"""
+        now = datetime.now()
+        attempts = record.get('attempts', 0) + 1
+        if sent:
+            status, last_error = 'sent', None
+        elif attempts >= self.max_attempts:
+            status, last_error = 'failed', f"Delivery failed after {attempts} attempts"
+        else:
+            status, last_error = 'pending', f"Delivery attempt {attempts} failed"
+        return {
+            'status': status,
+            'attempts': attempts,
+            'last_error': last_error,
+            'next_attempt_at': now + timedelta(seconds=self.backoff(attempts)),
+            'lease_until': None,
+            'updated_at': now
+        }
+
+    def _work(self):
+        while True:
+            outbox_id = self._queue.get()
+            with self._lock:
+                claimed = outbox_id not in self._inflight
+                self._inflight.add(outbox_id)
+            try:
+                if claimed:
+                    self.deliver(outbox_id)
+            except Exception as e:
+                print(f"Email outbox worker error: {e}")
+            finally:
+                if claimed:
+                    with self._lock:
+                        self._inflight.discard(outbox_id)
+                self._queue.task_done()
+
+    def _drain_forever(self):
+        while True:
+            try:
+                result = self.drain()
+                if result.get('attempted'):
+                    print(f"Drained {result['attempted']} outbox emails, {result['sent']} sent")
+            except Exception as e:
+                print(f"Email outbox drain error: {e}")
+            time.sleep(self.drain_interval)
+
+    def deliver(self, outbox_id):
+        """Attempt delivery of one outbox record
+
+        Returns whether it was sent, or None if it wasn't attempted because
+        it is not due or another worker holds it.
+        """
+        return run_steps(self.delivery_steps(outbox_id), get_storage())
+
+    def delivery_steps(self, outbox_id):
+        """Steps of deliver: lease the record to this process, send it, and record the attempt"""
+        now = datetime.now()
+        record = yield ('claim_outbox', (outbox_id, now, now + timedelta(seconds=self.lease), self.owner))
+        metrics.inc('portal_storage_reads_total')
+        if record is None:
+            return None
+        metrics.inc('portal_storage_writes_total')
+        
+        sent = yield ('send_email', (record['payload'],))
+        update = self.attempt_result(record, sent)
         
-        # Create payment record
-        db.collection('payments').document(booking_id).set({
+        yield ('update_outbox', (outbox_id, update))
+        metrics.inc('portal_storage_writes_total')
+        try:
+            yield ('update_booking', (record['email_doc_id'], {'email_status': update['status']}))
+            metrics.inc('portal_storage_writes_total')
+            booking_cache.invalidate(record['email_doc_id'])
+        except Exception as e:
+            print(f"Failed to update email status: {e}")
+        return sent
+
+email_outbox = EmailOutbox(
+    workers=EMAIL_WORKERS,
+    max_attempts=EMAIL_MAX_ATTEMPTS,
+    retry_base=EMAIL_RETRY_BASE,
+    retry_max=EMAIL_RETRY_MAX,
+    lease=EMAIL_LEASE,
+    drain_interval=EMAIL_DRAIN_INTERVAL
+)
+
+def warm_up():
+    """Initialize storage and preload the QR stack ahead of the first real request"""
+    started = time.perf_counter()
+    connected = get_storage() is not None
+    # Loads the Pillow image factory generate_qr_png would import on its first call
+    importlib.import_module('qrcode.image.pil')
+    return {
+        "storage": STORAGE_BACKEND,
+        "storage_connected": connected,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
+# Crockford base32: no I, L, O or U, and sorts in the same order as the numbers it encodes
+CROCKFORD_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+class BookingIdGenerator:
+    """Snowflake-style booking IDs, unique across instances without a central counter
+
+    Each ID is the prefix followed by 21 Crockford base32 characters packing a
+    48-bit Unix time in milliseconds, a 40-bit instance id drawn at random for
+    each process, and a 16-bit sequence within the millisecond. IDs from one
+    process strictly increase, even if the clock steps back; IDs sort by time.
+    """
+
+    TIME_BITS = 48
+    INSTANCE_BITS = 40
+    SEQUENCE_BITS = 16
+    LENGTH = 21
+
+    def __init__(self, prefix='ATH', instance_id=None):
+        self.prefix = prefix
+        self.reset(instance_id)
+
+    def reset(self, instance_id=None):
+        """Start over with a new instance id, e.g. in a forked child"""
+        self.instance_id = instance_id if instance_id is not None else secrets.randbits(self.INSTANCE_BITS)
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now_ms = time.time_ns() // 1000000
+            if now_ms > self._last_ms:
+                self._last_ms, self._sequence = now_ms, 0
+            else:
+                # Same millisecond, or the clock stepped back: keep counting from the last timestamp
+                self._sequence += 1
+                if self._sequence >> self.SEQUENCE_BITS:
+                    self._last_ms, self._sequence = self._last_ms + 1, 0
+            value = (self._last_ms << (self.INSTANCE_BITS + self.SEQUENCE_BITS)) \
+                | (self.instance_id << self.SEQUENCE_BITS) | self._sequence
+        
+        chars = []
+        for _ in range(self.LENGTH):
+            value, digit = divmod(value, 32)
+            chars.append(CROCKFORD_ALPHABET[digit])
+        return self.prefix + ''.join(reversed(chars))
+
+    def parse(self, booking_id):
+        """(datetime, instance_id, sequence) encoded in a booking ID from this generator"""
+        value = 0
+        for char in booking_id[len(self.prefix):]:
+            value = value * 32 + CROCKFORD_ALPHABET.index(char)
+        sequence = value & ((1 << self.SEQUENCE_BITS) - 1)
+        instance_id = (value >> self.SEQUENCE_BITS) & ((1 << self.INSTANCE_BITS) - 1)
+        timestamp_ms = value >> (self.INSTANCE_BITS + self.SEQUENCE_BITS)
+        return datetime.fromtimestamp(timestamp_ms / 1000), instance_id, sequence
+
+booking_ids = BookingIdGenerator()
+
+# A forked worker would otherwise share its parent's instance id and sequence
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=booking_ids.reset)
+
+def generate_booking_id():
+    """Generate a booking ID, unique across processes and instances"""
+    return booking_ids.next_id()
+
+def visit_day(booking_data):
+    """Day a booking admits its visitors on, as 'YYYY-MM-DD'"""
+    validity = booking_data.get('validity')
+    day = validity.replace(tzinfo=None) if isinstance(validity, datetime) else datetime.now()
+    return day.strftime('%Y-%m-%d')
+
+class PaymentResult(tuple):
+    """(success, message) of a payment, flagged sold_out when its day had no capacity left,
+    with the booking ID once paid"""
+
+    def __new__(cls, success, message, sold_out=False, booking_id=None):
+        result = super().__new__(cls, (success, message))
+        result.sold_out = sold_out
+        result.booking_id = booking_id
+        return result
+
+def settled_payment(booking_data, now=None):
+    """(success, message) for a booking that must not be paid again, or None if it can be paid"""
+    status = booking_data.get('status')
+    if status == 'completed':
+        # Paid already, by an earlier request or a concurrent one on another instance
+        return True, "Payment processed successfully"
+    # Past its validity but not yet swept is as expired as a swept booking
+    validity = _wall_clock(booking_data.get('validity'))
+    if status == 'expired' or (isinstance(validity, datetime) and validity < (now or datetime.now())):
+        return False, "Booking has expired"
+    return None
+
+def prepare_payment(email, booking_data, version):
+    """Build the writes completing one booking's payment, for storage.commit_payments
+
+    booking_data is the booking as read at version; the returned payment also
+    carries the updated booking under 'booking' for building the confirmation.
+    """
+    # Generate booking ID and hash
+    booking_id = generate_booking_id()
+    hash_code = hashlib.md5(f"{booking_id}{email}".encode()).hexdigest()[:8].upper()
+    now = datetime.now()
+    
+    updates = {
+        'status': 'completed',
+        'booking_id': booking_id,
+        'hash': hash_code,
+        'email_status': 'pending',
+        'updated_at': now
+    }
+    
+    # Confirmation payload comes from the booking already in memory
+    booking_data = dict(booking_data)
+    booking_data.update(updates)
+    annotate_booking(booking_data)
+    
+    return {
+        'email_doc_id': email_doc_id_for(email),
+        'version': version,
+        'updates': updates,
+        'reservation': (visit_day(booking_data), int(_stat_value(booking_data.get('tickets'))) or 1) if DAILY_CAPACITY else None,
+        'booking_id': booking_id,
+        'payment': {
             'booking_id': booking_id,
             'email': email,
             'status': 'completed',
-            'created_at': datetime.now()
-        })
-        
-        # Get updated booking data
-        booking_data = get_booking_by_email(email)
+            'tickets': booking_data.get('tickets'),
+            'amount': booking_data.get('amount'),
+            'created_at': now
+        },
+        'outbox': email_outbox.record(booking_data),
+        'booking': booking_data
+    }
+
+def idempotency_key_id(key):
+    """Storage ID for a client-supplied idempotency key"""
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def idempotency_record_steps(key_id):
+    """Unexpired result stored for an idempotency key, from cache or storage"""
+    record = idempotency_cache.get(key_id)
+    if record is None:
+        record = yield ('get_idempotency', (key_id,))
+        metrics.inc('portal_storage_reads_total')
+        if record is None:
+            return None
+        idempotency_cache.set(key_id, record)
+    if record['expires_at'] <= datetime.now():
+        idempotency_cache.invalidate(key_id)
+        return None
+    return record
+
+def idempotency_entry(idempotency_key, payment):
+    """(key_id, record) storing a payment's result under its idempotency key"""
+    now = datetime.now()
+    return idempotency_key_id(idempotency_key), {
+        'email_doc_id': payment['email_doc_id'],
+        'booking_id': payment['booking_id'],
+        'success': True,
+        'message': "Payment processed successfully",
+        'created_at': now,
+        'expires_at': now + timedelta(seconds=IDEMPOTENCY_TTL)
+    }
+
+def replay_result(record, email_doc_id):
+    """PaymentResult for a request repeating an idempotency key"""
+    if record['email_doc_id'] != email_doc_id:
+        return PaymentResult(False, "Idempotency key was already used for a different booking")
+    return PaymentResult(record['success'], record['message'], booking_id=record.get('booking_id'))
+
+def payment_error_title(result):
+    """Heading of the error page for a failed payment"""
+    return "Sold Out" if result.sold_out else "Payment Failed"
+
+def request_idempotency_key(data=None):
+    """Idempotency key from the Idempotency-Key header or an idempotency_key field"""
+    key = request.headers.get('Idempotency-Key') or (data if data is not None else request.form).get('idempotency_key')
+    key = str(key or '').strip()
+    return key or None
+
+def bearer_token_error(token, name):
+    """Error response unless the request carries token as its bearer token
+
+    An endpoint whose token name is not configured is refused outright.
+    """
+    if not token:
+        return jsonify({'success': False, 'error': f'{name} is not configured'}), 503
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    return None
+
+def process_payment(email, idempotency_key=None):
+    """Process payment and update booking
+
+    Concurrent calls for the same booking (a double-submitted form, the chatbot
+    and the visitor at once) share a single payment and its result. A retry
+    carrying the idempotency key of a completed payment gets the original
+    result back without touching storage or SMTP again. Returns a PaymentResult.
+    """
+    storage = get_storage()
+    if not storage:
+        return PaymentResult(False, "Database connection failed")
+    return run_steps(payment_steps(email, idempotency_key), storage)
+
+def payment_steps(email, idempotency_key=None):
+    """Steps of process_payment: replay a known idempotency key, or pay in the booking's flight"""
+    email_doc_id = email_doc_id_for(email)
+    if idempotency_key:
+        record = yield from idempotency_record_steps(idempotency_key_id(idempotency_key))
+        if record:
+            return replay_result(record, email_doc_id)
+    return (yield ('shared', ('payment', email_doc_id, pay_booking_steps(email, idempotency_key))))
+
+def pay_booking_steps(email, idempotency_key=None):
+    """Complete one booking's payment, retrying on conflicting writes"""
+    try:
+        email_doc_id = email_doc_id_for(email)
+        for attempt in range(PAYMENT_RETRIES):
+            stored = yield ('get_booking', (email_doc_id,))
+            metrics.inc('portal_storage_reads_total')
+            
+            if not stored:
+                return PaymentResult(False, "Booking not found")
+            
+            settled = settled_payment(stored[0])
+            if settled:
+                return PaymentResult(*settled, booking_id=stored[0].get('booking_id') if settled[0] else None)
+            
+            # Booking update, payment record, outbox entry and capacity reservation commit
+            # atomically, and only if the booking hasn't changed since it was read
+            payment = prepare_payment(email, *stored)
+            if idempotency_key:
+                # Stored in the same commit, so a key is never recorded without its payment
+                payment['idempotency'] = idempotency_entry(idempotency_key, payment)
+            try:
+                writes = yield ('commit_payments', ([payment],))
+                break
+            except StorageConflict:
+                if attempt == PAYMENT_RETRIES - 1:
+                    raise
+                yield ('sleep', (random.uniform(0, PAYMENT_RETRY_BASE * 2 ** attempt),))
+        metrics.inc('portal_storage_writes_total', writes)
+        booking_cache.invalidate(email_doc_id)
+        if idempotency_key:
+            idempotency_cache.set(*payment['idempotency'])
         
-        # Send confirmation email
-        if booking_data:
-            send_confirmation_email(booking_data)
+        # Queue confirmation email for background delivery
+        yield ('dispatch_email', (payment['booking_id'],))
         
-        return True, "Payment processed successfully"
+        return PaymentResult(True, "Payment processed successfully", booking_id=payment['booking_id'])
         
+    except SoldOut:
+        return PaymentResult(False, SOLD_OUT_MESSAGE, sold_out=True)
     except Exception as e:
         print(f"Payment processing error: {e}")
-        return False, f"Payment failed: {str(e)}"
+        return PaymentResult(False, f"Payment failed: {str(e)}")
+
+def process_payments(emails):
+    """Process payments for many bookings in chunked batched writes
+
+    Returns one result dict per distinct email, in request order. A chunk that
+    can't be read, or a group whose commit fails, is retried one payment at a
+    time so a single bad booking doesn't fail its neighbours. A group that
+    sells out a day retries only that day's payments one at a time, and
+    commits the rest together again.
+    """
+    emails = list(dict.fromkeys(emails))
+    storage = get_storage()
+    if not storage:
+        return [{'email': email, 'success': False, 'message': "Database connection failed"} for email in emails]
+    
+    results = {}
+    
+    def pay_individually(email):
+        result = process_payment(email)
+        results[email] = {'email': email, 'success': result[0], 'message': result[1]}
+        if result.booking_id:
+            results[email]['booking_id'] = result.booking_id
+    
+    for start in range(0, len(emails), PAYMENT_BATCH_SIZE):
+        chunk = emails[start:start + PAYMENT_BATCH_SIZE]
+        payments = []
+        
+        try:
+            with timed('storage'):
+                stored = storage.get_bookings([email_doc_id_for(email) for email in chunk])
+            metrics.inc('portal_storage_reads_total', len(chunk))
+            
+            for email in chunk:
+                booking = stored.get(email_doc_id_for(email))
+                if not booking:
+                    results[email] = {'email': email, 'success': False, 'message': "Booking not found"}
+                    continue
+                settled = settled_payment(booking[0])
+                if settled:
+                    results[email] = {'email': email, 'success': settled[0], 'message': settled[1]}
+                    if settled[0]:
+                        results[email]['booking_id'] = booking[0].get('booking_id')
+                    continue
+                payments.append((email, prepare_payment(email, *booking)))
+        except Exception as e:
+            print(f"Batch payment error, retrying individually: {e}")
+            for email in chunk:
+                if email not in results:
+                    pay_individually(email)
+            continue
+        
+        for group in payment_groups(payments):
+            while group:
+                try:
+                    with timed('storage'):
+                        writes = storage.commit_payments([payment for email, payment in group])
+                    metrics.inc('portal_storage_writes_total', writes)
+                    break
+                except SoldOut as e:
+                    # Nothing was written; whichever of the day's payments still fit go through singly
+                    kept, sold_out = [], []
+                    for entry in group:
+                        reservation = entry[1]['reservation']
+                        (sold_out if reservation and reservation[0] == e.day else kept).append(entry)
+                    group = kept
+                    for email, payment in sold_out:
+                        pay_individually(email)
+                except Exception as e:
+                    print(f"Batch payment error, retrying individually: {e}")
+                    for email, payment in group:
+                        pay_individually(email)
+                    group = []
+            
+            for email, payment in group:
+                booking_cache.invalidate(payment['email_doc_id'])
+                email_outbox.dispatch(payment['booking_id'])
+                results[email] = {
+                    'email': email,
+                    'success': True,
+                    'message': "Payment processed successfully",
+                    'booking_id': payment['booking_id']
+                }
+    
+    return [results[email] for email in emails]
+
+def sweep_expired_bookings(now=None, batch_size=EXPIRY_BATCH_SIZE, cursor=None, budget=None):
+    """Mark pending bookings whose validity has passed as expired
+
+    Pages through pending bookings in validity order with an indexed range
+    query, writing each page as one batch. Stops once no expired bookings are
+    left, or after budget seconds with a cursor to resume from. A page that
+    conflicts with a concurrent change (usually a payment) is retried one
+    booking at a time, skipping the bookings that changed. A finished sweep
+    also deletes expired idempotency keys.
+    """
+    storage = get_storage()
+    if not storage:
+        return {'success': False, 'error': 'Database connection failed'}
+    
+    before = now or datetime.now()
+    started = time.monotonic()
+    expired = skipped = pages = 0
+    done = False
+    
+    while not done:
+        with timed('storage'):
+            page = storage.expired_bookings(before, batch_size, cursor)
+        metrics.inc('portal_storage_reads_total', len(page))
+        if not page:
+            done = True
+            break
+        pages += 1
+        
+        try:
+            with timed('storage'):
+                storage.expire_bookings([(email_doc_id, version) for email_doc_id, validity, version in page])
+            count = len(page)
+        except StorageConflict:
+            count = 0
+            for email_doc_id, validity, version in page:
+                try:
+                    storage.expire_bookings([(email_doc_id, version)])
+                    count += 1
+                except StorageConflict:
+                    skipped += 1
+        metrics.inc('portal_storage_writes_total', count)
+        metrics.inc('portal_bookings_expired_total', count)
+        expired += count
+        for email_doc_id, validity, version in page:
+            booking_cache.invalidate(email_doc_id)
+        
+        last_id, last_validity, _ = page[-1]
+        cursor = (last_validity, last_id)
+        done = len(page) < batch_size
+        if not done and budget is not None and time.monotonic() - started >= budget:
+            break
+    
+    purged = 0
+    if done:
+        with timed('storage'):
+            purged = storage.purge_idempotency(before)
+        metrics.inc('portal_storage_writes_total', purged)
+    
+    return {
+        'success': True,
+        'done': done,
+        'expired': expired,
+        'skipped': skipped,
+        'pages': pages,
+        'idempotency_purged': purged,
+        'cursor': None if done else {'validity': cursor[0].isoformat(), 'email_doc_id': cursor[1]},
+        'elapsed_ms': round((time.monotonic() - started) * 1000, 2)
+    }
+
+class ExpirySweeper:
+    """Background thread running the expiry sweep every interval seconds"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread or not self.interval:
+                return
+            self._thread = threading.Thread(target=self._run, name='expiry-sweeper', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                result = sweep_expired_bookings()
+                if result.get('expired'):
+                    print(f"Expired {result['expired']} bookings in {result['elapsed_ms']}ms")
+            except Exception as e:
+                print(f"Expiry sweep error: {e}")
+            time.sleep(self.interval)
+
+expiry_sweeper = ExpirySweeper(EXPIRY_SWEEP_INTERVAL)
+
+class RateLimiter:
+    """Spaces acquire() calls at least 1/rate seconds apart across threads; a rate of 0 disables it"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def load_resend_checkpoint(path):
+    """Saved re-send progress, or None if there is none"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_resend_checkpoint(path, checkpoint):
+    """Write re-send progress atomically, so an interruption never leaves it half written"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+def resend_confirmations(checkpoint_path=RESEND_CHECKPOINT, rate=RESEND_RATE, page_size=RESEND_PAGE_SIZE,
+                         qr_workers=RESEND_QR_WORKERS, email_status=None, include_past=False,
+                         limit=None, dry_run=False, restart=False, progress=None):
+    """Re-send confirmation emails for completed bookings
+
+    Streams completed bookings a page at a time in email_doc_id order. A
+    page's QR codes are encoded in a pool of qr_workers processes while its
+    messages go out through the SMTP pool, at most rate per second. After
+    each page the cursor and counters are saved to checkpoint_path, and a
+    later run resumes from there. A page cut short by an interruption is
+    sent again in full, so a visitor may get a duplicate but never misses one.
+
+    Bookings whose validity has passed are skipped unless include_past, as
+    are bookings whose email_status differs from email_status when it is
+    given. At most limit messages are sent per run. progress, if given, is
+    called with the checkpoint after every page.
+    """
+    storage = get_storage()
+    if not storage:
+        return {'success': False, 'error': 'Database connection failed'}
+    
+    options = {'email_status': email_status, 'include_past': include_past}
+    checkpoint = None if restart or not checkpoint_path else load_resend_checkpoint(checkpoint_path)
+    if checkpoint is None:
+        checkpoint = {'options': options, 'cursor': None, 'done': False, 'sent': 0, 'skipped': 0,
+                      'failed': 0, 'failed_ids': [], 'started_at': datetime.now().isoformat()}
+    elif checkpoint['options'] != options:
+        return {'success': False, 'error': f"Checkpoint {checkpoint_path} was written with {checkpoint['options']}; restart to change options"}
+    
+    limiter = RateLimiter(0 if dry_run else rate)
+    started = time.monotonic()
+    sent = 0
+    
+    def send(email_doc_id, msg):
+        limiter.acquire()
+        try:
+            if not dry_run:
+                with timed('smtp'):
+                    smtp_pool.send(msg)
+            return None
+        except Exception as e:
+            return str(e)
+    
+    def fail(email_doc_id, error):
+        print(f"Failed to re-send confirmation for {email_doc_id}: {error}")
+        metrics.inc('portal_emails_total', result='failed')
+        checkpoint['failed'] += 1
+        checkpoint['failed_ids'].append(email_doc_id)
+    
+    # Imported here so serving requests never loads multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    qr_pool = ProcessPoolExecutor(max_workers=qr_workers) if qr_workers > 0 else None
+    # One sender per pooled SMTP session
+    senders = ThreadPoolExecutor(max_workers=max(1, smtp_pool.max_size), thread_name_prefix='resend')
+    
+    try:
+        while not checkpoint['done'] and (limit is None or sent < limit):
+            with timed('storage'):
+                page = storage.completed_bookings(page_size, checkpoint['cursor'])
+            metrics.inc('portal_storage_reads_total', len(page))
+            
+            batch = []
+            examined = 0
+            for email_doc_id, booking_data in page:
+                if limit is not None and sent + len(batch) >= limit:
+                    break
+                examined += 1
+                annotate_booking(booking_data)
+                if ((not include_past and not booking_data['is_valid'])
+                        or (email_status and booking_data.get('email_status') != email_status)
+                        or not booking_data.get('hash')):
+                    checkpoint['skipped'] += 1
+                    continue
+                batch.append((email_doc_id, booking_data))
+            
+            # A malformed booking is recorded as failed rather than aborting every resumed run
+            payloads = []
+            for email_doc_id, booking_data in batch:
+                try:
+                    payloads.append((email_doc_id, booking_data, ticket_payload(booking_data)))
+                except Exception as e:
+                    fail(email_doc_id, e)
+            
+            # Encoding runs ahead in the process pool while earlier messages are built and sent
+            tickets = [payload for _, _, payload in payloads]
+            if qr_pool:
+                pngs = qr_pool.map(encode_qr_png, tickets, chunksize=max(1, len(tickets) // (qr_workers * 4)))
+            else:
+                pngs = map(encode_qr_png, tickets)
+            sends = []
+            for (email_doc_id, booking_data, _), png in zip(payloads, pngs):
+                try:
+                    msg = build_confirmation_email(booking_data, png)
+                except Exception as e:
+                    fail(email_doc_id, e)
+                    continue
+                sends.append((email_doc_id, booking_data, senders.submit(send, email_doc_id, msg)))
+            
+            for email_doc_id, booking_data, future in sends:
+                error = future.result()
+                if error:
+                    fail(email_doc_id, error)
+                    continue
+                metrics.inc('portal_emails_total', result='sent')
+                checkpoint['sent'] += 1
+                if not dry_run and booking_data.get('email_status') != 'sent':
+                    storage.update_booking(email_doc_id, {'email_status': 'sent'})
+                    metrics.inc('portal_storage_writes_total')
+                    booking_cache.invalidate(email_doc_id)
+            sent += len(sends)
+            
+            if examined:
+                checkpoint['cursor'] = page[examined - 1][0]
+            checkpoint['done'] = examined == len(page) < page_size
+            checkpoint['updated_at'] = datetime.now().isoformat()
+            if checkpoint_path and not dry_run:
+                save_resend_checkpoint(checkpoint_path, checkpoint)
+            if progress:
+                progress(checkpoint)
+    finally:
+        senders.shutdown(cancel_futures=True)
+        if qr_pool:
+            qr_pool.shutdown(cancel_futures=True)
+    
+    elapsed = time.monotonic() - started
+    return {
+        'success': True,
+        'done': checkpoint['done'],
+        'sent': checkpoint['sent'],
+        'skipped': checkpoint['skipped'],
+        'failed': checkpoint['failed'],
+        'sent_this_run': sent,
+        'cursor': checkpoint['cursor'],
+        'elapsed_ms': round(elapsed * 1000, 2),
+        'rate': round(sent / elapsed, 1) if elapsed else 0.0
+    }
+
+@app.cli.command('resend-tickets')
+@click.option('--checkpoint', default=RESEND_CHECKPOINT, show_default=True, help='Progress file to resume from.')
+@click.option('--rate', type=float, default=RESEND_RATE, show_default=True, help='Messages per second, 0 for no limit.')
+@click.option('--page-size', type=int, default=RESEND_PAGE_SIZE, show_default=True)
+@click.option('--qr-workers', type=int, default=RESEND_QR_WORKERS, show_default=True, help='QR encoding processes.')
+@click.option('--email-status', type=click.Choice(sorted(EMAIL_STATUS_LABELS)), help='Only bookings with this delivery status.')
+@click.option('--include-past', is_flag=True, help='Also bookings whose validity has passed.')
+@click.option('--limit', type=int, help='Stop after this many messages.')
+@click.option('--dry-run', is_flag=True, help='Build every message but send nothing.')
+@click.option('--restart', is_flag=True, help='Ignore an existing checkpoint.')
+def resend_tickets_command(checkpoint, rate, page_size, qr_workers, email_status, include_past, limit, dry_run, restart):
+    """Re-send confirmation emails for completed bookings"""
+    def progress(state):
+        click.echo(f"sent {state['sent']}, skipped {state['skipped']}, failed {state['failed']}, cursor {state['cursor']}")
+    
+    result = resend_confirmations(
+        checkpoint_path=checkpoint, rate=rate, page_size=page_size, qr_workers=qr_workers,
+        email_status=email_status, include_past=include_past, limit=limit,
+        dry_run=dry_run, restart=restart, progress=progress
+    )
+    if not result['success']:
+        raise click.ClickException(result['error'])
+    click.echo(json.dumps(result))
+
+class StackSampler:
+    """Low-overhead sampling profiler for a single thread
+
+    A background thread records the target thread's stack every interval
+    seconds; stacks are aggregated in collapsed form ("outer;inner;leaf count"),
+    ready for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                name = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+                names.append(name.replace(' ', '_').replace(';', ','))
+                frame = frame.f_back
+            if names:
+                stack = ';'.join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+def should_profile():
+    """Profile requests to profiled endpoints that carry the token or fall in the sample"""
+    if '*' not in PROFILE_ENDPOINTS and request.endpoint not in PROFILE_ENDPOINTS:
+        return False
+    if PROFILE_TOKEN and hmac.compare_digest(request.headers.get('X-Profile-Token', '').encode(), PROFILE_TOKEN.encode()):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def write_profile(endpoint, profiler):
+    """Write one request profile under PROFILE_DIR/<endpoint>/, keeping the newest PROFILE_KEEP"""
+    route_dir = os.path.join(PROFILE_DIR, endpoint)
+    os.makedirs(route_dir, exist_ok=True)
+    stem = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}"
+    
+    if isinstance(profiler, StackSampler):
+        path = os.path.join(route_dir, f"{stem}.collapsed")
+        with open(path, 'w') as f:
+            f.write(profiler.collapsed())
+    else:
+        path = os.path.join(route_dir, f"{stem}.prof")
+        profiler.dump_stats(path)
+    
+    profiles = sorted(os.listdir(route_dir))
+    for name in profiles[:max(0, len(profiles) - PROFILE_KEEP)]:
+        try:
+            os.remove(os.path.join(route_dir, name))
+        except OSError:
+            pass
+    return path
+
+# Request instrumentation
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.server_timing = {}
+
+@app.before_request
+def start_expiry_sweeper():
+    expiry_sweeper.start()
+
+@app.before_request
+def start_outbox_drainer():
+    email_outbox.start_drainer()
+
+@app.before_request
+def start_profiler():
+    if not (PROFILE_SAMPLE_RATE > 0 or PROFILE_TOKEN) or not should_profile():
+        return
+    if PROFILE_MODE == 'cprofile':
+        import cProfile
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    else:
+        g.profiler = StackSampler(threading.get_ident(), PROFILE_INTERVAL).start()
+
+@app.teardown_request
+def stop_profiler(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    try:
+        if isinstance(profiler, StackSampler):
+            profiler.stop()
+        else:
+            profiler.disable()
+        write_profile(request.endpoint or 'unmatched', profiler)
+    except Exception as e:
+        print(f"Failed to write profile: {e}")
+
+@app.after_request
+def record_request_timing(response):
+    started = getattr(g, 'request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('portal_request_duration_seconds', elapsed, route=route, method=request.method,
+                    status=str(response.status_code))
+    
+    timings = [f"{stage};dur={duration * 1000:.2f}" for stage, duration in g.server_timing.items()]
+    timings.append(f"total;dur={elapsed * 1000:.2f}")
+    response.headers['Server-Timing'] = ', '.join(timings)
+    return response
 
 # Routes
 @app.route('/', methods=['GET'])
@@ -994,23 +3168,19 @@ def home():
     email = request.args.get('email', '')
     if email:
         return redirect(f"/booking/{email}")
-    return render_template_string(HTML_TEMPLATE, page='home', streamlit_url=STREAMLIT_APP_URL)
+    return render_page('home')
 
 @app.route('/validate', methods=['POST'])
 def validate_email():
     email = request.form.get('email', '').strip()
     
     if not email:
-        return render_template_string(HTML_TEMPLATE, page='error', 
-                                    error_message="Please enter a valid email address.",
-                                    streamlit_url=STREAMLIT_APP_URL)
+        return render_page('error', error_message="Please enter a valid email address.")
     
     booking = get_booking_by_email(email)
     
     if not booking:
-        return render_template_string(HTML_TEMPLATE, page='error',
-                                    error_message="No booking found for this email address. Please check and try again.",
-                                    streamlit_url=STREAMLIT_APP_URL)
+        return render_page('error', error_message="No booking found for this email address. Please check and try again.")
     
     return redirect(f"/booking/{email}")
 
@@ -1019,29 +3189,25 @@ def booking_details(email):
     booking = get_booking_by_email(email)
     
     if not booking:
-        return render_template_string(HTML_TEMPLATE, page='error',
-                                    error_message="Booking not found or has expired.",
-                                    streamlit_url=STREAMLIT_APP_URL)
+        return render_page('error', error_message="Booking not found or has expired.")
     
-    return render_template_string(HTML_TEMPLATE, page='booking', booking=booking, streamlit_url=STREAMLIT_APP_URL)
+    # Fresh key per page view, so a resubmitted form replays the first payment
+    return render_page('booking', booking=booking, idempotency_key=secrets.token_hex(16))
 
 @app.route('/process_payment', methods=['POST'])
 def process_payment_route():
     email = request.form.get('email', '').strip()
     
     if not email:
-        return render_template_string(HTML_TEMPLATE, page='error',
-                                    error_message="Invalid request.",
-                                    streamlit_url=STREAMLIT_APP_URL)
+        return render_page('error', error_message="Invalid request.")
     
-    success, message = process_payment(email)
+    result = process_payment(email, request_idempotency_key())
+    success, message = result
     
     if success:
-        return render_template_string(HTML_TEMPLATE, page='success', email=email, streamlit_url=STREAMLIT_APP_URL)
+        return render_page('success', email=email)
     else:
-        return render_template_string(HTML_TEMPLATE, page='error',
-                                    error_message=message,
-                                    streamlit_url=STREAMLIT_APP_URL)
+        return render_page('error', error_title=payment_error_title(result), error_message=message)
 
 @app.route('/api/process_payment', methods=['POST'])
 def api_process_payment():
@@ -1052,7 +3218,11 @@ def api_process_payment():
         if not email:
             return jsonify({'success': False, 'error': 'Email is required'})
         
-        success, message = process_payment(email)
+        result = process_payment(email, request_idempotency_key(data))
+        success, message = result
+        
+        if result.sold_out:
+            return jsonify({'success': False, 'sold_out': True, 'message': message}), 409
         
         return jsonify({
             'success': success,
@@ -1061,12 +3231,228 @@ def api_process_payment():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/process_payments', methods=['POST'])
+def api_process_payments():
+    try:
+        data = request.get_json()
+        emails = data.get('emails')
+        
+        if not isinstance(emails, list) or not emails or not all(isinstance(email, str) and email.strip() for email in emails):
+            return jsonify({'success': False, 'error': 'A non-empty list of emails is required'})
+        
+        if len(emails) > PAYMENT_BULK_MAX:
+            return jsonify({'success': False, 'error': f'At most {PAYMENT_BULK_MAX} emails per request'})
+        
+        results = process_payments([email.strip() for email in emails])
+        processed = sum(1 for result in results if result['success'])
+        
+        return jsonify({
+            'success': processed == len(results),
+            'processed': processed,
+            'failed': len(results) - processed,
+            'results': results
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/bookings', methods=['POST'])
+def api_bookings():
+    try:
+        data = request.get_json()
+        emails = data.get('emails')
+        
+        if not isinstance(emails, list) or not emails or not all(isinstance(email, str) and email.strip() for email in emails):
+            return jsonify({'success': False, 'error': 'A non-empty list of emails is required'})
+        
+        if len(emails) > BOOKING_LOOKUP_MAX:
+            return jsonify({'success': False, 'error': f'At most {BOOKING_LOOKUP_MAX} emails per request'})
+        
+        if not get_storage():
+            return jsonify({'success': False, 'error': 'Database connection failed'})
+        
+        emails = list(dict.fromkeys(email.strip() for email in emails))
+        bookings = get_bookings_by_email(emails)
+        
+        return jsonify({
+            'success': True,
+            'bookings': [booking_summary(email, bookings[email]) for email in emails]
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/verify', methods=['POST'])
+def api_verify():
+    if not TICKET_SIGNING_KEY:
+        return jsonify({'success': False, 'error': 'Ticket verification is not configured'}), 503
+    try:
+        data = request.get_json()
+        payloads = data.get('payloads')
+        
+        if payloads is None:
+            if not data.get('payload'):
+                return jsonify({'success': False, 'error': 'A payload or a list of payloads is required'})
+            result = verify_ticket(data['payload'])
+            metrics.inc('portal_tickets_verified_total', result=result['reason'] or 'valid')
+            return jsonify({'success': True, **result})
+        
+        if not isinstance(payloads, list) or not payloads:
+            return jsonify({'success': False, 'error': 'A non-empty list of payloads is required'})
+        
+        if len(payloads) > VERIFY_BATCH_MAX:
+            return jsonify({'success': False, 'error': f'At most {VERIFY_BATCH_MAX} payloads per request'})
+        
+        results = verify_tickets(payloads)
+        for result in results:
+            metrics.inc('portal_tickets_verified_total', result=result['reason'] or 'valid')
+        
+        return jsonify({
+            'success': True,
+            'valid': sum(1 for result in results if result['valid']),
+            'results': results
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/expire_bookings', methods=['GET', 'POST'])
+def api_expire_bookings():
+    # Vercel Cron sends the project's CRON_SECRET as a bearer token
+    error = bearer_token_error(CRON_SECRET, 'CRON_SECRET')
+    if error:
+        return error
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        cursor = data.get('cursor')
+        if cursor:
+            cursor = (datetime.fromisoformat(cursor['validity']), cursor['email_doc_id'])
+        
+        return jsonify(sweep_expired_bookings(cursor=cursor, budget=EXPIRY_SWEEP_BUDGET))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/drain_outbox', methods=['GET', 'POST'])
+def api_drain_outbox():
+    # Vercel Cron sends the project's CRON_SECRET as a bearer token
+    error = bearer_token_error(CRON_SECRET, 'CRON_SECRET')
+    if error:
+        return error
+    
+    try:
+        return jsonify(email_outbox.drain(budget=EMAIL_DRAIN_BUDGET))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/stats', methods=['GET'])
+def api_stats():
+    error = bearer_token_error(STATS_TOKEN, 'STATS_TOKEN')
+    if error:
+        return error
+    
+    try:
+        days = min(max(int(request.args.get('days', '7')), 1), STATS_MAX_DAYS)
+        end = datetime.strptime(request.args['date'], '%Y-%m-%d') if request.args.get('date') else datetime.now()
+        
+        storage = get_storage()
+        if not storage:
+            return jsonify({'success': False, 'error': 'Database connection failed'})
+        
+        # Reads the day's counter shards only, however many payments they add up
+        day_keys = [(end - timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range(days)]
+        with timed('storage'):
+            stats = storage.get_daily_stats(day_keys)
+        metrics.inc('portal_storage_reads_total', len(day_keys))
+        
+        daily = [{'date': day, **stats.get(day, dict.fromkeys(STATS_FIELDS, 0))} for day in day_keys]
+        return jsonify({
+            'success': True,
+            'days': daily,
+            'totals': {field: sum(day[field] for day in daily) for field in STATS_FIELDS}
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/qr/<booking_id>.png', methods=['GET'])
+def qr_image(booking_id):
+    signature = request.args.get('sig')
+    # Without a signing key the token is the booking's hash, checked once the booking is read
+    if TICKET_SIGNING_KEY and not qr_signature_valid(booking_id, signature):
+        return jsonify({'error': 'QR code not found'}), 404
+    
+    etag = qr_code_etag(booking_id)
+    
+    # The image for a booking ID is immutable, so a matching ETag needs no lookup
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        booking = get_booking_by_booking_id(booking_id)
+        if not booking or booking.get('status') != 'completed' or not qr_signature_valid(booking_id, signature, booking):
+            return jsonify({'error': 'QR code not found'}), 404
+        
+        try:
+            png = generate_qr_png(ticket_payload(booking))
+        except Exception as e:
+            print(f"QR code generation failed: {e}")
+            return jsonify({'error': 'QR code generation failed'}), 500
+        
+        response = app.response_class(png, mimetype='image/png')
+    
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = QR_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/static/<filename>', methods=['GET'])
+def static_asset(filename):
+    name = ASSET_FILES.get(filename)
+    if not name:
+        return jsonify({'error': 'Asset not found'}), 404
+    
+    response = send_from_directory(STATIC_DIR, name, max_age=ASSET_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/warmup', methods=['GET', 'POST'])
+def warmup():
+    return jsonify(warm_up())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    qr_stats = qr_cache.stats()
+    booking_stats = booking_cache.stats()
+    smtp_stats = smtp_pool.stats()
+    snapshot = {
+        'portal_qr_cache_hits_total': ('counter', qr_stats['hits']),
+        'portal_qr_cache_misses_total': ('counter', qr_stats['misses']),
+        'portal_qr_cache_size': ('gauge', qr_stats['size']),
+        'portal_booking_cache_hits_total': ('counter', booking_stats['hits']),
+        'portal_booking_cache_misses_total': ('counter', booking_stats['misses']),
+        'portal_booking_cache_size': ('gauge', booking_stats['size']),
+        'portal_email_queue_length': ('gauge', email_outbox.pending()),
+        'portal_smtp_pool_idle': ('gauge', smtp_stats['idle']),
+        'portal_smtp_pool_connects_total': ('counter', smtp_stats['connects']),
+        'portal_smtp_pool_reconnects_total': ('counter', smtp_stats['reconnects']),
+    }
+    return app.response_class(metrics.render(snapshot), mimetype='text/plain; version=0.0.4')
+
 @app.route('/health', methods=['GET'])
 def health_check():
+    # Cheap and side-effect free: a cold instance reports storage as null (not yet connected)
+    # rather than connecting here; /api/warmup connects it
+    connected = True if storage is not None else None
     return jsonify({
         "status": "healthy", 
         "timestamp": datetime.now().isoformat(),
-        "firebase_connected": db is not None
+        "firebase_connected": db is not None,
+        "storage": STORAGE_BACKEND,
+        "storage_connected": connected,
+        "ticket_signing_configured": bool(TICKET_SIGNING_KEY),
+        "qr_cache": qr_cache.stats(),
+        "booking_cache": booking_cache.stats(),
+        "idempotency_cache": idempotency_cache.stats(),
+        "email_queue": email_outbox.pending(),
+        "smtp_pool": smtp_pool.stats()
     })
 
 # Vercel serverless function handler
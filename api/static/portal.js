@@ -0,0 +1,42 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const tiltCard = document.getElementById('tiltCard');
+
+    if (tiltCard) {
+        tiltCard.addEventListener('mousemove', function(e) {
+            const rect = this.getBoundingClientRect();
+            const x = e.clientX - rect.left;
+            const y = e.clientY - rect.top;
+
+            const centerX = rect.width / 2;
+            const centerY = rect.height / 2;
+
+            const angleX = (y - centerY) / 20;
+            const angleY = (centerX - x) / 20;
+
+            this.style.transform = `perspective(1000px) rotateX(${angleX}deg) rotateY(${angleY}deg)`;
+        });
+
+        tiltCard.addEventListener('mouseleave', function() {
+            this.style.transform = 'perspective(1000px) rotateX(0) rotateY(0)';
+        });
+    }
+
+    const emailForm = document.getElementById('emailForm');
+    const paymentForm = document.getElementById('paymentForm');
+    const submitBtn = document.getElementById('submitBtn');
+    const payBtn = document.getElementById('payBtn');
+
+    if (emailForm && submitBtn) {
+        emailForm.addEventListener('submit', function() {
+            submitBtn.innerHTML = '<span class="loading"></span> Searching...';
+            submitBtn.disabled = true;
+        });
+    }
+
+    if (paymentForm && payBtn) {
+        paymentForm.addEventListener('submit', function() {
+            payBtn.innerHTML = '<span class="loading"></span> Processing Payment...';
+            payBtn.disabled = true;
+        });
+    }
+});
@@ -0,0 +1,154 @@
+"""Build time and size of confirmation emails, previous f-string builder vs templated CID message.
+
+The previous builder rendered a large f-string per call and inlined the QR
+as a base64 data: URI inside the HTML part, which was itself base64 encoded.
+The current one renders precompiled plain-text and HTML templates and
+attaches the QR PNG once as a multipart/related image. Both are timed with
+a warm QR cache, including serialization to the bytes handed to SMTP.
+
+Usage:
+    python bench/bench_email_build.py [--messages 2000]
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('TICKET_SIGNING_KEY', 'bench-signing-key')
+
+import index
+
+def legacy_confirmation_email(booking_data):
+    """The previous builder: one f-string HTML body with the QR as a data: URI"""
+    msg = MIMEMultipart()
+    msg['From'] = index.SMTP_USERNAME
+    msg['To'] = booking_data['email']
+    msg['Subject'] = "🎫 Athena Museum - Booking Confirmed"
+    
+    qr_code = base64.b64encode(index.generate_qr_png(index.ticket_payload(booking_data))).decode()
+    qr_src = f"data:image/png;base64,{qr_code}"
+    
+    body = f"""
+    <html>
+    <head>
+        <style>
+            body {{ font-family: 'Poppins', sans-serif; line-height: 1.6; color: #333; margin: 0; padding: 0; }}
+            .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
+            .header {{ background: linear-gradient(135deg, #6c63ff, #764ba2); color: white; padding: 30px; text-align: center; border-radius: 15px 15px 0 0; }}
+            .content {{ padding: 30px; background: white; border-radius: 0 0 15px 15px; box-shadow: 0 4px 15px rgba(0,0,0,0.1); }}
+            .ticket {{ background: #f8f9fa; border: 2px dashed #6c63ff; padding: 20px; margin: 20px 0; border-radius: 15px; text-align: center; }}
+            .qr-code {{ margin: 20px 0; }}
+            .qr-code img {{ max-width: 200px; border-radius: 10px; padding: 10px; background: white; border: 1px solid #eee; }}
+            .details {{ background: #f0f4ff; padding: 15px; border-radius: 10px; margin: 15px 0; }}
+            .detail-row {{ display: flex; justify-content: space-between; padding: 8px 0; border-bottom: 1px solid #e0e0ff; }}
+            .detail-row:last-child {{ border-bottom: none; }}
+            .footer {{ background: #f8f9fa; padding: 20px; text-align: center; font-size: 14px; color: #666; border-radius: 15px; margin-top: 20px; }}
+            .button {{ display: inline-block; background: linear-gradient(135deg, #6c63ff, #764ba2); color: white; padding: 12px 25px; text-decoration: none; border-radius: 25px; font-weight: bold; margin: 15px 0; }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="header">
+                <h1>🏛️ Athena Museum</h1>
+                <h2>Booking Confirmed!</h2>
+            </div>
+            <div class="content">
+                <p>Dear Visitor,</p>
+                <p>Your payment has been processed successfully! Here are your booking details:</p>
+                
+                <div class="ticket">
+                    <h3>Your E-Ticket</h3>
+                    <div class="qr-code">
+                        <img src="{qr_src}" alt="QR Code">
+                    </div>
+                    <p><strong>Booking ID:</strong> {booking_data['booking_id']}</p>
+                    <p><strong>Security Hash:</strong> {booking_data['hash']}</p>
+                </div>
+                
+                <div class="details">
+                    <div class="detail-row">
+                        <span>Email:</span>
+                        <span>{booking_data['email']}</span>
+                    </div>
+                    <div class="detail-row">
+                        <span>Phone:</span>
+                        <span>{booking_data['phone']}</span>
+                    </div>
+                    <div class="detail-row">
+                        <span>Tickets:</span>
+                        <span>{booking_data['tickets']}</span>
+                    </div>
+                    <div class="detail-row">
+                        <span>Amount Paid:</span>
+                        <span>₹{booking_data['amount']}</span>
+                    </div>
+                    <div class="detail-row">
+                        <span>Valid Until:</span>
+                        <span>{booking_data['validity_str']}</span>
+                    </div>
+                </div>
+                
+                <p>Present the QR code above at the museum entrance for entry.</p>
+                <p>We look forward to your visit!</p>
+                
+                <div style="text-align: center; margin-top: 20px;">
+                    <a href="{index.STREAMLIT_APP_URL}" class="button">Return to Chatbot</a>
+                </div>
+            </div>
+            <div class="footer">
+                <p><strong>Athena Museum of Science and Technology</strong></p>
+                <p>123 Science Avenue, Mumbai, Maharashtra 400001, India</p>
+                <p>📞 +91 22 1234 5678 | 📧 info@athenamuseum.com</p>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+    
+    msg.attach(MIMEText(body, 'html'))
+    return msg
+
+def bookings(count):
+    validity = datetime.now() + timedelta(hours=2)
+    for i in range(count):
+        booking_id = index.generate_booking_id()
+        yield {
+            'email': f"visitor{i:06d}@example.com",
+            'phone': '+91 98765 43210',
+            'tickets': 1 + i % 4,
+            'amount': 250 * (1 + i % 4),
+            'validity': validity,
+            'validity_str': validity.strftime('%d %b %Y, %H:%M') + ' (2h 0m remaining)',
+            'booking_id': booking_id,
+            'hash': booking_id[-8:]
+        }
+
+def run(name, build, batch):
+    started = time.perf_counter()
+    sizes = [len(build(booking).as_bytes()) for booking in batch]
+    elapsed = time.perf_counter() - started
+    print(f"{name:<24}{elapsed / len(batch) * 1e6:>10.1f} us/msg{sum(sizes) / len(sizes):>10,.0f} bytes/msg")
+    return elapsed, sum(sizes)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+
+    batch = list(bookings(args.messages))
+    index.qr_cache.maxsize = max(index.qr_cache.maxsize, len(batch))
+    for booking in batch:
+        index.generate_qr_png(index.ticket_payload(booking))
+
+    before_time, before_size = run('f-string + data: URI', legacy_confirmation_email, batch)
+    after_time, after_size = run('templates + CID image', index.build_confirmation_email, batch)
+    print(f"build speedup: {before_time / after_time:.2f}x, size: {after_size / before_size:.0%} of before")
+
+if __name__ == '__main__':
+    main()
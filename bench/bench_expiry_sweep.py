@@ -0,0 +1,109 @@
+"""Benchmark for the booking expiry sweeper.
+
+Loads synthetic bookings (a --expired-share of them pending past their
+validity), then compares the full scan a status query needs while expired
+bookings stay 'pending' with the indexed, paged sweep that marks them
+'expired', and the same scan once the sweep has run.
+
+The SQLite backend uses the real (status, validity) index. The firestore
+backend runs against the in-memory stand-in, which scans on every query, so
+keep it to smaller sizes; it reports round trips and batch commits instead.
+
+Usage:
+    python bench/bench_expiry_sweep.py [--size 1000000] [--backend sqlite|firestore|memory]
+                                       [--expired-share 0.3] [--batch 500]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'api'))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import index
+from fake_firestore import InMemoryFirestore
+
+def synthetic_bookings(size, expired_share, now):
+    """{email_doc_id: booking} with every status mixed in"""
+    expired_every = max(1, round(1 / expired_share)) if expired_share else 0
+    bookings = {}
+    for i in range(size):
+        expired = expired_every and i % expired_every == 0
+        bookings[f"visitor{i:07d}_at_example_com"] = {
+            'email': f"visitor{i:07d}@example.com",
+            'phone': '+91 98765 43210',
+            'tickets': 1 + i % 4,
+            'amount': 250 * (1 + i % 4),
+            'status': 'completed' if i % 7 == 0 and not expired else 'pending',
+            'validity': now - timedelta(minutes=1 + i % 10000) if expired else now + timedelta(minutes=1 + i % 10000)
+        }
+    return bookings
+
+def build_storage(backend, bookings):
+    if backend == 'sqlite':
+        path = os.path.join(tempfile.mkdtemp(prefix='expiry-bench-'), 'bookings.db')
+        storage = index.SQLiteStorage(path)
+        storage.put_bookings(bookings)
+        return storage, None
+    if backend == 'firestore':
+        db = InMemoryFirestore()
+        db.load('bookings', bookings, copy_data=False)
+        return index.FirestoreStorage(db), db
+    storage = index.MemoryStorage()
+    storage.put_bookings(bookings)
+    return storage, None
+
+def scan_pending(storage, db, now):
+    """What a status query costs without the sweeper: every pending booking, filtered in Python"""
+    started = time.perf_counter()
+    if db is not None:
+        rows = [doc.to_dict() for doc in db.collection('bookings').where('status', '==', 'pending').get()]
+    elif isinstance(storage, index.SQLiteStorage):
+        rows = [index._loads(data) for (data,) in
+                storage._conn().execute("SELECT data FROM bookings WHERE status = 'pending'")]
+    else:
+        rows = [data for data in storage._bookings.values() if data.get('status') == 'pending']
+    stale = sum(1 for data in rows if data['validity'].replace(tzinfo=None) <= now)
+    return len(rows), stale, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--backend', choices=('sqlite', 'firestore', 'memory'), default='sqlite')
+    parser.add_argument('--expired-share', type=float, default=0.3)
+    parser.add_argument('--batch', type=int, default=index.EXPIRY_BATCH_SIZE)
+    args = parser.parse_args()
+
+    now = datetime.now()
+    started = time.perf_counter()
+    bookings = synthetic_bookings(args.size, args.expired_share, now)
+    storage, db = build_storage(args.backend, bookings)
+    del bookings
+    index.storage = storage
+    print(f"{args.size:,} bookings on {args.backend}, loaded in {time.perf_counter() - started:.1f}s")
+
+    pending, stale, elapsed = scan_pending(storage, db, now)
+    print(f"  pending scan before sweep   {elapsed * 1000:>10.1f} ms  {pending:,} pending read, {stale:,} of them expired")
+
+    if db is not None:
+        db.reset_counters()
+    result = index.sweep_expired_bookings(now=now, batch_size=args.batch)
+    rate = result['expired'] / (result['elapsed_ms'] / 1000) if result['elapsed_ms'] else 0
+    print(f"  sweep                       {result['elapsed_ms']:>10.1f} ms  {result['expired']:,} expired "
+          f"in {result['pages']:,} pages ({rate:,.0f} bookings/s), {result['skipped']} skipped")
+    if db is not None:
+        print(f"                                             {db.round_trips:,} round trips, {db.commits:,} batch commits")
+
+    pending, stale, elapsed = scan_pending(storage, db, now)
+    print(f"  pending scan after sweep    {elapsed * 1000:>10.1f} ms  {pending:,} pending read, {stale:,} of them expired")
+
+    result = index.sweep_expired_bookings(now=now, batch_size=args.batch)
+    print(f"  repeat sweep (nothing due)  {result['elapsed_ms']:>10.1f} ms  {result['expired']:,} expired")
+
+if __name__ == '__main__':
+    main()
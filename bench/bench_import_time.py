@@ -0,0 +1,83 @@
+"""Import-time report for the serverless entry point.
+
+Runs `python -X importtime -c "import index"` in fresh interpreters, the same
+work a cold start does before the first request, and reports the total and the
+slowest top-level imports. Firebase, qrcode and Pillow should not appear: they
+are loaded on first use.
+
+Usage: python bench/bench_import_time.py [--runs N] [--top N] [--json] [--max-ms MS]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+
+# Modules that must stay out of the import path of api/index.py
+LAZY_MODULES = ('firebase_admin', 'google.cloud.firestore', 'qrcode', 'PIL')
+
+def import_profile():
+    """Import times in microseconds for the modules loaded by one cold import of index"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import index'],
+        cwd=API_DIR, capture_output=True, text=True, check=True
+    )
+    modules = {}
+    pending = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        pending[name.strip()] = {'cumulative_us': int(cumulative_us), 'self_us': int(self_us), 'depth': depth}
+        # Children are reported before their parent; keep only the subtree of index
+        if depth == 0:
+            if name.strip() == 'index':
+                modules = pending
+            pending = {}
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--max-ms', type=float, help='exit non-zero if the median import exceeds this budget')
+    args = parser.parse_args()
+
+    runs = [import_profile() for _ in range(args.runs)]
+    totals = [run['index']['cumulative_us'] / 1000 for run in runs]
+    last = runs[-1]
+    top_level = sorted(
+        ((name, info['cumulative_us'] / 1000) for name, info in last.items() if info['depth'] == 1),
+        key=lambda item: item[1], reverse=True
+    )[:args.top]
+    eager = sorted(name for name in last if name.split('.')[0] in LAZY_MODULES or name in LAZY_MODULES)
+    report = {
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'total_ms_median': round(statistics.median(totals), 2),
+        'total_ms_min': round(min(totals), 2),
+        'total_ms_max': round(max(totals), 2),
+        'top_imports_ms': {name: round(ms, 2) for name, ms in top_level},
+        'eager_lazy_modules': eager,
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"import index: median {report['total_ms_median']}ms "
+              f"(min {report['total_ms_min']}ms, max {report['total_ms_max']}ms over {args.runs} runs)")
+        for name, ms in report['top_imports_ms'].items():
+            print(f"  {name:<40}{ms:>10.2f}ms")
+        if eager:
+            print(f"modules expected to be lazy were imported eagerly: {', '.join(eager)}")
+
+    if eager or (args.max_ms is not None and report['total_ms_median'] > args.max_ms):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Latency comparison of the sequential payment writes against the single batched commit.
+
+Runs both flows against the in-memory Firestore stand-in with a simulated
+per-call round-trip latency and reports round trips and wall time per payment.
+Each flow makes one untimed warm-up payment first.
+
+Usage: python bench/bench_payment_commit.py [payments] [latency_ms]
+"""
+import hashlib
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'api'))
+sys.path.insert(0, BENCH_DIR)
+
+import index
+from fake_firestore import InMemoryFirestore
+
+def sequential_process_payment(email):
+    # The original flow: update, payment set, full re-read, then the outbox write
+    db = index.storage.client
+    booking_id = f"ATH{datetime.now().strftime('%Y%m%d')}{str(int(datetime.now().timestamp()))[-6:]}"
+    hash_code = hashlib.md5(f"{booking_id}{email}".encode()).hexdigest()[:8].upper()
+    db.collection('bookings').document(index.email_doc_id_for(email)).update({
+        'status': 'completed',
+        'booking_id': booking_id,
+        'hash': hash_code,
+        'email_status': 'pending',
+        'updated_at': datetime.now()
+    })
+    db.collection('payments').document(booking_id).set({
+        'booking_id': booking_id,
+        'email': email,
+        'status': 'completed',
+        'created_at': datetime.now()
+    })
+    booking_data = index.get_booking_by_email(email)
+    db.collection('email_outbox').document(booking_id).set(index.email_outbox.record(booking_data))
+    return True, "Payment processed successfully"
+
+def seed(count):
+    db = InMemoryFirestore()
+    validity = datetime.now() + timedelta(hours=2)
+    db.load('bookings', {
+        index.email_doc_id_for(f"visitor{i}@example.com"): {
+            'email': f"visitor{i}@example.com",
+            'phone': '+91 98765 43210',
+            'tickets': 2,
+            'amount': 500,
+            'status': 'pending',
+            'validity': validity
+        }
+        for i in range(count)
+    })
+    return db
+
+def run(label, flow, payments, latency):
+    db = seed(payments + 1)
+    db.latency = latency
+    index.storage = index.FirestoreStorage(db)
+    # Untimed warm-up payment, so lazy imports and first-call setup aren't charged to either flow
+    success, message = flow(f"visitor{payments}@example.com")
+    assert success, message
+    db.round_trips = 0
+    started = time.perf_counter()
+    for i in range(payments):
+        success, message = flow(f"visitor{i}@example.com")
+        assert success, message
+    elapsed = time.perf_counter() - started
+    print(f"{label:<12}{db.round_trips / payments:>14.1f}{elapsed / payments * 1000:>16.2f}")
+    return elapsed
+
+def main():
+    payments = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 5.0) / 1000
+    # Measure the Firestore path only; emails are not delivered
+    index.email_outbox.dispatch = lambda outbox_id: None
+    print(f"{payments} payments, {latency * 1000:.1f}ms simulated round trip")
+    print(f"{'flow':<12}{'round trips':>14}{'ms/payment':>16}")
+    before = run('sequential', sequential_process_payment, payments, latency)
+    after = run('batched', index.process_payment, payments, latency)
+    print(f"speedup: {before / after:.2f}x")
+
+if __name__ == '__main__':
+    main()
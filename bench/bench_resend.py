@@ -0,0 +1,106 @@
+"""Throughput of the bulk confirmation re-send job, and resume after an interruption.
+
+Loads --size completed bookings and re-sends every confirmation to a local
+SMTP sink with no rate limit, encoding QR codes in-process and then with a
+pool of --qr-workers processes. A final run is stopped part way with
+--limit and resumed from its checkpoint, checking that every booking gets
+exactly one message.
+
+Usage:
+    python bench/bench_resend.py [--size 5000] [--backend sqlite|firestore|memory]
+                                 [--qr-workers 4] [--page-size 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'api'))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_firestore import InMemoryFirestore
+from smtp_sink import SMTPSink
+
+# Point the app at the local sink before it builds its SMTP pool
+sink = SMTPSink().start()
+os.environ.update({
+    'SMTP_SERVER': sink.host,
+    'SMTP_PORT': str(sink.port),
+    'SMTP_STARTTLS': 'false',
+    'TICKET_SIGNING_KEY': 'bench-signing-key',
+    'SMTP_POOL_SIZE': '4',
+    'STORAGE_BACKEND': 'memory',
+})
+
+import index
+
+def completed_bookings(size):
+    validity = datetime.now() + timedelta(days=1)
+    bookings = {}
+    for i in range(size):
+        email = f"visitor{i:07d}@example.com"
+        booking_id = index.generate_booking_id()
+        bookings[index.email_doc_id_for(email)] = {
+            'email': email,
+            'phone': '+91 98765 43210',
+            'tickets': 1 + i % 4,
+            'amount': 250 * (1 + i % 4),
+            'status': 'completed',
+            'validity': validity,
+            'booking_id': booking_id,
+            'hash': booking_id[-8:],
+            'email_status': 'sent'
+        }
+    return bookings
+
+def build_storage(backend, bookings, workdir):
+    if backend == 'sqlite':
+        storage = index.SQLiteStorage(os.path.join(workdir, 'bookings.db'))
+        storage.put_bookings(bookings)
+        return storage
+    if backend == 'firestore':
+        db = InMemoryFirestore()
+        db.load('bookings', bookings)
+        return index.FirestoreStorage(db)
+    storage = index.MemoryStorage()
+    storage.put_bookings(bookings)
+    return storage
+
+def run(name, **options):
+    before = sink.messages
+    result = index.resend_confirmations(rate=0, **options)
+    assert result['success'], result
+    print(f"{name:<28}{result['sent_this_run']:>8,} msgs{result['elapsed_ms'] / 1000:>8.2f}s"
+          f"{result['rate']:>10,.0f} msgs/s{sink.messages - before:>10,} received")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=5000)
+    parser.add_argument('--backend', choices=('sqlite', 'firestore', 'memory'), default='sqlite')
+    parser.add_argument('--qr-workers', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--page-size', type=int, default=index.RESEND_PAGE_SIZE)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='resend-bench-')
+    index.storage = build_storage(args.backend, completed_bookings(args.size), workdir)
+    checkpoint = os.path.join(workdir, 'checkpoint.json')
+    print(f"{args.size:,} completed bookings on {args.backend}, page size {args.page_size}")
+
+    run('QR in-process', checkpoint_path=checkpoint, restart=True, page_size=args.page_size, qr_workers=0)
+    run(f"QR in {args.qr_workers} processes", checkpoint_path=checkpoint, restart=True,
+        page_size=args.page_size, qr_workers=args.qr_workers)
+
+    # Interrupted run, then resumed from the checkpoint
+    before = sink.messages
+    run('interrupted at 40%', checkpoint_path=checkpoint, restart=True, page_size=args.page_size,
+        qr_workers=args.qr_workers, limit=int(args.size * 0.4))
+    result = run('resumed', checkpoint_path=checkpoint, page_size=args.page_size, qr_workers=args.qr_workers)
+    received = sink.messages - before
+    print(f"done: {result['done']}, received {received:,} for {args.size:,} bookings")
+    sys.exit(0 if result['done'] and received == args.size else 1)
+
+if __name__ == '__main__':
+    main()
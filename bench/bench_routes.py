@@ -0,0 +1,171 @@
+"""End-to-end latency benchmark for the portal routes.
+
+Drives the Flask app through its test client against the in-memory Firestore
+stand-in and a local SMTP sink, so every layer of the app runs (routing,
+storage, caches, templates, outbox) without a network. For each fixture size
+it reports p50/p95/p99 latency and sequential throughput per route.
+
+Usage:
+    python bench/bench_routes.py [--sizes 1000,100000,1000000] [--requests 500]
+                                 [--latency-ms 0] [--json results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'api'))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_firestore import InMemoryFirestore
+from smtp_sink import SMTPSink
+
+# Point the app at the local sink before it builds its SMTP pool
+sink = SMTPSink().start()
+os.environ.update({
+    'SMTP_SERVER': sink.host,
+    'SMTP_PORT': str(sink.port),
+    'SMTP_STARTTLS': 'false',
+    'TICKET_SIGNING_KEY': 'bench-signing-key',
+    'STORAGE_BACKEND': 'firestore',
+})
+
+import index
+
+ROUTES = ('GET /booking/<email>', 'POST /validate', 'POST /process_payment', 'POST /api/process_payment')
+
+def fixture_email(i):
+    return f"visitor{i:07d}@example.com"
+
+def build_fixture(size, latency):
+    """Fake Firestore holding size pending bookings"""
+    db = InMemoryFirestore(latency=latency)
+    validity = datetime.now() + timedelta(hours=2)
+    db.load('bookings', {
+        index.email_doc_id_for(fixture_email(i)): {
+            'email': fixture_email(i),
+            'phone': '+91 98765 43210',
+            'tickets': 1 + i % 4,
+            'amount': 250 * (1 + i % 4),
+            'status': 'pending',
+            'validity': validity
+        }
+        for i in range(size)
+    }, copy_data=False)
+    return db
+
+def percentile(sorted_values, pct):
+    index_ = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index_]
+
+def measure(requests, call):
+    latencies = []
+    started = time.perf_counter()
+    for args in requests:
+        t0 = time.perf_counter()
+        response = call(*args)
+        latencies.append(time.perf_counter() - t0)
+        assert response.status_code in (200, 302), response.status_code
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1)
+    }
+
+def run_size(size, requests, latency, seed):
+    rng = random.Random(seed)
+    index.storage = index.FirestoreStorage(build_fixture(size, latency))
+    index.booking_cache.clear()
+    client = index.app.test_client()
+
+    # Lookups draw from the whole fixture; each payment consumes its own pending booking
+    lookups = [fixture_email(rng.randrange(size)) for _ in range(requests)]
+    payers = iter(rng.sample(range(size), min(size, 2 * requests)))
+
+    results = {}
+    results[ROUTES[0]] = measure([(email,) for email in lookups],
+                                 lambda email: client.get(f"/booking/{email}"))
+    results[ROUTES[1]] = measure([(email,) for email in lookups],
+                                 lambda email: client.post('/validate', data={'email': email}))
+    results[ROUTES[2]] = measure([(fixture_email(next(payers)),) for _ in range(min(requests, size // 2))],
+                                 lambda email: client.post('/process_payment', data={'email': email}))
+    results[ROUTES[3]] = measure([(fixture_email(next(payers)),) for _ in range(min(requests, size // 2))],
+                                 lambda email: client.post('/api/process_payment', json={'email': email}))
+
+    # Confirmation emails are delivered in the background; report how long draining took
+    drain_started = time.perf_counter()
+    index.email_outbox.join(timeout=120)
+    results['email_outbox'] = {
+        'drain_s': round(time.perf_counter() - drain_started, 3),
+        'delivered_total': sink.messages,
+        'smtp_pool': index.smtp_pool.stats()
+    }
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def print_results(size, results, baseline=None):
+    print(f"\n{size:,} bookings")
+    print(f"  {'route':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+    for route in ROUTES:
+        r = results[route]
+        line = f"  {route:<28}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['throughput_rps']:>10.1f}"
+        previous = (baseline or {}).get(str(size), {}).get(route)
+        if previous:
+            line += f"   p50 {r['p50_ms'] - previous['p50_ms']:+.3f}ms, p95 {r['p95_ms'] - previous['p95_ms']:+.3f}ms"
+        print(line)
+    outbox = results['email_outbox']
+    print(f"  outbox drained in {outbox['drain_s']}s, {outbox['delivered_total']} emails delivered so far")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,100000', help='comma separated fixture sizes, e.g. 1000,100000,1000000')
+    parser.add_argument('--requests', type=int, default=500, help='requests per route and size')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated Firestore round trip')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='print deltas against an earlier --json file')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'requests': args.requests,
+        'latency_ms': args.latency_ms,
+        'results': {}
+    }
+    for size in (int(value) for value in args.sizes.split(',')):
+        results = run_size(size, args.requests, args.latency_ms / 1000, args.seed)
+        report['results'][str(size)] = results
+        print_results(size, results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nwrote {args.json}")
+
+if __name__ == '__main__':
+    main()
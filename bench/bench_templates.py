@@ -0,0 +1,51 @@
+"""Micro-benchmark: per-render cost of compiling page templates on every call vs the precompiled cache.
+
+Usage: python bench/bench_templates.py [iterations]
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+from jinja2 import DictLoader, Environment
+
+import index
+
+BOOKING = {
+    'email': 'visitor@example.com',
+    'phone': '+91 98765 43210',
+    'tickets': 2,
+    'amount': 500,
+    'status': 'completed',
+    'validity_str': datetime.now().strftime('%d %b %Y, %H:%M') + ' (2h 0m remaining)',
+    'booking_id': 'ATH20240101123456',
+    'qr_url': '/qr/ATH20240101123456.png',
+}
+
+CONTEXTS = {
+    'home': {},
+    'booking': {'booking': BOOKING},
+    'success': {'email': BOOKING['email']},
+    'error': {'error_message': 'Booking not found or has expired.'},
+}
+
+def render_uncached(page, context):
+    # Equivalent of render_template_string: the source is compiled on every call
+    env = Environment(loader=DictLoader(index.TEMPLATES), autoescape=True, cache_size=0)
+    # Same globals as the app environment (asset_url, EMAIL_STATUS_LABELS)
+    env.globals.update(index.app.jinja_env.globals)
+    return env.get_template(f"{page}.html").render(streamlit_url=index.STREAMLIT_APP_URL, **context)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"{'page':<10}{'uncached (ms)':>16}{'cached (ms)':>14}{'speedup':>10}")
+    for page, context in CONTEXTS.items():
+        assert render_uncached(page, context) == index.render_page(page, **context)
+        uncached = timeit.timeit(lambda: render_uncached(page, context), number=iterations) / iterations
+        cached = timeit.timeit(lambda: index.render_page(page, **context), number=iterations) / iterations
+        print(f"{page:<10}{uncached * 1000:>16.3f}{cached * 1000:>14.3f}{uncached / cached:>9.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Throughput of stateless ticket verification.
+
+Measures verify_ticket in-process, then /api/verify through the Flask test
+client with one scan per request and with batches, all without storage.
+
+Usage:
+    python bench/bench_verify.py [--scans 20000] [--batch 500]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('TICKET_SIGNING_KEY', 'bench-signing-key')
+
+import index
+
+def rate(count, elapsed):
+    return f"{count / elapsed:>12,.0f} scans/s"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scans', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=500)
+    args = parser.parse_args()
+
+    validity = datetime.now() + timedelta(hours=2)
+    payloads = [index.sign_ticket(f"ATH{i:014d}", validity, 1 + i % 4) for i in range(args.scans)]
+    client = index.app.test_client()
+
+    started = time.perf_counter()
+    results = index.verify_tickets(payloads)
+    print(f"verify_tickets (in-process)   {rate(len(payloads), time.perf_counter() - started)}")
+    assert all(result['valid'] for result in results)
+
+    single = payloads[:min(len(payloads), 2000)]
+    started = time.perf_counter()
+    for payload in single:
+        assert client.post('/api/verify', json={'payload': payload}).json['valid']
+    print(f"/api/verify, 1 per request    {rate(len(single), time.perf_counter() - started)}")
+
+    started = time.perf_counter()
+    for start in range(0, len(payloads), args.batch):
+        batch = payloads[start:start + args.batch]
+        assert client.post('/api/verify', json={'payloads': batch}).json['valid'] == len(batch)
+    print(f"/api/verify, {args.batch} per request  {rate(len(payloads), time.perf_counter() - started)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+"""In-memory stand-in for the subset of the Firestore client used by the portal.
+
+Every call that would be a network round trip against real Firestore (document
+get/set/update/delete, batch commit, get_all, query get/stream) sleeps for the
+configured latency and is counted, so benchmarks can compare call patterns
+without a network.
+"""
+import copy
+import itertools
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+class FailedPrecondition(Exception):
+    pass
+
+class NotFound(Exception):
+    pass
+
+class AlreadyExists(Exception):
+    pass
+
+class InvalidArgument(Exception):
+    pass
+
+class WriteOption:
+    def __init__(self, last_update_time=None, exists=None):
+        self.last_update_time = last_update_time
+        self.exists = exists
+
+class FieldFilter:
+    def __init__(self, field_path, op_string, value):
+        self.field_path = field_path
+        self.op_string = op_string
+        self.value = value
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+}
+
+def _apply_transforms(current, data):
+    for key, value in data.items():
+        # google.cloud.firestore_v1.transforms.Increment and friends
+        if type(value).__name__ == 'Increment':
+            current[key] = current.get(key, 0) + value.value
+        elif type(value).__name__ == 'Sentinel' and 'DELETE' in repr(value):
+            current.pop(key, None)
+        elif type(value).__name__ == 'Sentinel' and 'SERVER_TIMESTAMP' in repr(value):
+            current[key] = datetime.now(timezone.utc)
+        else:
+            current[key] = copy.deepcopy(value)
+    return current
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+class DocumentReference:
+    def __init__(self, client, collection, doc_id):
+        self._client = client
+        self._collection = collection
+        self.id = doc_id
+        self.path = f"{collection}/{doc_id}"
+
+    def get(self, transaction=None):
+        self._client._round_trip()
+        return self._client._snapshot(self)
+
+    def set(self, data, merge=False):
+        self._client._round_trip()
+        with self._client._lock:
+            self._client._write_set(self, data, merge)
+
+    def update(self, data, option=None):
+        self._client._round_trip()
+        with self._client._lock:
+            self._client._write_update(self, data, option)
+
+    def delete(self):
+        self._client._round_trip()
+        with self._client._lock:
+            self._client._write_delete(self)
+
+class Query:
+    def __init__(self, client, collection, filters=(), orders=(), limit=None, start_after=None):
+        self._client = client
+        self._collection = collection
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit, start_after=self._start_after)
+        state.update(changes)
+        return Query(self._client, self._collection, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field_path, _OPERATORS[op_string], value)])
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + [(field_path, direction)])
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot_or_values):
+        return self._copy(start_after=snapshot_or_values)
+
+    def _results(self):
+        with self._client._lock:
+            docs = self._client._store.get(self._collection, {})
+            rows = [
+                (doc_id, data) for doc_id, data in docs.items()
+                if all(op(data.get(field), value) for field, op, value in self._filters)
+            ]
+        # Ordered fields, then the document ID ('__name__') as Firestore's implicit tie-break
+        fields = [field for field, _ in self._orders if field != '__name__'] + ['__name__']
+        reverse = bool(self._orders) and self._orders[0][1] in ('DESCENDING', 'desc')
+        def sort_key(doc_id, data):
+            return tuple(doc_id if field == '__name__' else data.get(field) for field in fields)
+        rows.sort(key=lambda row: sort_key(*row), reverse=reverse)
+        if self._start_after is not None:
+            if isinstance(self._start_after, DocumentSnapshot):
+                cursor = sort_key(self._start_after.id, self._start_after._data or {})
+            else:
+                cursor = tuple(self._start_after.values()) if isinstance(self._start_after, dict) else tuple(self._start_after)
+            def after(row):
+                key = sort_key(*row)[:len(cursor)]
+                return key < cursor if reverse else key > cursor
+            rows = [row for row in rows if after(row)]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return [
+            DocumentSnapshot(DocumentReference(self._client, self._collection, doc_id), copy.deepcopy(data),
+                             self._client._update_times.get((self._collection, doc_id)))
+            for doc_id, data in rows
+        ]
+
+    def get(self, transaction=None):
+        self._client._round_trip()
+        return self._results()
+
+    def stream(self, transaction=None):
+        self._client._round_trip()
+        return iter(self._results())
+
+class CollectionReference(Query):
+    def __init__(self, client, name):
+        super().__init__(client, name)
+        self.id = name
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, self._collection, document_id or uuid.uuid4().hex[:20])
+
+# Firestore rejects commits with more writes than this
+MAX_BATCH_WRITES = 500
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, reference, data):
+        self._writes.append(('create', reference, data, None))
+        return self
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(('set', reference, data, merge))
+        return self
+
+    def update(self, reference, data, option=None):
+        self._writes.append(('update', reference, data, option))
+        return self
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, None))
+        return self
+
+    def __len__(self):
+        return len(self._writes)
+
+    def commit(self):
+        """Apply every write atomically, or none if a precondition fails"""
+        if len(self._writes) > MAX_BATCH_WRITES:
+            raise InvalidArgument(f"maximum {MAX_BATCH_WRITES} writes allowed per request")
+        self._client._round_trip()
+        with self._client._lock:
+            for kind, reference, data, option in self._writes:
+                if kind == 'update':
+                    self._client._check_update(reference, option)
+                elif kind == 'create' and reference.id in self._client._store.get(reference._collection, {}):
+                    raise AlreadyExists(f"Document already exists: {reference.path}")
+            for kind, reference, data, extra in self._writes:
+                if kind in ('set', 'create'):
+                    self._client._write_set(reference, data, False if kind == 'create' else extra)
+                elif kind == 'update':
+                    self._client._write_update(reference, data, extra)
+                else:
+                    self._client._write_delete(reference)
+            self._client.commits += 1
+        writes, self._writes = len(self._writes), []
+        return writes
+
+class InMemoryFirestore:
+    """Thread-safe in-memory Firestore stand-in with simulated round-trip latency"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self.commits = 0
+        self._store = {}
+        self._update_times = {}
+        self._clock = itertools.count(1)
+        self._lock = threading.RLock()
+
+    # Client API
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def get_all(self, references, transaction=None):
+        self._round_trip()
+        return [self._snapshot(reference) for reference in references]
+
+    @staticmethod
+    def write_option(last_update_time=None, exists=None):
+        return WriteOption(last_update_time=last_update_time, exists=exists)
+
+    # Helpers for benchmarks
+    def load(self, collection, documents, copy_data=True):
+        """Bulk-load {doc_id: data} without counting round trips
+
+        Pass copy_data=False for freshly built fixtures to skip the deep copies.
+        """
+        with self._lock:
+            docs = self._store.setdefault(collection, {})
+            for doc_id, data in documents.items():
+                docs[doc_id] = copy.deepcopy(data) if copy_data else data
+                self._update_times[(collection, doc_id)] = next(self._clock)
+
+    def documents(self, collection):
+        with self._lock:
+            return copy.deepcopy(self._store.get(collection, {}))
+
+    def reset_counters(self):
+        self.round_trips = 0
+        self.commits = 0
+
+    # Internals
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _snapshot(self, reference):
+        with self._lock:
+            data = self._store.get(reference._collection, {}).get(reference.id)
+            return DocumentSnapshot(reference, copy.deepcopy(data),
+                                    self._update_times.get((reference._collection, reference.id)))
+
+    def _touch(self, reference):
+        self._update_times[(reference._collection, reference.id)] = next(self._clock)
+
+    def _write_set(self, reference, data, merge):
+        docs = self._store.setdefault(reference._collection, {})
+        current = docs.get(reference.id, {}) if merge else {}
+        docs[reference.id] = _apply_transforms(dict(current), data)
+        self._touch(reference)
+
+    def _check_update(self, reference, option):
+        key = (reference._collection, reference.id)
+        if reference.id not in self._store.get(reference._collection, {}):
+            raise NotFound(f"No document to update: {reference.path}")
+        if option is not None and option.last_update_time is not None \
+                and self._update_times.get(key) != option.last_update_time:
+            raise FailedPrecondition(f"Document was modified: {reference.path}")
+
+    def _write_update(self, reference, data, option):
+        self._check_update(reference, option)
+        docs = self._store[reference._collection]
+        docs[reference.id] = _apply_transforms(dict(docs[reference.id]), data)
+        self._touch(reference)
+
+    def _write_delete(self, reference):
+        self._store.get(reference._collection, {}).pop(reference.id, None)
+        self._update_times.pop((reference._collection, reference.id), None)
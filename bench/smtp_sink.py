@@ -0,0 +1,68 @@
+"""Minimal threaded SMTP server that accepts and counts every message.
+
+A local stand-in for the real mail server in benchmarks: it speaks enough
+ESMTP (EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP, QUIT) for smtplib, advertises
+no STARTTLS or AUTH, and keeps sessions open so pooled connections are reused.
+"""
+import socketserver
+import threading
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        sink = self.server.sink
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 localhost SMTP sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.wfile.write(b'250-localhost\r\n250-8BITMIME\r\n250 SMTPUTF8\r\n')
+            elif command.startswith(('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP')):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    size += len(data)
+                with sink.lock:
+                    sink.messages += 1
+                    sink.bytes += size
+                self.reply('250 OK: queued')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class _ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class SMTPSink:
+    """Run with start(); the bound port is available as .port"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self._server = _ThreadedServer((host, port), _SMTPHandler)
+        self._server.sink = self
+        self.host, self.port = self._server.server_address
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,77 @@
+"""Stress test for booking ID uniqueness across processes.
+
+Starts --processes workers (forked from a parent that has already issued IDs,
+or spawned fresh), each generating --ids booking IDs from --threads threads.
+Checks that every worker's IDs strictly increase per thread, then that all IDs
+from all workers are distinct. Exits non-zero on any duplicate.
+
+Usage:
+    python bench/stress_booking_ids.py [--processes 8] [--ids 500000] [--threads 2] [--start fork|spawn]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import index
+
+def generate(count, threads):
+    """IDs from one process; raises if any thread saw them go backwards"""
+    per_thread = [[] for _ in range(threads)]
+
+    def run(ids, n):
+        for _ in range(n):
+            ids.append(index.generate_booking_id())
+
+    workers = [
+        threading.Thread(target=run, args=(ids, count // threads + (i < count % threads)))
+        for i, ids in enumerate(per_thread)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for ids in per_thread:
+        if any(a >= b for a, b in zip(ids, ids[1:])):
+            raise AssertionError(f"IDs not strictly increasing in process {os.getpid()}")
+    return index.booking_ids.instance_id, [booking_id for ids in per_thread for booking_id in ids]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--ids', type=int, default=500000, help='IDs per process')
+    parser.add_argument('--threads', type=int, default=2, help='generating threads per process')
+    parser.add_argument('--start', choices=('fork', 'spawn'), default='fork' if hasattr(os, 'fork') else 'spawn')
+    args = parser.parse_args()
+
+    # Forked workers start from a generator that has already been used
+    parent_ids = [index.generate_booking_id() for _ in range(1000)]
+
+    started = time.perf_counter()
+    context = multiprocessing.get_context(args.start)
+    with context.Pool(args.processes) as pool:
+        results = pool.starmap(generate, [(args.ids, args.threads)] * args.processes)
+    elapsed = time.perf_counter() - started
+
+    instances = {instance_id for instance_id, _ in results} | {index.booking_ids.instance_id}
+    seen = set(parent_ids)
+    total = len(parent_ids)
+    for _, ids in results:
+        seen.update(ids)
+        total += len(ids)
+    duplicates = total - len(seen)
+
+    print(f"{args.processes} processes ({args.start}) x {args.threads} threads x {args.ids:,} IDs "
+          f"in {elapsed:.2f}s ({args.processes * args.ids / elapsed:,.0f} IDs/s)")
+    print(f"distinct instance ids: {len(instances)} of {args.processes + 1}")
+    print(f"total IDs: {total:,}, distinct: {len(seen):,}, duplicates: {duplicates:,}")
+    sys.exit(1 if duplicates else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Concurrency stress test for daily capacity: no oversell under parallel payments.
+
+Loads more pending bookings for one day than that day's capacity, then pays
+for all of them from many threads at once through /api/process_payment,
+against the in-memory Firestore stand-in with simulated round-trip latency
+(or the sqlite/memory backends). Afterwards it checks that:
+
+- confirmed tickets never exceed the capacity,
+- confirmed tickets plus the remaining count equal the capacity exactly,
+- every request was confirmed, answered sold out (409), or gave up after
+  PAYMENT_RETRIES conflicting commits (reported as contention; expect these
+  with --shards 1 and many threads, which is what sharding avoids).
+
+Exits non-zero if any check fails.
+
+Usage:
+    python bench/stress_capacity.py [--capacity 1000] [--bookings 1500] [--threads 64]
+                                    [--shards 20] [--latency-ms 2] [--backend firestore|sqlite|memory]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'api'))
+sys.path.insert(0, BENCH_DIR)
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--capacity', type=int, default=1000)
+parser.add_argument('--bookings', type=int, default=1500)
+parser.add_argument('--threads', type=int, default=64)
+parser.add_argument('--shards', type=int, default=20)
+parser.add_argument('--latency-ms', type=float, default=2.0)
+parser.add_argument('--backend', choices=('firestore', 'sqlite', 'memory'), default='firestore')
+args = parser.parse_args()
+
+from fake_firestore import InMemoryFirestore
+from smtp_sink import SMTPSink
+
+# Capacity settings are read at import, and confirmation emails go to a local sink
+sink = SMTPSink().start()
+os.environ.update({
+    'DAILY_CAPACITY': str(args.capacity),
+    'CAPACITY_SHARDS': str(args.shards),
+    'SMTP_SERVER': sink.host,
+    'SMTP_PORT': str(sink.port),
+    'SMTP_STARTTLS': 'false',
+    'STORAGE_BACKEND': 'memory',
+})
+
+import index
+
+def main():
+    validity = (datetime.now() + timedelta(days=1)).replace(hour=18, minute=0, second=0, microsecond=0)
+    day = validity.strftime('%Y-%m-%d')
+    emails = [f"visitor{i:06d}@example.com" for i in range(args.bookings)]
+    bookings = {
+        index.email_doc_id_for(email): {
+            'email': email,
+            'phone': '+91 98765 43210',
+            'tickets': 1 + i % 4,
+            'amount': 250 * (1 + i % 4),
+            'status': 'pending',
+            'validity': validity
+        }
+        for i, email in enumerate(emails)
+    }
+
+    db = None
+    if args.backend == 'firestore':
+        db = InMemoryFirestore(latency=args.latency_ms / 1000)
+        db.load('bookings', bookings)
+        index.storage = index.FirestoreStorage(db)
+    elif args.backend == 'sqlite':
+        index.storage = index.SQLiteStorage(os.path.join(tempfile.mkdtemp(prefix='capacity-stress-'), 'bookings.db'))
+        index.storage.put_bookings(bookings)
+    else:
+        index.storage = index.MemoryStorage()
+        index.storage.put_bookings(bookings)
+
+    outcomes = Counter()
+    pending = list(emails)
+    lock = threading.Lock()
+
+    def worker():
+        client = index.app.test_client()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                email = pending.pop()
+            response = client.post('/api/process_payment', json={'email': email})
+            result = response.get_json()
+            if response.status_code == 409 and result.get('sold_out'):
+                outcome = 'sold_out'
+            elif result.get('success'):
+                outcome = 'confirmed'
+            elif 'modified' in (result.get('message') or ''):
+                outcome = 'contention'
+            else:
+                outcome = f"failed: {result.get('message') or result.get('error')}"
+            with lock:
+                outcomes[outcome] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    confirmed_tickets = 0
+    for email_doc_id in bookings:
+        booking, _ = index.storage.get_booking(email_doc_id)
+        if booking.get('status') == 'completed':
+            confirmed_tickets += booking['tickets']
+    remaining = index.storage.remaining_capacity(day)
+
+    print(f"{args.bookings:,} bookings for {day}, capacity {args.capacity:,} tickets over {args.shards} shards, "
+          f"{args.threads} threads, {args.backend}")
+    print(f"  {dict(outcomes)} in {elapsed:.2f}s ({args.bookings / elapsed:,.0f} req/s)")
+    if db is not None:
+        print(f"  {db.round_trips:,} round trips, {db.commits:,} commits")
+    print(f"  confirmed tickets {confirmed_tickets:,}, remaining {remaining:,}")
+
+    failures = []
+    if confirmed_tickets > args.capacity:
+        failures.append(f"oversold by {confirmed_tickets - args.capacity}")
+    if confirmed_tickets + remaining != args.capacity:
+        failures.append(f"confirmed + remaining = {confirmed_tickets + remaining}, expected {args.capacity}")
+    if set(outcomes) - {'confirmed', 'sold_out', 'contention'}:
+        failures.append("some requests failed")
+    print("  FAIL: " + "; ".join(failures) if failures else "  OK: no oversell")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()